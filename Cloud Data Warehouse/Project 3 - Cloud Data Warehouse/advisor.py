@@ -0,0 +1,253 @@
+import argparse
+import configparser
+import psycopg2
+from sql_queries import (final_table_rows, column_key_stats, slice_count, songplay_rows, songplay_table_drop,
+                         user_table_drop, song_table_drop, artist_table_drop, time_table_drop)
+
+# dimensions up to this many rows are copied to every node (DISTSTYLE ALL)
+ALL_MAX_ROWS = 1000000
+# a distribution key needs at least this many distinct values per slice
+MIN_KEYS_PER_SLICE = 10
+# VARCHAR columns with at most this many distinct values are dictionary encoded
+BYTEDICT_MAX_DISTINCT = 255
+# slices per node of the dc2.large nodes of dwh.cfg, when stv_slices cannot be read
+SLICES_PER_NODE = 2
+
+NEXT_SONG = "page = 'NextSong'"
+
+# table -> list of (column, type, (staging table, staging column, filter) the column is loaded from);
+# songplays is read from the rows it is loaded with (songplay_rows), its keys are not in staging_events
+FINAL_TABLE_COLUMNS = {
+    'songplays': [
+        ('songplay_id', 'INTEGER IDENTITY(0,1)', None),
+        ('start_time', 'TIMESTAMP', (songplay_rows, 'start_time', 'TRUE')),
+        ('user_id', 'INTEGER', (songplay_rows, 'user_id', 'TRUE')),
+        ('level', 'VARCHAR', (songplay_rows, 'level', 'TRUE')),
+        ('song_id', 'VARCHAR', (songplay_rows, 'song_id', 'TRUE')),
+        ('artist_id', 'VARCHAR', (songplay_rows, 'artist_id', 'TRUE')),
+        ('session_id', 'INTEGER', (songplay_rows, 'session_id', 'TRUE')),
+        ('location', 'VARCHAR', (songplay_rows, 'location', 'TRUE')),
+        ('user_agent', 'VARCHAR', (songplay_rows, 'user_agent', 'TRUE')),
+    ],
+    'users': [
+        ('user_id', 'INTEGER', ('staging_events', 'userId', 'userId IS NOT NULL')),
+        ('first_name', 'VARCHAR', ('staging_events', 'firstName', 'userId IS NOT NULL')),
+        ('last_name', 'VARCHAR', ('staging_events', 'lastName', 'userId IS NOT NULL')),
+        ('gender', 'CHAR(1)', ('staging_events', 'gender', 'userId IS NOT NULL')),
+        ('level', 'VARCHAR', ('staging_events', 'level', 'userId IS NOT NULL')),
+    ],
+    'songs': [
+        ('song_id', 'VARCHAR', ('staging_songs', 'song_id', 'song_id IS NOT NULL')),
+        ('title', 'VARCHAR', ('staging_songs', 'title', 'song_id IS NOT NULL')),
+        ('artist_id', 'VARCHAR', ('staging_songs', 'artist_id', 'song_id IS NOT NULL')),
+        ('year', 'INTEGER', None),
+        ('duration', 'DECIMAL', None),
+    ],
+    'artists': [
+        ('artist_id', 'VARCHAR', ('staging_songs', 'artist_id', 'artist_id IS NOT NULL')),
+        ('name', 'VARCHAR', ('staging_songs', 'artist_name', 'artist_id IS NOT NULL')),
+        ('location', 'VARCHAR', ('staging_songs', 'artist_location', 'artist_id IS NOT NULL')),
+        ('latitude', 'DECIMAL', None),
+        ('longitude', 'DECIMAL', None),
+    ],
+    'time': [
+        ('start_time', 'TIMESTAMP', ('staging_events', 'ts', NEXT_SONG)),
+        ('hour', 'INTEGER', None),
+        ('day', 'INTEGER', None),
+        ('week', 'INTEGER', None),
+        ('month', 'INTEGER', None),
+        ('year', 'INTEGER', None),
+        ('weekday', 'INTEGER', None),
+    ],
+}
+
+# dimension -> its primary key, which is also its join key with songplays
+DIMENSION_KEYS = {'songs': 'song_id', 'artists': 'artist_id', 'users': 'user_id', 'time': 'start_time'}
+
+FINAL_TABLE_DROPS = {'songplays': songplay_table_drop, 'users': user_table_drop, 'songs': song_table_drop,
+                     'artists': artist_table_drop, 'time': time_table_drop}
+
+
+def gather_stats(cur, default_slices):
+    """
+    This function reads the statistics of the staged data the advice is based on.
+
+    INPUTS:
+    * cur the cursor variable
+    * default_slices the number of slices used when stv_slices cannot be read
+
+    OUTPUT:
+    * dict of final table to its expected rows
+    * dict of (table, column) to (distinct values, rows of the most frequent value)
+    * the number of slices of the cluster
+    """
+    cur.execute(final_table_rows)
+    rows = dict(zip(['songplays', 'users', 'songs', 'artists', 'time'], cur.fetchone()))
+
+    column_stats = {}
+    for table, columns in FINAL_TABLE_COLUMNS.items():
+        for column, _, source in columns:
+            if source is not None:
+                cur.execute(column_key_stats.format(source[1], source[0], source[2]))
+                column_stats[(table, column)] = cur.fetchone()
+
+    try:
+        cur.execute(slice_count)
+        slices = cur.fetchone()[0]
+    except psycopg2.Error:
+        cur.connection.rollback()
+        slices = default_slices
+
+    return rows, column_stats, slices
+
+
+def key_skew_ok(rows, stats, slices):
+    """
+    Returns whether a column spreads rows evenly enough to be a distribution key:
+    enough distinct values for every slice, and no value holding more rows than
+    an even share of a slice.
+    """
+    if not stats or not stats[0]:
+        return False
+    distinct, max_rows = stats
+    return distinct >= MIN_KEYS_PER_SLICE * slices and (max_rows or 0) <= max(1, rows / slices)
+
+
+def choose_encoding(column, column_type, stats, sortkey):
+    """
+    Returns the (encoding, reason) of a column.
+    """
+    if column == sortkey:
+        return 'RAW', 'sort key, left uncompressed so that zone maps stay effective'
+    if column_type.startswith(('INTEGER', 'BIGINT', 'DECIMAL', 'TIMESTAMP', 'DATE')):
+        return 'AZ64', 'numeric or time value'
+    if stats and stats[0] is not None and stats[0] <= BYTEDICT_MAX_DISTINCT:
+        return 'BYTEDICT', '{} distinct values'.format(stats[0])
+    return 'ZSTD', 'free text{}'.format(', {} distinct values'.format(stats[0]) if stats else '')
+
+
+def choose_distribution(table, rows, column_stats, slices, layouts):
+    """
+    Returns the (diststyle, distkey, reasons) of a table. The dimensions must be
+    decided before songplays, whose choice depends on theirs (`layouts`).
+    """
+    if table in DIMENSION_KEYS:
+        key = DIMENSION_KEYS[table]
+        if rows[table] <= ALL_MAX_ROWS:
+            return 'ALL', None, ['{} rows, at most {}: a full copy on every node is cheap and its joins with '
+                                 'songplays never redistribute'.format(rows[table], ALL_MAX_ROWS)]
+        return 'KEY', key, ['{} rows, more than {}: distributed on {}, its join key with songplays, '
+                            'so that the join is collocated'.format(rows[table], ALL_MAX_ROWS, key)]
+
+    reasons = []
+    keyed = sorted((rows[dimension], dimension) for dimension in DIMENSION_KEYS
+                   if layouts[dimension][0] == 'KEY')
+    for _, dimension in reversed(keyed):
+        key = DIMENSION_KEYS[dimension]
+        if key_skew_ok(rows[table], column_stats.get((table, key)), slices):
+            reasons.append('distributed on {} like {}, the largest distributed dimension it can be collocated with, '
+                           'so that their join is collocated'.format(key, dimension))
+            return 'KEY', key, reasons
+        reasons.append('{} is too skewed to distribute on ({} distinct values, {} rows for the most frequent, '
+                       '{} slices): the join with {} redistributes'.format(
+                           key, *(column_stats.get((table, key)) or (None, None)), slices, dimension))
+
+    if not keyed:
+        reasons.append('every dimension is copied to all nodes, so no join redistributes: '
+                       'the {} rows are spread evenly over the {} slices'.format(rows[table], slices))
+    return 'EVEN', None, reasons
+
+
+def create_table_query(table, diststyle, distkey, sortkey, encodings):
+    """
+    Returns the CREATE TABLE query of a final table with its layout.
+    """
+    primary_key = DIMENSION_KEYS.get(table)
+    columns = ',\n'.join('    {} {}{} ENCODE {}'.format(column, column_type,
+                                                        '  PRIMARY KEY' if column == primary_key else '',
+                                                        encodings[column])
+                         for column, column_type, _ in FINAL_TABLE_COLUMNS[table])
+
+    layout = 'DISTSTYLE {}'.format(diststyle)
+    if distkey:
+        layout += '\nDISTKEY ({})'.format(distkey)
+    return 'CREATE TABLE {}(\n{})\n{}\nSORTKEY ({});\n'.format(table, columns, layout, sortkey)
+
+
+def advise(rows, column_stats, slices):
+    """
+    This function chooses the distribution style, distribution key, sort key and column
+    encodings of every final table from the statistics of the staged data.
+
+    OUTPUT:
+    * create_table_queries of the final tables, in the order of FINAL_TABLE_COLUMNS
+    * dict of table to the list of reasons of its layout
+    """
+    layouts = {}
+    for table in list(DIMENSION_KEYS) + ['songplays']:
+        layouts[table] = choose_distribution(table, rows, column_stats, slices, layouts)
+
+    queries = []
+    explanations = {}
+    for table, columns in FINAL_TABLE_COLUMNS.items():
+        diststyle, distkey, reasons = layouts[table]
+        sortkey = DIMENSION_KEYS.get(table, 'start_time')
+        reasons = list(reasons)
+        if table == 'songplays':
+            reasons.append('sorted on start_time: analyses filter song plays on time ranges')
+        else:
+            reasons.append('sorted on {}: the merge of etl.py deletes and joins on it'.format(sortkey))
+
+        encodings = {}
+        for column, column_type, _ in columns:
+            encodings[column], reason = choose_encoding(column, column_type, column_stats.get((table, column)),
+                                                        sortkey)
+            reasons.append('{} {}: {}'.format(column, encodings[column], reason))
+
+        queries.append(create_table_query(table, diststyle, distkey, sortkey, encodings))
+        explanations[table] = reasons
+
+    return queries, explanations
+
+
+def main():
+    """
+    Prints the advised CREATE TABLE queries of the final tables, each preceded by the reasons
+    of its layout, from the statistics of the loaded staging tables.
+    With --apply, the final tables are dropped and created again with the advised layout.
+    """
+    parser = argparse.ArgumentParser(description='Advise the Redshift layout of the Sparkify final tables')
+    parser.add_argument('--output', default=None, help='SQL file to write the advised queries to')
+    parser.add_argument('--apply', action='store_true',
+                        help='drop and create the final tables with the advised layout (their rows are lost)')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    cur = conn.cursor()
+
+    rows, column_stats, slices = gather_stats(cur, int(config.get('DWH', 'DWH_NUM_NODES')) * SLICES_PER_NODE)
+    queries, explanations = advise(rows, column_stats, slices)
+
+    script = ''
+    for query, (table, reasons) in zip(queries, explanations.items()):
+        script += '\n'.join('-- ' + reason for reason in reasons) + '\n' + query + '\n'
+    print(script)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as f:
+            f.write(script)
+
+    if args.apply:
+        for table, query in zip(explanations, queries):
+            cur.execute(FINAL_TABLE_DROPS[table])
+            cur.execute(query)
+        conn.commit()
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 import configparser
 import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+from sql_queries import copy_table_queries, merge_table_queries, merge_stage_drop
 
 
 def load_staging_tables(cur, conn):
@@ -14,11 +14,29 @@ def load_staging_tables(cur, conn):
 
 def insert_tables(cur, conn):
     """
-    Extract data from the staging tables and insert it to all other existing tables
+    Extract data from the staging tables and merge it into all other existing tables:
+    for each table, the deduplicated staging rows replace the rows with the same keys.
+    All tables are merged in one transaction, so reloading the same data is idempotent
+    and a failure leaves the tables unchanged.
+    Prints the rows deleted and inserted per table.
     """
-    for query in insert_table_queries:
-        cur.execute(query)
+    counts = {}
+    try:
+        for table, (stage, delete, insert) in merge_table_queries.items():
+            cur.execute(merge_stage_drop.format(table))
+            cur.execute(stage)
+            cur.execute(delete)
+            deleted = cur.rowcount
+            cur.execute(insert)
+            counts[table] = (deleted, cur.rowcount)
+            cur.execute(merge_stage_drop.format(table))
         conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+
+    for table, (deleted, inserted) in counts.items():
+        print('{}: {} existing rows replaced, {} rows inserted'.format(table, deleted, inserted))
 
 
 def main():
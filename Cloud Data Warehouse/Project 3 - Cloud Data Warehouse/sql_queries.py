@@ -11,6 +11,7 @@ LOG_DATA = config.get("S3","LOG_DATA")
 LOG_JSONPATH = config.get("S3", "LOG_JSONPATH")
 SONG_DATA = config.get("S3", "SONG_DATA")
 DWH_ROLE_ARN = config.get("IAM_ROLE","ARN")
+MANIFEST_PREFIX = config.get("S3", "MANIFEST_PREFIX", fallback="")
 
 # DROP TABLES
 
@@ -21,6 +22,7 @@ user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+staging_loads_table_drop = "DROP TABLE IF EXISTS staging_loads"
 
 # CREATE TABLES
 
@@ -64,11 +66,29 @@ CREATE TABLE staging_songs(
 );
 """)
 
-# songplays table is a small table, no need for distkey
+# One row per COPY of a manifest: the partitions already loaded with the same files
+# (manifest_key, a hash of their keys and sizes) are skipped by incremental loads
+staging_loads_table_create = ("""
+CREATE TABLE staging_loads(
+    staging_table VARCHAR,
+    partition_key VARCHAR,
+    manifest VARCHAR,
+    manifest_key VARCHAR(64),
+    files INTEGER,
+    rows_loaded BIGINT,
+    load_ms BIGINT,
+    loaded_at TIMESTAMP
+);
+""")
+
+# Default layout for the sample data size, all dimensions being far below a million rows:
+# the dimensions are copied to every node (diststyle all) so that the star join never
+# redistributes, and the fact table is spread evenly and sorted on time.
+# advisor.py generates the layout from the statistics of the staged data.
 songplay_table_create = ("""
 CREATE TABLE songplays(
-    songplay_id INTEGER IDENTITY(0,1) NULL sortkey,
-    start_time TIMESTAMP,
+    songplay_id INTEGER IDENTITY(0,1),
+    start_time TIMESTAMP sortkey,
     user_id INTEGER,
     level VARCHAR,
     song_id VARCHAR,
@@ -76,53 +96,49 @@ CREATE TABLE songplays(
     session_id INTEGER,
     location VARCHAR,
     user_agent VARCHAR)
-diststyle all;
+diststyle even;
 """)
 
-# user table is a small table, no need for distkey
 user_table_create = ("""
 CREATE TABLE users(
     user_id INTEGER  PRIMARY KEY sortkey,
     first_name VARCHAR,
     last_name VARCHAR,
     gender CHAR(1),
-    level VARCHAR 
-);
+    level VARCHAR)
+diststyle all;
 """)
 
-# song table has over 10 thousands of records artist_id used as distkey
 song_table_create = ("""
 CREATE TABLE songs(
-    song_id VARCHAR  PRIMARY KEY,
+    song_id VARCHAR  PRIMARY KEY sortkey,
     title VARCHAR,
-    artist_id VARCHAR distkey,
+    artist_id VARCHAR,
     year INTEGER,
     duration DECIMAL)
 diststyle all;
 """)
 
-# artist table has over 14 thousands of records artist_id used as distkey
 artist_table_create = ("""
 CREATE TABLE artists(
-    artist_id VARCHAR  PRIMARY KEY distkey,
+    artist_id VARCHAR  PRIMARY KEY sortkey,
     name VARCHAR,
     location VARCHAR,
     latitude DECIMAL,
-    longitude DECIMAL 
-);
+    longitude DECIMAL)
+diststyle all;
 """)
 
-# time table has over 8 thousands of records artist_id used as distkey
 time_table_create = ("""
 CREATE TABLE time(
-    start_time TIMESTAMP  PRIMARY KEY distkey,
+    start_time TIMESTAMP  PRIMARY KEY sortkey,
     hour INTEGER,
     day INTEGER,
     week INTEGER,
     month INTEGER,
     year INTEGER,
-    weekday INTEGER 
-);
+    weekday INTEGER)
+diststyle all;
 """)
 
 # STAGING TABLES
@@ -146,77 +162,278 @@ staging_songs_copy = ("""
     FORMAT AS JSON 'auto';
 """).format(SONG_DATA, DWH_ROLE_ARN)
 
+# Same COPYs as above, from a manifest listing the files of one partition
+staging_events_copy_manifest = ("""
+    COPY staging_events
+    FROM '{{}}'
+    CREDENTIALS 'aws_iam_role={}'
+    MANIFEST
+    COMPUPDATE OFF
+    REGION 'us-west-2'
+    TIMEFORMAT AS 'epochmillisecs'
+    TRUNCATECOLUMNS BLANKSASNULL EMPTYASNULL
+    JSON {};
+""").format(DWH_ROLE_ARN, LOG_JSONPATH)
+
+staging_songs_copy_manifest = ("""
+    COPY staging_songs FROM '{{}}'
+    CREDENTIALS 'aws_iam_role={}'
+    MANIFEST
+    COMPUPDATE OFF region 'us-west-2'
+    TRUNCATECOLUMNS BLANKSASNULL EMPTYASNULL
+    FORMAT AS JSON 'auto';
+""").format(DWH_ROLE_ARN)
+
+# Load statistics of the last COPY of the session, from the Redshift system tables
+copy_load_stats = ("""
+SELECT DATEDIFF(ms, q.starttime, q.endtime) AS load_ms,
+       (SELECT COUNT(DISTINCT lc.filename) FROM stl_load_commits lc WHERE lc.query = q.query) AS files,
+       (SELECT SUM(lc.lines_scanned) FROM stl_load_commits lc WHERE lc.query = q.query) AS rows_loaded
+FROM stl_query q
+WHERE q.query = pg_last_copy_id();
+""")
+
+staging_loads_insert = ("""
+INSERT INTO staging_loads(staging_table, partition_key, manifest, manifest_key, files, rows_loaded, load_ms,
+                          loaded_at)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
+""")
+
+staging_loads_select = ("""
+SELECT partition_key, manifest_key FROM staging_loads WHERE staging_table = %s ORDER BY loaded_at;
+""")
+
+staging_table_truncate = "TRUNCATE {};"
+
+# STAGING STATISTICS (advisor.py)
+
+# The rows songplays is loaded with, matched and deduplicated like songplay_table_stage, as a
+# derived table: the statistics of songplays are those of its own columns, e.g. of song_id and
+# artist_id rather than of the song and artist titles of staging_events
+songplay_rows = ("""(
+    SELECT start_time, user_id, level, song_id, artist_id, session_id, location, user_agent
+    FROM (
+        SELECT se.ts         AS start_time,
+               se.userId     AS user_id,
+               se.level      AS level,
+               ss.song_id    AS song_id,
+               ss.artist_id  AS artist_id,
+               se.sessionID  AS session_id,
+               se.location   AS location,
+               se.userAgent  AS user_agent,
+               ROW_NUMBER() OVER (PARTITION BY se.ts, se.userId, se.sessionID
+                                  ORDER BY ss.song_id, ss.artist_id) AS row_number
+        FROM staging_events se
+        JOIN staging_songs ss ON (se.song = ss.title) AND (se.artist = ss.artist_name)
+        WHERE se.page = 'NextSong' AND se.ts IS NOT NULL
+    ) AS songplays_ranked
+    WHERE row_number = 1
+) AS songplay_rows""")
+
+# Expected rows of the final tables
+final_table_rows = ("""
+SELECT (SELECT COUNT(*) FROM {})                                                             AS songplays,
+       (SELECT COUNT(DISTINCT userId) FROM staging_events WHERE userId IS NOT NULL)          AS users,
+       (SELECT COUNT(DISTINCT song_id) FROM staging_songs WHERE song_id IS NOT NULL)         AS songs,
+       (SELECT COUNT(DISTINCT artist_id) FROM staging_songs WHERE artist_id IS NOT NULL)     AS artists,
+       (SELECT COUNT(DISTINCT ts) FROM staging_events WHERE page = 'NextSong')               AS time;
+""").format(songplay_rows)
+
+# Number of distinct values and rows of the most frequent value of a column: {column}, {table}, {where}
+column_key_stats = ("""
+SELECT COUNT(*), MAX(key_rows)
+FROM (
+    SELECT {0}, COUNT(*) AS key_rows
+    FROM {1}
+    WHERE {2}
+    GROUP BY {0}
+) AS keys;
+""")
+
+slice_count = "SELECT COUNT(*) FROM stv_slices;"
+
 # FINAL TABLES
 
-# Get distinct (no duplicate) data from joined staging_events & staging_songs tables and insert it into songplays table
+# Each final table is loaded with a merge, all tables in one transaction:
+# 1. the deduplicated rows of the staging tables are computed once into a temporary table,
+#    keeping one row per key with ROW_NUMBER() (Redshift does not enforce primary keys)
+# 2. the rows of the final table with the same keys are deleted
+# 3. the temporary rows are inserted
+# so that loading the same S3 prefix twice leaves the final tables unchanged
+
+merge_stage_drop = "DROP TABLE IF EXISTS {}_stage;"
+
+# One row per song play, i.e. per (ts, user, session) NextSong event of a song found in staging_songs.
+# ts is already a TIMESTAMP (TIMEFORMAT AS 'epochmillisecs' of the COPY), used as is for start_time.
+songplay_table_stage = ("""
+CREATE TEMP TABLE songplays_stage AS
+WITH next_songs AS (
+    SELECT se.ts, se.userId, se.level, se.song, se.artist, se.sessionID, se.location, se.userAgent
+    FROM staging_events se
+    WHERE se.page = 'NextSong' AND se.ts IS NOT NULL
+)
+SELECT start_time, user_id, level, song_id, artist_id, session_id, location, user_agent
+FROM (
+    SELECT ns.ts         AS start_time,
+           ns.userId     AS user_id,
+           ns.level      AS level,
+           ss.song_id    AS song_id,
+           ss.artist_id  AS artist_id,
+           ns.sessionID  AS session_id,
+           ns.location   AS location,
+           ns.userAgent  AS user_agent,
+           ROW_NUMBER() OVER (PARTITION BY ns.ts, ns.userId, ns.sessionID
+                              ORDER BY ss.song_id, ss.artist_id) AS row_number
+    FROM next_songs ns
+    JOIN staging_songs ss ON (ns.song = ss.title) AND (ns.artist = ss.artist_name)
+) AS songplays_ranked
+WHERE row_number = 1;
+""")
+
+songplay_table_delete = ("""
+DELETE FROM songplays
+USING songplays_stage
+WHERE songplays.start_time = songplays_stage.start_time
+  AND songplays.user_id = songplays_stage.user_id
+  AND songplays.session_id = songplays_stage.session_id;
+""")
+
 songplay_table_insert = ("""
 INSERT INTO songplays(start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
-SELECT DISTINCT TO_DATE(se.ts,'dd.mm.yyyy/hh:mi:ss') AS start_time,
-                se.userId                            AS user_id,
-                se.level                             AS level,
-                ss.song_id                           AS song_id,
-                ss.artist_id                         AS artist_id,
-                se.sessionID                         AS session_id,
-                se.location                          AS location,
-                se.userAgent                         AS user_agent
-FROM staging_events se
-JOIN staging_songs ss ON (se.song = ss.title) AND (se.artist = ss.artist_name)
-WHERE se.ts IS NOT NULL;
-""")
-
-# Get distinct (no duplicate) data from staging_events table and insert it into users table
+SELECT start_time, user_id, level, song_id, artist_id, session_id, location, user_agent
+FROM songplays_stage;
+""")
+
+# One row per user, from its latest event so that the level is the current one
+user_table_stage = ("""
+CREATE TEMP TABLE users_stage AS
+SELECT user_id, first_name, last_name, gender, level
+FROM (
+    SELECT se.userId    AS user_id,
+           se.firstName AS first_name,
+           se.lastName  AS last_name,
+           se.gender    AS gender,
+           se.level     AS level,
+           ROW_NUMBER() OVER (PARTITION BY se.userId ORDER BY se.ts DESC) AS row_number
+    FROM staging_events se
+    WHERE se.userId IS NOT NULL
+) AS users_ranked
+WHERE row_number = 1;
+""")
+
+user_table_delete = ("""
+DELETE FROM users
+USING users_stage
+WHERE users.user_id = users_stage.user_id;
+""")
+
 user_table_insert = ("""
 INSERT INTO users(user_id, first_name, last_name, gender, level)
-SELECT DISTINCT se.userId    AS user_id,
-                se.firstName AS first_name,
-                se.lastName  AS last_name,
-                se.gender    AS gender,
-                se.level     AS level
-FROM staging_events se
-WHERE se.userId IS NOT NULL;
+SELECT user_id, first_name, last_name, gender, level
+FROM users_stage;
+""")
+
+# One row per song
+song_table_stage = ("""
+CREATE TEMP TABLE songs_stage AS
+SELECT song_id, title, artist_id, year, duration
+FROM (
+    SELECT ss.song_id      AS song_id,
+           ss.title        AS title,
+           ss.artist_id    AS artist_id,
+           ss.year         AS year,
+           ss.duration     AS duration,
+           ROW_NUMBER() OVER (PARTITION BY ss.song_id ORDER BY ss.year DESC, ss.duration DESC) AS row_number
+    FROM staging_songs ss
+    WHERE ss.song_id IS NOT NULL
+) AS songs_ranked
+WHERE row_number = 1;
+""")
+
+song_table_delete = ("""
+DELETE FROM songs
+USING songs_stage
+WHERE songs.song_id = songs_stage.song_id;
 """)
 
-# Get distinct (no duplicate) data from staging_songs table and insert it into songs table
 song_table_insert = ("""
 INSERT INTO songs(song_id, title, artist_id, year, duration)
-SELECT  ss.song_id      AS song_id,
-        ss.title        AS title,
-        ss.artist_id    AS artist_id,
-        ss.year         AS year,
-        ss.duration     AS duration
-FROM staging_songs ss
-WHERE ss.song_id IS NOT NULL;
+SELECT song_id, title, artist_id, year, duration
+FROM songs_stage;
+""")
+
+# One row per artist, preferring the rows with a location
+artist_table_stage = ("""
+CREATE TEMP TABLE artists_stage AS
+SELECT artist_id, name, location, latitude, longitude
+FROM (
+    SELECT ss.artist_id        AS artist_id,
+           ss.artist_name      AS name,
+           ss.artist_location  AS location,
+           ss.artist_latitude  AS latitude,
+           ss.artist_longitude AS longitude,
+           ROW_NUMBER() OVER (PARTITION BY ss.artist_id
+                              ORDER BY ss.artist_latitude NULLS LAST, ss.artist_location NULLS LAST,
+                                       ss.artist_name) AS row_number
+    FROM staging_songs ss
+    WHERE ss.artist_id IS NOT NULL
+) AS artists_ranked
+WHERE row_number = 1;
+""")
+
+artist_table_delete = ("""
+DELETE FROM artists
+USING artists_stage
+WHERE artists.artist_id = artists_stage.artist_id;
 """)
 
-# Get distinct (no duplicate) data from staging_songs table and insert it into artists table
 artist_table_insert = ("""
 INSERT INTO artists(artist_id, name, location, latitude, longitude)
-SELECT DISTINCT ss.artist_id        AS artist_id,
-                ss.artist_name      AS name,
-                ss.artist_location  AS location,
-                ss.artist_latitude  AS latitude,
-                ss.artist_longitude AS longitude
-FROM staging_songs ss
-WHERE ss.artist_id IS NOT NULL;
+SELECT artist_id, name, location, latitude, longitude
+FROM artists_stage;
+""")
+
+# One row per start_time of a NextSong event, its calendar parts computed once from the native TIMESTAMP
+# (EXTRACT rather than DATEPART, so that the same SQL runs on Postgres; WEEK is the ISO week, DOW 0 is Sunday)
+time_table_stage = ("""
+CREATE TEMP TABLE time_stage AS
+WITH event_times AS (
+    SELECT DISTINCT se.ts AS start_time
+    FROM staging_events se
+    WHERE se.page = 'NextSong' AND se.ts IS NOT NULL
+)
+SELECT start_time,
+       CAST(EXTRACT(HOUR FROM start_time) AS INTEGER)  AS hour,
+       CAST(EXTRACT(DAY FROM start_time) AS INTEGER)   AS day,
+       CAST(EXTRACT(WEEK FROM start_time) AS INTEGER)  AS week,
+       CAST(EXTRACT(MONTH FROM start_time) AS INTEGER) AS month,
+       CAST(EXTRACT(YEAR FROM start_time) AS INTEGER)  AS year,
+       CAST(EXTRACT(DOW FROM start_time) AS INTEGER)   AS weekday
+FROM event_times;
+""")
+
+time_table_delete = ("""
+DELETE FROM time
+USING time_stage
+WHERE time.start_time = time_stage.start_time;
 """)
 
-# Get distinct (no duplicate) data from staging_events table and insert it into time table
 time_table_insert = ("""
-INSERT INTO time(start_time, hour, day, month, week, year, weekday)
-SELECT DISTINCT TO_DATE(se.ts,'dd.mm.yyyy/hh:mi:ss') AS start_time,
-                DATEPART(HOUR,start_time)            AS hour,
-                DATEPART(DAY,start_time)             AS day,
-                DATEPART(MONTH,start_time)           AS month,
-                DATEPART(WEEK,start_time)            AS week,
-                DATEPART(YEAR,start_time)            AS year,
-                DATEPART(WEEKDAY,start_time)         AS weekday
-FROM staging_events se
-WHERE se.ts IS NOT NULL;
+INSERT INTO time(start_time, hour, day, week, month, year, weekday)
+SELECT start_time, hour, day, week, month, year, weekday
+FROM time_stage;
 """)
 
 # QUERY LISTS
 
-create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
+create_table_queries = [staging_events_table_create, staging_songs_table_create, staging_loads_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
+drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, staging_loads_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
 copy_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
+# table -> (stage, delete, insert) queries of its merge, dimensions first
+merge_table_queries = {
+    'songs': (song_table_stage, song_table_delete, song_table_insert),
+    'artists': (artist_table_stage, artist_table_delete, artist_table_insert),
+    'users': (user_table_stage, user_table_delete, user_table_insert),
+    'time': (time_table_stage, time_table_delete, time_table_insert),
+    'songplays': (songplay_table_stage, songplay_table_delete, songplay_table_insert),
+}
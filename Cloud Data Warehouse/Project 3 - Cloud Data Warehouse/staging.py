@@ -0,0 +1,393 @@
+import io
+import os
+import re
+import json
+import hashlib
+import time
+import argparse
+import configparser
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from sql_queries import (LOG_DATA, SONG_DATA, MANIFEST_PREFIX, staging_events_copy_manifest,
+                         staging_songs_copy_manifest, copy_load_stats, staging_loads_insert,
+                         staging_loads_select, staging_table_truncate, staging_events_table_create,
+                         staging_songs_table_create, staging_loads_table_create)
+
+# fields of a log record in the order of the staging_events columns (log_json_path.json)
+EVENT_FIELDS = ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName', 'length',
+                'level', 'location', 'method', 'page', 'registration', 'sessionId', 'song',
+                'status', 'ts', 'userAgent', 'userId']
+# fields of a song record in the order of the staging_songs columns (JSON 'auto')
+SONG_FIELDS = ['num_songs', 'artist_id', 'artist_latitude', 'artist_longitude', 'artist_location',
+               'artist_name', 'song_id', 'title', 'duration', 'year']
+
+LOG_DATE_RE = re.compile(r'(\d{4}-\d{2}-\d{2})-events\.json$')
+
+
+def strip_quotes(url):
+    """
+    Returns a dwh.cfg S3 location without the SQL quotes, e.g. s3://udacity-dend/log_data.
+    """
+    return url.strip().strip("'")
+
+
+def log_partition(key, prefix):
+    """
+    Returns the date partition of a log file, e.g. log_data/2018/11/2018-11-12-events.json -> 2018-11-12.
+    """
+    match = LOG_DATE_RE.search(key)
+    return match.group(1) if match else None
+
+
+def song_partition(key, prefix):
+    """
+    Returns the prefix partition of a song file, i.e. the first letter of its track ID
+    directory, e.g. song_data/A/B/C/TRABCEI128F424C983.json -> A.
+    """
+    parts = key[len(prefix):].strip('/').split('/')
+    return parts[0] if len(parts) > 1 else None
+
+
+# staging table -> (source location, function returning the partition of a file, manifest COPY)
+STAGING_SOURCES = {
+    'staging_events': (strip_quotes(LOG_DATA), log_partition, staging_events_copy_manifest),
+    'staging_songs': (strip_quotes(SONG_DATA), song_partition, staging_songs_copy_manifest),
+}
+
+
+def build_manifests(files, prefix, partition_func, start=None, end=None):
+    """
+    This function groups files by partition, dropping the partitions outside of [start, end].
+
+    INPUTS:
+    * files the (key, size) of the files (S3 object keys or local paths) under prefix
+    * prefix the common prefix of the keys
+    * partition_func function (key, prefix) -> partition, None for files to skip
+    * start, end optional bounds of the partitions, e.g. dates of the log files
+
+    OUTPUT:
+    * dict of partition to the sorted list of the (key, size) of its files
+    """
+    manifests = {}
+    for key, size in files:
+        partition = partition_func(key, prefix)
+        if partition is None or (start and partition < start) or (end and partition > end):
+            continue
+        manifests.setdefault(partition, []).append((key, size))
+
+    return {partition: sorted(files) for partition, files in sorted(manifests.items())}
+
+
+def manifest_key(files):
+    """
+    Returns the SHA-256 hex digest of the keys and sizes of the files of a manifest,
+    which changes when a file is added, removed or rewritten with another size.
+    """
+    digest = hashlib.sha256()
+    for key, size in sorted(files):
+        digest.update('{}\t{}\n'.format(key, size).encode('utf8'))
+    return digest.hexdigest()
+
+
+def pending_manifests(table, manifests, loaded):
+    """
+    This function returns the manifests of an incremental load that still have to be loaded:
+    the partitions never loaded, or loaded with other files.
+    staging_events only holds the log days of the current run, so a changed day is loaded
+    again on its own. staging_songs keeps the rows of every run, and its rows cannot be
+    traced back to their partition: if a loaded song partition changed, all the song
+    partitions are loaded again into the emptied table, instead of staging old rows twice.
+
+    INPUTS:
+    * table the staging table, a key of STAGING_SOURCES
+    * manifests dict of partition to the (key, size) of its files, see build_manifests
+    * loaded dict of partition to the manifest key of its last COPY
+
+    OUTPUT:
+    * dict of the manifests to load
+    * sorted list of the loaded partitions whose files changed
+    """
+    keys = {partition: manifest_key(files) for partition, files in manifests.items()}
+    changed = sorted(p for p in loaded if p in keys and keys[p] != loaded[p])
+    if table != 'staging_events':
+        # a song partition whose files are all gone still has rows staged
+        changed = sorted(set(changed) | {p for p in loaded if p not in keys})
+        if changed:
+            return dict(manifests), changed
+
+    return {p: files for p, files in manifests.items() if loaded.get(p) != keys[p]}, changed
+
+
+def manifest_document(urls):
+    """
+    Returns the content of a Redshift COPY manifest listing urls.
+    """
+    return json.dumps({'entries': [{'url': url, 'mandatory': True} for url in urls]}, indent=1)
+
+
+class S3Staging:
+    """
+    Loads the staging tables of Redshift from S3: the manifests are written under
+    the MANIFEST_PREFIX of dwh.cfg and each COPY reads one manifest, its timings
+    being read back from the stl_query and stl_load_commits system tables.
+    """
+
+    def __init__(self, s3, manifest_prefix=MANIFEST_PREFIX):
+        """
+        INPUTS:
+        * s3 a boto3 S3 client
+        * manifest_prefix the s3://bucket/prefix the manifests are written to
+        """
+        if not strip_quotes(manifest_prefix):
+            raise ValueError('Set manifest_prefix in the S3 section of dwh.cfg to a writable S3 location')
+        self.s3 = s3
+        self.manifest_prefix = strip_quotes(manifest_prefix).rstrip('/')
+
+    def prefix(self, location):
+        """
+        Returns the common prefix of the keys returned by list_files.
+        """
+        return location.rstrip('/')
+
+    def list_files(self, location):
+        """
+        Returns the (key, size) of the JSON files under an s3://bucket/prefix location.
+        """
+        bucket, _, prefix = location[len('s3://'):].partition('/')
+        files = []
+        for page in self.s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            files.extend(('s3://{}/{}'.format(bucket, obj['Key']), obj['Size'])
+                         for obj in page.get('Contents', []) if obj['Key'].endswith('.json'))
+        return files
+
+    def write_manifest(self, table, partition, files):
+        """
+        Writes the manifest of a partition to S3 and returns its URL.
+        """
+        url = '{}/{}/{}.manifest'.format(self.manifest_prefix, table, partition)
+        bucket, _, key = url[len('s3://'):].partition('/')
+        self.s3.put_object(Bucket=bucket, Key=key, Body=manifest_document(files).encode('utf8'))
+        return url
+
+    def copy(self, cur, table, manifest):
+        """
+        Runs the COPY of a manifest and returns (files, rows, milliseconds) from the system tables.
+        """
+        cur.execute(STAGING_SOURCES[table][2].format(manifest))
+        cur.execute(copy_load_stats)
+        load_ms, files, rows = cur.fetchone()
+        return files, rows, load_ms
+
+
+class LocalStaging:
+    """
+    Offline stand-in of S3Staging for a local Postgres: the sources are local directories
+    mirroring the S3 prefixes, the manifests are local JSON files, and COPY is emulated
+    by reading the listed files and streaming them with COPY FROM STDIN, with the
+    conversions of the Redshift COPY options (epoch milliseconds to TIMESTAMP,
+    empty strings as NULL). The timings are measured by the client.
+    """
+
+    def __init__(self, data, manifest_dir):
+        """
+        INPUTS:
+        * data the local directory holding log_data and song_data
+        * manifest_dir the local directory the manifests are written to
+        """
+        self.data = data
+        self.manifest_dir = manifest_dir
+
+    def prefix(self, location):
+        """
+        Returns the local directory of an S3 location, e.g. s3://udacity-dend/log_data -> data/log_data.
+        """
+        return os.path.join(self.data, location.rstrip('/').rsplit('/', 1)[-1])
+
+    def list_files(self, location):
+        """
+        Returns the (path, size) of the JSON files under the local directory of an S3 location.
+        """
+        paths = []
+        for root, dirs, files in os.walk(self.prefix(location)):
+            paths.extend(os.path.join(root, f) for f in files if f.endswith('.json'))
+        return [(path, os.path.getsize(path)) for path in paths]
+
+    def write_manifest(self, table, partition, files):
+        """
+        Writes the manifest of a partition to the manifest directory and returns its path.
+        """
+        path = os.path.join(self.manifest_dir, table, '{}.manifest'.format(partition))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf8') as f:
+            f.write(manifest_document(files))
+        return path
+
+    def copy(self, cur, table, manifest):
+        """
+        Emulates the COPY of a manifest and returns (files, rows, milliseconds).
+        """
+        start = time.perf_counter()
+        with open(manifest, encoding='utf8') as f:
+            files = [entry['url'] for entry in json.load(f)['entries']]
+
+        fields = EVENT_FIELDS if table == 'staging_events' else SONG_FIELDS
+        buffer = io.StringIO()
+        rows = 0
+        for filepath in files:
+            with open(filepath, encoding='utf8') as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        buffer.write('\t'.join(copy_value(field, record.get(field)) for field in fields) + '\n')
+                        rows += 1
+
+        buffer.seek(0)
+        cur.copy_expert('COPY {} FROM STDIN'.format(table), buffer)
+        return len(files), rows, int((time.perf_counter() - start) * 1000)
+
+
+def postgres_ddl(query):
+    """
+    Returns a CREATE TABLE query of sql_queries.py without its Redshift-only clauses.
+    """
+    query = query.replace('INTEGER IDENTITY(0,1)', 'SERIAL')
+    query = re.sub(r'\s+(sortkey|distkey)\b', '', query, flags=re.I)
+    return re.sub(r'\s*diststyle \w+', '', query, flags=re.I)
+
+
+def create_local_tables(cur, conn):
+    """
+    Creates staging_events, staging_songs and staging_loads on a local Postgres,
+    unless they exist, for LocalStaging.
+    """
+    for query in [staging_events_table_create, staging_songs_table_create, staging_loads_table_create]:
+        cur.execute(postgres_ddl(query).replace('CREATE TABLE', 'CREATE TABLE IF NOT EXISTS', 1))
+    conn.commit()
+
+
+def copy_value(field, value):
+    """
+    Returns a JSON value in the COPY text format, converted like the Redshift COPY options
+    of sql_queries.py: epoch milliseconds of ts as a TIMESTAMP, empty strings as NULL.
+    """
+    if value is None or value == '':
+        return '\\N'
+    if field == 'ts':
+        value = datetime.fromtimestamp(value / 1000, timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')
+    elif field == 'registration':
+        value = int(value)
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def load_table(staging, dsn, table, incremental=True, start=None, end=None):
+    """
+    This function loads the pending partitions of a staging table, one COPY per manifest,
+    on its own connection, and records each COPY with its timings in staging_loads.
+    Incremental loads skip the partitions already recorded with the same files, see
+    pending_manifests; staging_events is truncated first, so that the final tables are
+    merged from the new log days only.
+
+    INPUTS:
+    * staging the S3Staging or LocalStaging backend
+    * dsn the connection string of the database
+    * table the staging table, a key of STAGING_SOURCES
+    * incremental whether to skip the partitions already loaded
+    * start, end optional bounds of the partitions, compared with the partitions of the table
+
+    OUTPUT:
+    * list of (partition, files, rows, milliseconds) of the COPYs
+    """
+    location, partition_func, _ = STAGING_SOURCES[table]
+    manifests = build_manifests(staging.list_files(location), staging.prefix(location), partition_func, start, end)
+
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    try:
+        changed = []
+        if incremental:
+            cur.execute(staging_loads_select, (table,))
+            # the key of the last COPY of each partition
+            loaded = dict(cur.fetchall())
+            manifests, changed = pending_manifests(table, manifests, loaded)
+            if changed:
+                print('{}: partitions {} changed since their last load'.format(table, ', '.join(changed)))
+        if table == 'staging_events' or not incremental or changed:
+            cur.execute(staging_table_truncate.format(table))
+            conn.commit()
+
+        loads = []
+        for partition, files in manifests.items():
+            manifest = staging.write_manifest(table, partition, [key for key, size in files])
+            num_files, rows, load_ms = staging.copy(cur, table, manifest)
+            cur.execute(staging_loads_insert, (table, partition, manifest, manifest_key(files), num_files, rows,
+                                               load_ms, datetime.now()))
+            conn.commit()
+            loads.append((partition, num_files, rows, load_ms))
+            print('{} {}: {} files, {} rows in {} ms'.format(table, partition, num_files, rows, load_ms))
+    finally:
+        conn.close()
+
+    return loads
+
+
+def load_staging(staging, dsn, incremental=True, start=None, end=None):
+    """
+    Loads staging_events and staging_songs concurrently, each on its own connection.
+    start and end are log dates (YYYY-MM-DD) and only bound the partitions of staging_events:
+    the song prefix partitions are letters, which no date range would keep.
+
+    OUTPUT:
+    * dict of staging table to the list of its COPYs, see load_table
+    """
+    with ThreadPoolExecutor(len(STAGING_SOURCES)) as executor:
+        futures = {table: executor.submit(load_table, staging, dsn, table, incremental,
+                                          *((start, end) if table == 'staging_events' else ()))
+                   for table in STAGING_SOURCES}
+        return {table: future.result() for table, future in futures.items()}
+
+
+def main():
+    """
+    Loads the staging tables from manifests, on Redshift from S3 by default,
+    or on a local Postgres from local files with --local-data.
+    """
+    parser = argparse.ArgumentParser(description='Load the Sparkify staging tables from COPY manifests')
+    parser.add_argument('--start', default=None, help='first log date (YYYY-MM-DD) to load')
+    parser.add_argument('--end', default=None, help='last log date (YYYY-MM-DD) to load')
+    parser.add_argument('--full-reload', action='store_true',
+                        help='truncate the staging tables and load every partition again')
+    parser.add_argument('--local-data', default=None,
+                        help='local directory holding log_data and song_data, to load a local Postgres')
+    parser.add_argument('--manifest-dir', default='manifests', help='local directory of the local manifests')
+    parser.add_argument('--dsn', default='host=127.0.0.1 dbname=sparkifydb user=student password=student',
+                        help='connection string of the local Postgres')
+    args = parser.parse_args()
+
+    if args.local_data:
+        staging = LocalStaging(args.local_data, args.manifest_dir)
+        dsn = args.dsn
+        conn = psycopg2.connect(dsn)
+        create_local_tables(conn.cursor(), conn)
+        conn.close()
+    else:
+        import boto3
+
+        config = configparser.ConfigParser()
+        config.read('dwh.cfg')
+        staging = S3Staging(boto3.client('s3', region_name='us-west-2',
+                                         aws_access_key_id=config.get('AWS', 'KEY'),
+                                         aws_secret_access_key=config.get('AWS', 'SECRET')))
+        dsn = "host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values())
+
+    start = time.perf_counter()
+    loads = load_staging(staging, dsn, not args.full_reload, args.start, args.end)
+    for table, copies in loads.items():
+        print('{}: {} COPYs, {} files, {} rows'.format(
+            table, len(copies), sum(c[1] for c in copies), sum(c[2] or 0 for c in copies)))
+    print('staging loaded in {:.1f} s'.format(time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
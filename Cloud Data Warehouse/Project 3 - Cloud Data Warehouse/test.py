@@ -0,0 +1,117 @@
+import psycopg2
+from datetime import datetime
+from sql_queries import (staging_events_table_create, staging_songs_table_create, songplay_table_create,
+                         user_table_create, song_table_create, artist_table_create, time_table_create)
+from etl import insert_tables
+from staging import postgres_ddl
+
+# local Postgres running the merge SQL of sql_queries.py, in a schema of its own
+DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+TEST_SCHEMA = 'dwh_test'
+
+TEST_SONGS = [
+    # num_songs, artist_id, artist_latitude, artist_longitude, artist_location, artist_name, song_id, title, duration, year
+    (1, 'ARTEST1', None, None, 'London, England', 'Test Artist', 'SOTEST1', 'Test Song', 200.5, 2000),
+]
+
+TEST_EVENTS = [
+    # ts, page, userId, firstName, lastName, gender, level, song, artist, length, sessionID, location, userAgent
+    (datetime(2018, 11, 5, 9, 15, 30, 123000), 'NextSong', 10, 'Ann', 'Lee', 'F', 'free',
+     'Test Song', 'Test Artist', 200.5, 100, 'Lansing, MI', 'Mozilla/5.0'),
+    # the same event staged twice, e.g. by two COPYs of the same file
+    (datetime(2018, 11, 5, 9, 15, 30, 123000), 'NextSong', 10, 'Ann', 'Lee', 'F', 'free',
+     'Test Song', 'Test Artist', 200.5, 100, 'Lansing, MI', 'Mozilla/5.0'),
+    # same day, other hour: a distinct start_time
+    (datetime(2018, 11, 5, 21, 40, 0), 'NextSong', 10, 'Ann', 'Lee', 'F', 'paid',
+     'Test Song', 'Test Artist', 200.5, 100, 'Lansing, MI', 'Mozilla/5.0'),
+    # a Sunday, song unknown: a time row but no song play
+    (datetime(2018, 11, 11, 23, 59, 59), 'NextSong', 11, 'Bob', 'Kim', 'M', 'free',
+     'Unknown Song', 'Unknown Artist', 180.0, 101, 'Chicago, IL', 'Mozilla/5.0'),
+    # not a song play: no time row
+    (datetime(2018, 11, 5, 10, 0, 0), 'Home', 10, 'Ann', 'Lee', 'F', 'free',
+     None, None, None, 100, 'Lansing, MI', 'Mozilla/5.0'),
+]
+
+
+def setup_tables(cur, conn):
+    """
+    Creates the staging and final tables in the test schema and stages the test rows.
+    """
+    cur.execute("DROP SCHEMA IF EXISTS {} CASCADE".format(TEST_SCHEMA))
+    cur.execute("CREATE SCHEMA {}".format(TEST_SCHEMA))
+    cur.execute("SET search_path TO {}".format(TEST_SCHEMA))
+    for query in [staging_events_table_create, staging_songs_table_create, songplay_table_create,
+                  user_table_create, song_table_create, artist_table_create, time_table_create]:
+        cur.execute(postgres_ddl(query))
+
+    cur.executemany("INSERT INTO staging_songs VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", TEST_SONGS)
+    cur.executemany("""
+        INSERT INTO staging_events(ts, page, userId, firstName, lastName, gender, level,
+                                   song, artist, length, sessionID, location, userAgent)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """, TEST_EVENTS)
+    conn.commit()
+
+
+def expected_time_rows():
+    """
+    Returns the time rows expected from the NextSong test events, computed in Python.
+    """
+    timestamps = sorted({event[0] for event in TEST_EVENTS if event[1] == 'NextSong'})
+    return [(ts, ts.hour, ts.day, ts.isocalendar()[1], ts.month, ts.year, (ts.weekday() + 1) % 7)
+            for ts in timestamps]
+
+
+def check_data(cur, conn):
+    print("Checking: Table time content")
+    cur.execute("SELECT start_time, hour, day, week, month, year, weekday FROM time ORDER BY start_time")
+    results = cur.fetchall()
+    print(results, "\n")
+    assert results == expected_time_rows(), "time rows differ from {}".format(expected_time_rows())
+
+    print("Checking: Table songplays content")
+    cur.execute("SELECT start_time, user_id, level, song_id, artist_id, session_id FROM songplays ORDER BY start_time")
+    results = cur.fetchall()
+    print(results, "\n")
+    assert results == [(datetime(2018, 11, 5, 9, 15, 30, 123000), 10, 'free', 'SOTEST1', 'ARTEST1', 100),
+                       (datetime(2018, 11, 5, 21, 40, 0), 10, 'paid', 'SOTEST1', 'ARTEST1', 100)], \
+        "songplays rows differ"
+
+    print("Checking: Table users content")
+    cur.execute("SELECT user_id, level FROM users ORDER BY user_id")
+    results = cur.fetchall()
+    print(results, "\n")
+    assert results == [(10, 'paid'), (11, 'free')], "users should keep the level of their latest event"
+
+    print("Checking: Tables songs and artists row count")
+    cur.execute("SELECT (SELECT COUNT(*) FROM songs), (SELECT COUNT(*) FROM artists)")
+    results = cur.fetchone()
+    print(results, "\n")
+    assert results == (1, 1), "songs and artists should have one row each"
+
+
+def main():
+    """
+    Regression test of the time dimension and fact pipeline: runs the merge of etl.py
+    against a local Postgres on a few staged events, twice to check it is idempotent,
+    and compares the final tables with the values computed in Python.
+    """
+    conn = psycopg2.connect(DSN)
+    cur = conn.cursor()
+
+    try:
+        setup_tables(cur, conn)
+        for run in range(2):
+            print("Run {} of insert_tables\n".format(run + 1))
+            insert_tables(cur, conn)
+            check_data(cur, conn)
+        print("All checks passed")
+    finally:
+        conn.rollback()
+        cur.execute("DROP SCHEMA IF EXISTS {} CASCADE".format(TEST_SCHEMA))
+        conn.commit()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import os
+import json
+import shutil
+import tempfile
+import psycopg2
+from datetime import datetime, timezone
+from staging import (LocalStaging, build_manifests, create_local_tables, load_staging, log_partition,
+                     manifest_key, pending_manifests, song_partition)
+
+# local Postgres loaded by LocalStaging, in a schema of its own
+DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+TEST_SCHEMA = 'dwh_staging_test'
+TEST_DSN = "{} options='-c search_path={}'".format(DSN, TEST_SCHEMA)
+
+# sample data of Project 1, laid out like the S3 prefixes
+DATA = os.path.join('..', '..', 'Data Modeling', 'Project 1 - Data Modeling with PostgreSQL', 'data')
+
+
+def source_records(prefix):
+    """
+    Returns the records of the JSON files under a directory of the sample data, read in Python.
+    """
+    records = []
+    for root, dirs, files in os.walk(os.path.join(DATA, prefix)):
+        for name in files:
+            if name.endswith('.json'):
+                with open(os.path.join(root, name), encoding='utf8') as f:
+                    records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def log_day(record):
+    """
+    Returns the date partition of a log record, i.e. the UTC day of its ts.
+    """
+    return datetime.fromtimestamp(record['ts'] / 1000, timezone.utc).strftime('%Y-%m-%d')
+
+
+class CopyCursor:
+    """
+    Cursor recording the COPY FROM STDIN of LocalStaging.copy, so that it runs without a database.
+    """
+
+    def __init__(self):
+        self.copies = []
+
+    def copy_expert(self, sql, file):
+        self.copies.append((sql, file.read()))
+
+
+def test_build_manifests():
+    logs = [('data/log_data/2018/11/2018-11-{:02d}-events.json'.format(day), 100 + day) for day in (1, 2, 15, 16)]
+    songs = [('data/song_data/A/A/B/TRAABJL12903CDCF1A.json', 300), ('data/song_data/B/A/A/TRBAAXT128F42A1ED5.json', 250),
+             ('data/song_data/A/B/C/TRABCEI128F424C983.json', 280), ('data/song_data/README.json', 10)]
+
+    manifests = build_manifests(logs, 'data/log_data', log_partition, '2018-11-02', '2018-11-15')
+    assert list(manifests) == ['2018-11-02', '2018-11-15']
+    assert manifests['2018-11-02'] == [('data/log_data/2018/11/2018-11-02-events.json', 102)]
+    assert list(build_manifests(logs, 'data/log_data', log_partition, '2018-11-16')) == ['2018-11-16']
+
+    # the song partitions are letters, which date bounds would drop: only the logs are bounded
+    manifests = build_manifests(songs, 'data/song_data', song_partition)
+    assert list(manifests) == ['A', 'B']
+    assert [key for key, size in manifests['A']] == ['data/song_data/A/A/B/TRAABJL12903CDCF1A.json',
+                                                     'data/song_data/A/B/C/TRABCEI128F424C983.json']
+
+
+def test_manifest_key():
+    files = [('song_data/A/A/B/TRAABJL12903CDCF1A.json', 300), ('song_data/A/B/C/TRABCEI128F424C983.json', 280)]
+    assert manifest_key(files) == manifest_key(files[::-1])
+    assert manifest_key(files) != manifest_key(files[:1])
+    assert manifest_key(files) != manifest_key([files[0], (files[1][0], 281)])
+
+
+def test_pending_manifests():
+    events = {'2018-11-01': [('2018-11-01-events.json', 100)], '2018-11-02': [('2018-11-02-events.json', 200)],
+              '2018-11-03': [('2018-11-03-events.json', 300)]}
+    loaded = {'2018-11-01': manifest_key(events['2018-11-01']), '2018-11-02': manifest_key([('2018-11-02-events.json', 150)])}
+    # a changed log day is loaded again on its own, with the new days
+    assert pending_manifests('staging_events', events, loaded) == (
+        {'2018-11-02': events['2018-11-02'], '2018-11-03': events['2018-11-03']}, ['2018-11-02'])
+
+    songs = {'A': [('A/A/B/TRAABJL12903CDCF1A.json', 300)], 'B': [('B/A/A/TRBAAXT128F42A1ED5.json', 250)]}
+    assert pending_manifests('staging_songs', songs, {'A': manifest_key(songs['A'])}) == ({'B': songs['B']}, [])
+    assert pending_manifests('staging_songs', songs, {p: manifest_key(f) for p, f in songs.items()}) == ({}, [])
+    # a new song file under a loaded letter: every song partition is loaded again
+    loaded = {'A': manifest_key(songs['A']), 'B': manifest_key(songs['B'])}
+    songs['A'] = songs['A'] + [('A/A/C/TRAACCG128F92E8A55.json', 270)]
+    assert pending_manifests('staging_songs', songs, loaded) == (songs, ['A'])
+    assert pending_manifests('staging_songs', {'A': songs['A']}, {'B': loaded['B']}) == ({'A': songs['A']}, ['B'])
+
+
+def test_local_staging():
+    with tempfile.TemporaryDirectory() as data, tempfile.TemporaryDirectory() as manifest_dir:
+        os.makedirs(os.path.join(data, 'log_data', '2018', '11'))
+        log_file = os.path.join(data, 'log_data', '2018', '11', '2018-11-01-events.json')
+        with open(log_file, 'w', encoding='utf8') as f:
+            f.write(json.dumps({'artist': None, 'auth': 'Logged In', 'firstName': 'Walter', 'gender': 'M',
+                                'itemInSession': 0, 'lastName': 'Frye', 'length': None, 'level': 'free',
+                                'location': 'San Francisco-Oakland-Hayward, CA', 'method': 'GET', 'page': 'Home',
+                                'registration': 1540919166796.0, 'sessionId': 38, 'song': None, 'status': 200,
+                                'ts': 1541105830796, 'userAgent': 'Mozilla/5.0', 'userId': '39'}) + '\n\n')
+            f.write(json.dumps({'artist': 'Des\'ree', 'auth': 'Logged In', 'firstName': 'Kaylee', 'gender': 'F',
+                                'itemInSession': 1, 'lastName': 'Summers', 'length': 246.30812, 'level': 'free',
+                                'location': 'Phoenix-Mesa-Scottsdale, AZ', 'method': 'PUT', 'page': 'NextSong',
+                                'registration': 1540344794796.0, 'sessionId': 139, 'song': 'You Gotta Be',
+                                'status': 200, 'ts': 1541106106796, 'userAgent': '', 'userId': '8'}) + '\n')
+
+        staging = LocalStaging(data, manifest_dir)
+        files = staging.list_files('s3://udacity-dend/log_data')
+        assert files == [(log_file, os.path.getsize(log_file))]
+
+        manifest = staging.write_manifest('staging_events', '2018-11-01', [log_file])
+        cur = CopyCursor()
+        num_files, rows, load_ms = staging.copy(cur, 'staging_events', manifest)
+        assert (num_files, rows) == (1, 2)
+
+        sql, text = cur.copies[0]
+        assert sql == 'COPY staging_events FROM STDIN'
+        first, second = [line.split('\t') for line in text.splitlines()]
+        assert len(first) == 18
+        # ts as a UTC TIMESTAMP, registration as BIGINT, missing values and empty strings as NULL
+        assert first[15] == '2018-11-01 20:57:10.796000'
+        assert first[11] == '1540919166796'
+        assert first[0] == first[6] == '\\N'
+        assert second[0] == "Des'ree" and second[16] == '\\N'
+
+
+def check_loads(cur, table, expected):
+    print("Checking: staging_loads partitions of {}".format(table))
+    # the rows of the last COPY of each partition
+    cur.execute("SELECT DISTINCT ON (partition_key) partition_key, rows_loaded FROM staging_loads "
+                "WHERE staging_table = %s ORDER BY partition_key, loaded_at DESC", (table,))
+    results = dict(cur.fetchall())
+    print(results, "\n")
+    assert results == expected, "{} loads differ from {}".format(table, expected)
+
+
+def check_staged(cur, table, expected_rows, expected_ts=None):
+    print("Checking: Table {} content".format(table))
+    cur.execute("SELECT COUNT(*), MIN(ts), MAX(ts) FROM {}".format(table) if expected_ts
+                else "SELECT COUNT(*) FROM {}".format(table))
+    results = cur.fetchone()
+    print(results, "\n")
+    assert results[0] == expected_rows, "{} should have {} rows".format(table, expected_rows)
+    if expected_ts:
+        assert results[1:] == expected_ts, "{} ts range differs from {}".format(table, expected_ts)
+
+
+def main():
+    """
+    Regression test of the offline staging load: loads a copy of the sample data through
+    LocalStaging into a local Postgres, first bounded to half of November 2018, then
+    incrementally, then again after a song file was added to a loaded partition, and compares
+    the staged rows and the staging_loads partitions with the files read in Python.
+    The log date bounds must leave the song partitions alone.
+    """
+    events = source_records('log_data')
+    songs = source_records('song_data')
+    days = {}
+    for record in events:
+        days[log_day(record)] = days.get(log_day(record), 0) + 1
+    first_half = {day: rows for day, rows in days.items() if day <= '2018-11-15'}
+    second_half = {day: rows for day, rows in days.items() if day > '2018-11-15'}
+
+    def ts_range(records):
+        ts = [datetime.fromtimestamp(record['ts'] / 1000, timezone.utc).replace(tzinfo=None) for record in records]
+        return min(ts), max(ts)
+
+    conn = psycopg2.connect(DSN)
+    # no transaction left open by the checks, which would block the TRUNCATE of the next load
+    conn.set_session(autocommit=True)
+    cur = conn.cursor()
+
+    try:
+        cur.execute("DROP SCHEMA IF EXISTS {} CASCADE".format(TEST_SCHEMA))
+        cur.execute("CREATE SCHEMA {}".format(TEST_SCHEMA))
+        cur.execute("SET search_path TO {}".format(TEST_SCHEMA))
+        create_local_tables(cur, conn)
+
+        with tempfile.TemporaryDirectory() as data, tempfile.TemporaryDirectory() as manifest_dir:
+            data = shutil.copytree(DATA, os.path.join(data, 'data'))
+            staging = LocalStaging(data, manifest_dir)
+
+            print("Run 1 of load_staging: log days 2018-11-01 to 2018-11-15\n")
+            load_staging(staging, TEST_DSN, True, '2018-11-01', '2018-11-15')
+            check_loads(cur, 'staging_events', first_half)
+            check_loads(cur, 'staging_songs', {'A': len(songs)})
+            check_staged(cur, 'staging_events', sum(first_half.values()),
+                         ts_range([record for record in events if log_day(record) in first_half]))
+            check_staged(cur, 'staging_songs', len(songs))
+
+            print("Run 2 of load_staging: incremental\n")
+            load_staging(staging, TEST_DSN, True)
+            check_loads(cur, 'staging_events', days)
+            check_loads(cur, 'staging_songs', {'A': len(songs)})
+            # staging_events only holds the new log days, the song partitions are already loaded
+            check_staged(cur, 'staging_events', sum(second_half.values()),
+                         ts_range([record for record in events if log_day(record) in second_half]))
+            check_staged(cur, 'staging_songs', len(songs))
+
+            print("Run 3 of load_staging: incremental, with a new song file under song_data/A\n")
+            new_song = dict(songs[0], song_id='SOTESTS12A8C13B9F0', title='Staging Test')
+            with open(os.path.join(data, 'song_data', 'A', 'TRTESTS128F92E8A55.json'), 'w', encoding='utf8') as f:
+                f.write(json.dumps(new_song))
+            load_staging(staging, TEST_DSN, True)
+            check_loads(cur, 'staging_events', days)
+            check_loads(cur, 'staging_songs', {'A': len(songs) + 1})
+            # staging_songs is loaded again in full rather than staging the old files twice
+            check_staged(cur, 'staging_events', 0)
+            check_staged(cur, 'staging_songs', len(songs) + 1)
+        print("All checks passed")
+    finally:
+        cur.execute("DROP SCHEMA IF EXISTS {} CASCADE".format(TEST_SCHEMA))
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
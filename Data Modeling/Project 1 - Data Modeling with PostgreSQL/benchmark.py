@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import resource
+import argparse
+import platform
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import psycopg2
+import etl
+import generate_data
+from metrics import set_metrics_hook
+from create_tables import drop_tables, create_tables
+from sql_queries import songs_count, artists_count, users_count, time_count, songplays_count
+
+# table -> (count query, stage loading it)
+BENCHMARK_TABLES = {
+    'songs': (songs_count, 'songs'),
+    'artists': (artists_count, 'songs'),
+    'time': (time_count, 'logs'),
+    'users': (users_count, 'logs'),
+    'songplays': (songplays_count, 'logs'),
+}
+
+# name -> etl.py options of each benchmarked mode
+BENCHMARK_MODES = {
+    'row': ['--mode', 'row'],
+    'bulk': ['--mode', 'bulk'],
+    'catalog': ['--mode', 'bulk', '--song-catalog'],
+    'parallel': ['--mode', 'bulk', '--workers', str(os.cpu_count() or 1)],
+}
+
+
+def peak_rss_kb():
+    """
+    Returns the peak resident set size in KB of this process and of its
+    (finished) worker processes.
+    Both are peaks over the lifetime of the process, hence run_mode runs in a
+    fresh process per mode, see run_mode_process.
+    """
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+def git_version():
+    """
+    Returns the short hash of the current commit, or None outside of a git checkout.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_mode(mode, data, dsn):
+    """
+    This function resets the tables of the sparkify database and runs the ETL end to end in one mode.
+
+    INPUTS:
+    * mode the name of a BENCHMARK_MODES entry
+    * data the data directory holding song_data and log_data
+    * dsn the connection string of the sparkify database
+
+    OUTPUT:
+    * dict with the per-stage latency, the rows and rows/sec per table, the peak RSS
+      and the phase metrics of the ETL, see metrics.py
+    """
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    drop_tables(cur, conn)
+    create_tables(cur, conn)
+
+    args = etl.parse_args(BENCHMARK_MODES[mode] + ['--data', data, '--dsn', dsn])
+
+    phases = []
+    set_metrics_hook(lambda record: phases.append(record) if record['event'] in ('phase', 'lookup') else None)
+
+    stages = {}
+    try:
+        for stage, func in [('songs', etl.load_songs), ('logs', etl.load_logs)]:
+            start = time.perf_counter()
+            func(cur, conn, args)
+            stages[stage] = time.perf_counter() - start
+    finally:
+        set_metrics_hook(None)
+
+    tables = {}
+    for table, (count_query, stage) in BENCHMARK_TABLES.items():
+        cur.execute(count_query)
+        rows = cur.fetchone()[0]
+        tables[table] = {
+            'rows': rows,
+            'rows_per_sec': rows / stages[stage] if stages[stage] > 0 else None,
+        }
+
+    conn.close()
+
+    return {
+        'mode': mode,
+        'stages_sec': stages,
+        'total_sec': sum(stages.values()),
+        'tables': tables,
+        'peak_rss_kb': peak_rss_kb(),
+        'metrics': phases,
+    }
+
+
+def run_mode_process(mode, data, dsn):
+    """
+    This function runs run_mode in a new process, started fresh rather than forked,
+    so that the peak RSS of each mode is its own and not the highest of the modes run before it.
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(run_mode, mode, data, dsn).result()
+
+
+def main():
+    """
+    Generates a synthetic dataset (unless --data is given), runs the ETL end to end
+    against the local Postgres in each requested mode, and appends one JSON line per mode
+    to the results file, so that runs of different versions can be compared.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the Sparkify PostgreSQL ETL')
+    parser.add_argument('--data', default=None,
+                        help='existing data directory, a synthetic one is generated if omitted')
+    parser.add_argument('--synthetic-output', default='benchmark_data',
+                        help='directory of the generated synthetic data')
+    parser.add_argument('--songs', type=int, default=10000, help='number of synthetic songs')
+    parser.add_argument('--users', type=int, default=100, help='number of synthetic users')
+    parser.add_argument('--days', type=int, default=30, help='number of synthetic days of logs')
+    parser.add_argument('--events-per-day', type=int, default=1000, help='number of synthetic events per day')
+    parser.add_argument('--modes', nargs='+', choices=list(BENCHMARK_MODES), default=['row', 'bulk'],
+                        help='ETL modes to benchmark')
+    parser.add_argument('--dsn', default=etl.DSN, help='connection string of the sparkify database')
+    parser.add_argument('--output', default='benchmark_results.jsonl', help='JSON lines results file')
+    args = parser.parse_args()
+
+    data = args.data
+    params = {'data': data}
+    if data is None:
+        data = args.synthetic_output
+        generate_data.main(['--output', data, '--songs', str(args.songs), '--users', str(args.users),
+                            '--days', str(args.days), '--events-per-day', str(args.events_per_day)])
+        params = {'data': data, 'songs': args.songs, 'users': args.users,
+                  'days': args.days, 'events_per_day': args.events_per_day}
+
+    for mode in args.modes:
+        result = run_mode_process(mode, data, args.dsn)
+        result.update({
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'version': git_version(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+            'params': params,
+        })
+
+        with open(args.output, 'a', encoding='utf8') as f:
+            f.write(json.dumps(result) + '\n')
+
+        print('{}: {:.2f} s'.format(mode, result['total_sec']))
+        for table, stats in result['tables'].items():
+            print('  {}: {} rows, {} rows/sec'.format(
+                table, stats['rows'],
+                '{:.0f}'.format(stats['rows_per_sec']) if stats['rows_per_sec'] else '-'))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,55 @@
 import os
-import glob
+import io
+import argparse
 import psycopg2
+import functools
+import multiprocessing
+import time
 import pandas as pd
+from psycopg2.pool import SimpleConnectionPool
 from sql_queries import *
+from song_lookup import build_song_lookup, resolve_songs
+from transforms import get_files, time_table_rows, latest_user_rows, song_file_rows, log_file_rows
+from manifest import pending_files, record_files
+from readers import read_batches, read_frames, read_song_catalog, SONG_FIELDS, LOG_FIELDS
+from metrics import (set_metrics_hook, json_lines_hook, emit, new_stats, count_rows,
+                     add_stats, timer, timed_iter, summary, print_stats)
 
+DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
 
-def process_song_file(cur, filepath):
+# number of files whose rows are loaded together in bulk mode
+BULK_BATCH_FILES = 100
+
+# number of attempts of a parallel batch, concurrent upserts may deadlock
+WORKER_LOAD_ATTEMPTS = 3
+
+
+def insert_row(cur, table, query, data, stats):
+    """
+    Inserts one row with error logging, counting it in stats as inserted,
+    conflicted (nothing inserted because of ON CONFLICT) or failed.
+
+    INPUTS:
+    * cur the cursor variable
+    * table the name of the table, for the error message and the stats
+    * query the insert query
+    * data the values of the row
+    * stats the stats to update, see metrics.py
+    """
+    # Adding error logging
+    try:
+        cur.execute(query, data)
+    except psycopg2.Error as e:
+        print("Error: Insert row for table {}".format(table))
+        print (e)
+        count_rows(stats, table, attempted=1, failed=1)
+        emit('error', table=table, message=str(e).strip())
+        return
+
+    count_rows(stats, table, attempted=1, inserted=cur.rowcount)
+
+
+def process_song_file(cur, filepath, stats=None):
     """
     This procedure processes a song file whose filepath has been provided as an arugment.
     It extracts the song information in order to store it into the songs table.
@@ -14,149 +58,669 @@ def process_song_file(cur, filepath):
     INPUTS: 
     * cur the cursor variable
     * filepath the file path to the song file
+    * stats the stats to update, see metrics.py
     """
+    stats = stats if stats is not None else new_stats()
     
-    # open song file
-    df = pd.read_json(filepath, lines=True)
+    # open song file, reading only the fields of SONG_FIELDS
+    for batch in timed_iter(read_batches(filepath, SONG_FIELDS), stats, 'read_sec'):
+        with timer(stats, 'load_sec'):
+            for row in batch:
+                # insert song record
+                song_data = list(row[:5])
+                insert_row(cur, 'songs', song_table_insert, song_data, stats)
 
-    # insert song record
-    for index, row in df.iterrows():
-        # insert song record
-        song_data = [row.song_id, row.title, row.artist_id, row.year, row.duration]
-        # Adding error logging
-        try:
-            cur.execute(song_table_insert, song_data)
-        except psycopg2.Error as e:
-            print("Error: Insert row for table songs")
-            print (e)
-    
-        # insert artist record
-        artist_data = [row.artist_id, row.artist_name, row.artist_location, row.artist_latitude, row.artist_longitude]
-        # Adding error logging
-        try:
-            cur.execute(artist_table_insert, artist_data)
-        except psycopg2.Error as e:
-            print("Error: Insert row for table artists")
-            print (e)
+                # insert artist record
+                artist_data = [row[2]] + list(row[5:])
+                insert_row(cur, 'artists', artist_table_insert, artist_data, stats)
 
 
-def process_log_file(cur, filepath):
+def process_log_file(cur, filepath, lookup=None, stats=None):
     """
     This procedure processes a log file whose filepath has been provided as an arugment.
     It extracts the time information in order to store it into the time table.
     Then it extracts the user information in order to store it into the users table.
     Finally it extracts joins what we extracted before in order to store it into the songplays table.
+    With a song lookup index, the song and artist IDs of the whole file are resolved
+    in one merge instead of one song_select query per event.
 
     INPUTS: 
     * cur the cursor variable
     * filepath the file path to the log file
+    * lookup the song lookup index (see song_lookup.py), None to query song_select per event
+    * stats the stats to update, see metrics.py
     """
+    stats = stats if stats is not None else new_stats()
     
-    # open log file
-    df = pd.read_json(filepath, lines=True)
+    # open log file, streaming the NextSong events in batches
+    for df in timed_iter(read_frames(filepath, LOG_FIELDS, page='NextSong'), stats, 'read_sec'):
+        process_log_batch(cur, df, lookup, stats)
 
-    # filter by NextSong action
-    df = df[df.page == 'NextSong']
 
-    # convert timestamp column to datetime
-    t = pd.to_datetime(df['ts'], unit='ms')
-    
-    # insert time data records
-    time_data = [df.ts, t.dt.hour, t.dt.day, t.dt.week, t.dt.month, t.dt.year, t.dt.weekday]
-    column_labels = ['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday']
-    time_df = pd.DataFrame(columns=column_labels) 
-    
-    for index, column_label in enumerate(column_labels):
-        time_df[column_label] = time_data[index]
+def process_log_batch(cur, df, lookup=None, stats=None):
+    """
+    This procedure inserts the time, users and songplays rows of a batch of NextSong events.
+
+    INPUTS:
+    * cur the cursor variable
+    * df DataFrame of NextSong events with the LOG_FIELDS columns
+    * lookup the song lookup index (see song_lookup.py), None to query song_select per event
+    * stats the stats to update, see metrics.py
+    """
+    stats = stats if stats is not None else new_stats()
+
+    with timer(stats, 'transform_sec'):
+        time_df = time_table_rows(df.ts)
+
+        # keep only the latest row of each user
+        user_df = latest_user_rows(df[['ts','userId','firstName','lastName','gender','level']])
+        user_df = user_df[['userId','firstName','lastName','gender','level']]
+
+        # get songid and artistid of the whole batch from the song lookup index
+        if lookup is not None:
+            song_ids = resolve_songs(df, lookup)
+            hits = int(song_ids.song_id.notna().sum())
+            stats['lookup_hits'] += hits
+            stats['lookup_misses'] += len(df) - hits
+
+    with timer(stats, 'load_sec'):
+        # insert time data records
+        for row in time_df.values.tolist():
+            insert_row(cur, 'time', time_table_insert, row, stats)
+
+        # insert user records
+        for i, row in user_df.iterrows():
+            insert_row(cur, 'users', user_table_insert, row, stats)
+
+        # insert songplay records
+        for index, row in df.iterrows():
+
+            if lookup is not None:
+                songid, artistid = song_ids.at[index, 'song_id'], song_ids.at[index, 'artist_id']
+            else:
+                # get songid and artistid from song and artist tables
+                # Adding error logging
+                try:
+                    cur.execute(song_select, (row.song, row.artist, row.length))
+                    results = cur.fetchone()
+                except psycopg2.Error as e:
+                    print("Error: Query for Song ID and Artist ID")
+                    print (e)
+                    emit('error', table='songs', message=str(e).strip())
+                    results = None
+
+                if results:
+                    songid, artistid = results
+                    stats['lookup_hits'] += 1
+                else:
+                    songid, artistid = None, None
+                    stats['lookup_misses'] += 1
+
+            # insert songplay record
+            songplay_data = [row.ts, row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent]
+            insert_row(cur, 'songplays', songplay_table_insert, songplay_data, stats)
+
+
+def copy_value(value):
+    """
+    Formats a single value for the COPY text format: NULL as \\N, and
+    backslash, tab, newline and carriage return escaped.
+    """
+    if value is None or (isinstance(value, float) and value != value):
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t') \
+                     .replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_rows(cur, table, columns, rows):
+    """
+    This procedure streams rows into a table with a single COPY FROM STDIN.
+
+    INPUTS:
+    * cur the cursor variable
+    * table the name of the table to copy into
+    * columns the list of column names, in the order of each row
+    * rows the list of rows to copy
+    """
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(copy_value(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+
+    cur.copy_expert(copy_from_stdin.format(table, ', '.join(columns)), buffer)
+
+
+def bulk_load(cur, conn, table_rows, files=None):
+    """
+    This procedure loads a batch of rows into the star schema.
+    The rows of each table are copied into a temporary staging table and then
+    merged into the final table with the same ON CONFLICT rules as the per-row inserts.
+    The user rows are first reduced to the latest row of each user, so that the users
+    merge is a single upsert per distinct user.
+    The batch is committed at the end, together with the manifest entries of its files,
+    or rolled back if any table fails.
+
+    INPUTS:
+    * cur the cursor variable
+    * conn the connection variable
+    * table_rows dict of table name to list of rows, as returned by song_file_rows/log_file_rows
+    * files the manifest entries of the files of the batch, see manifest.py
+
+    OUTPUT:
+    * dict of table name to [rows received, rows written] if the batch was committed,
+      None if it was rolled back
+    """
+    counts = {}
+    for table, (staging, columns, staging_create, merge) in bulk_load_tables.items():
+        rows = table_rows.get(table)
+        if not rows:
+            continue
+
+        received = len(rows)
+        if table == 'users':
+            rows = latest_user_rows(pd.DataFrame(rows, columns=columns)).values.tolist()
 
-    for i, row in time_df.iterrows():
         # Adding error logging
         try:
-            cur.execute(time_table_insert, list(row))
+            cur.execute(staging_create)
+            copy_rows(cur, staging, columns, rows)
+            cur.execute(merge)
         except psycopg2.Error as e:
-            print("Error: Insert row for table time")
-            print (e)
+            print("Error: Bulk load for table {}".format(table))
+            print(e)
+            conn.rollback()
+            return None
+
+        counts[table] = [received, cur.rowcount]
 
-    # load user table
-    user_df = df[['userId','firstName','lastName','gender','level']]
+    # Adding error logging
+    try:
+        record_files(cur, files)
+    except psycopg2.Error as e:
+        print("Error: Insert rows for table etl_manifest")
+        print(e)
+        conn.rollback()
+        return None
 
-    # insert user records
-    for i, row in user_df.iterrows():
+    conn.commit()
+    return counts
+
+
+def count_loaded(stats, table_rows, counts):
+    """
+    Counts the rows of a bulk_load batch in stats: every row is attempted, and
+    either the rows written are inserted if the batch was committed,
+    or all rows failed if it was rolled back.
+
+    INPUTS:
+    * stats the stats to update, see metrics.py
+    * table_rows the rows passed to bulk_load
+    * counts the counts returned by bulk_load
+    """
+    for table, rows in table_rows.items():
+        if not rows:
+            continue
+        if counts is None:
+            count_rows(stats, table, attempted=len(rows), failed=len(rows))
+        else:
+            count_rows(stats, table, attempted=len(rows), inserted=counts.get(table, [0, 0])[1])
+
+
+def load_deferred_tables(cur, conn, deferred, files):
+    """
+    This procedure loads the tables deferred over a whole run, and records the
+    files of the run in the manifest, in a single bulk batch and commit.
+    The timestamps collected across all log files are deduplicated in memory,
+    the ones already present in the time table are dropped, and only the new
+    ones are computed and written. The users rows are reduced to the latest row
+    of each user by bulk_load, whatever the order in which parallel workers
+    committed their chunks.
+    The files are only recorded once their deferred rows are committed too, so
+    that a failed or interrupted run processes them again on the next incremental run.
+
+    INPUTS:
+    * cur the cursor variable
+    * conn the connection variable
+    * deferred dict of deferred table name to the rows collected over the run:
+      start_time values for time, (ts, userId, firstName, lastName, gender, level) rows for users
+    * files the manifest entries of the files whose other rows are loaded
+    """
+    timestamps = set(deferred.get('time', ()))
+    new_timestamps = set()
+    if timestamps:
         # Adding error logging
         try:
-            cur.execute(user_table_insert, row)
+            cur.execute(time_select_range, (min(timestamps), max(timestamps)))
+            existing = {row[0] for row in cur.fetchall()}
         except psycopg2.Error as e:
-            print("Error: Insert row for table users")
-            print (e)
+            print("Error: Query for existing rows of table time")
+            print(e)
+            conn.rollback()
+            return
 
-    # insert songplay records
-    for index, row in df.iterrows():
-        
-        # get songid and artistid from song and artist tables
-        # Adding error logging
-        try:
-            cur.execute(song_select, (row.song, row.artist, row.length))
-            results = cur.fetchone()
-        
-            if results:
-                songid, artistid = results
-            else:
-                songid, artistid = None, None
+        new_timestamps = timestamps - existing
+        print('{} distinct timestamps collected, {} new'.format(len(timestamps), len(new_timestamps)))
+
+    stats = new_stats()
+    table_rows = {'users': list(deferred.get('users', ()))}
+    if new_timestamps:
+        with timer(stats, 'transform_sec'):
+            table_rows['time'] = time_table_rows(sorted(new_timestamps)).values.tolist()
+    if table_rows['users'] or new_timestamps or files:
+        with timer(stats, 'load_sec'):
+            counts = bulk_load(cur, conn, table_rows, files)
+        count_loaded(stats, table_rows, counts)
+        stats['files'] = len(files)
+
+    emit('phase', phase='deferred', collected=len(timestamps), new=len(new_timestamps), **summary(stats))
+    print_stats(stats)
+
+
+def list_files(cur, filepath, incremental):
+    """
+    This function returns the manifest entries of the JSON files under a directory
+    that have to be processed: the new or changed ones, or all of them if not incremental.
+
+    INPUTS:
+    * cur the cursor variable
+    * filepath the directory to walk
+    * incremental False to process every file
+    """
+    all_files = get_files(filepath)
+    entries = pending_files(cur, all_files, incremental)
+    print('{} files found in {}, {} to process'.format(len(all_files), filepath, len(entries)))
+
+    return entries
 
-            # insert songplay record
-            songplay_data = [row.ts, row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent]
-            # Adding error logging
-            try:
-                cur.execute(songplay_table_insert, songplay_data)
-            except psycopg2.Error as e:
-                print("Error: Insert row for table songplays")
-                print (e)
-        except psycopg2.Error as e:
-            print("Error: Query for Song ID and Artist ID")
-            print (e)
 
-            
-def process_data(cur, conn, filepath, func):
+def process_data(cur, conn, filepath, func, incremental=True):
     """
     This procedure processes a data (JSON) file whose filepath has been provided as an arugment.
+    Files already recorded in the manifest with the same content are skipped.
 
     INPUTS: 
     * cur the cursor variable
     * conn the connection variable
     * filepath the file path to the data file
     * func the function to call for each found file
+    * incremental False to process every file, even if already loaded
     """
     
-    # get all files matching extension from directory
-    all_files = []
-    for root, dirs, files in os.walk(filepath):
-        files = glob.glob(os.path.join(root,'*.json'))
-        for f in files :
-            all_files.append(os.path.abspath(f))
+    phase = os.path.basename(os.path.normpath(filepath))
+    total = new_stats()
 
-    # get total number of files found
-    num_files = len(all_files)
-    print('{} files found in {}'.format(num_files, filepath))
+    # get all new or changed files matching extension from directory
+    entries = list_files(cur, filepath, incremental)
+
+    # get total number of files to process
+    num_files = len(entries)
 
     # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
-        conn.commit()
+    for i, entry in enumerate(entries, 1):
+        stats = new_stats()
+        stats['files'] = 1
+        func(cur, entry[0], stats=stats)
+
+        with timer(stats, 'load_sec'):
+            # Adding error logging
+            try:
+                record_files(cur, [entry])
+            except psycopg2.Error as e:
+                print("Error: Insert row for table etl_manifest")
+                print(e)
+            conn.commit()
+
+        emit('file', phase=phase, path=entry[0], **summary(stats))
+        add_stats(total, stats)
         print('{}/{} files processed.'.format(i, num_files))
 
-        
+    emit('phase', phase=phase, **summary(total))
+    print_stats(total)
+
+
+def collect_rows(table_rows, deferred, file_rows, defer):
+    """
+    Adds the rows of one file to the rows of the current batch, or to the
+    run-level sets of the deferred tables.
+    """
+    for table, rows in file_rows.items():
+        if table in defer:
+            deferred.setdefault(table, set()).update(rows)
+        else:
+            table_rows.setdefault(table, []).extend(rows)
+
+
+def process_data_bulk(cur, conn, filepath, func, batch_files=BULK_BATCH_FILES, incremental=True, defer=()):
+    """
+    This procedure processes all data (JSON) files under a directory in batches.
+    The rows of `batch_files` files are accumulated and then loaded with bulk_load,
+    so that each table gets one COPY and one merge per batch instead of one insert per row.
+    Files already recorded in the manifest with the same content are skipped.
+    The rows of the `defer` tables are not loaded, but collected over the whole run
+    and returned, e.g. for load_deferred_tables. The files are then not recorded in
+    the manifest by their batch, but returned to be recorded with the deferred rows.
+
+    INPUTS:
+    * cur the cursor variable
+    * conn the connection variable
+    * filepath the file path to the data directory
+    * func the function returning the rows of one file (song_file_rows or log_file_rows)
+    * batch_files the number of files loaded per batch
+    * incremental False to process every file, even if already loaded
+    * defer the names of the tables whose rows are returned instead of loaded
+
+    OUTPUT:
+    * dict of deferred table name to the set of its rows over the run
+    * the manifest entries of the files of the committed batches, still to be
+      recorded if any table is deferred
+    """
+    phase = os.path.basename(os.path.normpath(filepath))
+    entries = list_files(cur, filepath, incremental)
+    num_files = len(entries)
+
+    table_rows = {}
+    deferred = {}
+    loaded = []
+    total = new_stats()
+    stats = new_stats()
+    batch = []
+    for i, entry in enumerate(entries, 1):
+        collect_rows(table_rows, deferred, func(entry[0], stats=stats), defer)
+        batch.append(entry)
+
+        if i % batch_files == 0 or i == num_files:
+            with timer(stats, 'load_sec'):
+                counts = bulk_load(cur, conn, table_rows, None if defer else batch)
+            count_loaded(stats, table_rows, counts)
+            stats['files'] = len(batch)
+            if counts is not None:
+                loaded.extend(batch)
+
+            emit('batch', phase=phase, **summary(stats))
+            add_stats(total, stats)
+            table_rows = {}
+            stats = new_stats()
+            batch = []
+            print('{}/{} files processed.'.format(i, num_files))
+
+    emit('phase', phase=phase, **summary(total))
+    print_stats(total)
+    return deferred, loaded
+
+
+def load_song_catalog(cur, conn, filepath, incremental=True):
+    """
+    This procedure loads the whole song catalog under a directory in one go.
+    The files are discovered with one recursive scan, read with plain buffered I/O,
+    and all their records are loaded with a single bulk_load and a single commit.
+    It prints the files/sec and records/sec of the load.
+
+    INPUTS:
+    * cur the cursor variable
+    * conn the connection variable
+    * filepath the file path to the song data directory
+    * incremental False to process every file, even if already loaded
+    """
+    start = time.perf_counter()
+    stats = new_stats()
+
+    entries = list_files(cur, filepath, incremental)
+    with timer(stats, 'read_sec'):
+        records = read_song_catalog([entry[0] for entry in entries])
+
+    with timer(stats, 'transform_sec'):
+        table_rows = {
+            'songs': [record[:5] for record in records],
+            'artists': [(record[2],) + record[5:] for record in records],
+        }
+    with timer(stats, 'load_sec'):
+        counts = bulk_load(cur, conn, table_rows, entries)
+    count_loaded(stats, table_rows, counts)
+    stats['files'] = len(entries)
+
+    elapsed = time.perf_counter() - start
+    emit('phase', phase=os.path.basename(os.path.normpath(filepath)), seconds=round(elapsed, 6),
+         **summary(stats))
+    print_stats(stats)
+    if entries and elapsed > 0:
+        print('{:.1f} files/sec, {:.1f} records/sec'.format(len(entries) / elapsed, len(records) / elapsed))
+
+
+# connection pool, row function and deferred tables of a worker process, set by init_worker
+worker_pool = None
+worker_func = None
+worker_defer = ()
+
+
+def init_worker(dsn, func, defer=()):
+    """
+    Initializes a worker process of process_data_parallel with its own
+    single-connection psycopg2 pool, the function returning the rows of one file
+    and the tables whose rows are returned to the parent instead of loaded.
+    """
+    global worker_pool, worker_func, worker_defer
+    worker_pool = SimpleConnectionPool(1, 1, dsn)
+    worker_func = func
+    worker_defer = defer
+
+
+def load_files_worker(files):
+    """
+    This function runs in a worker process and loads one chunk of files with bulk_load
+    on the worker's own connection, committing the chunk as one batch.
+    The files are recorded in the manifest with the chunk, unless tables are deferred.
+
+    INPUTS:
+    * files the manifest entries of the files of the chunk
+
+    OUTPUT:
+    * the number of files of the chunk
+    * the manifest entries of the chunk if it was committed, else an empty list
+    * dict of deferred table name to the set of its rows in the chunk
+    * the stats of the chunk, see metrics.py
+    """
+    table_rows = {}
+    deferred = {}
+    stats = new_stats()
+    for entry in files:
+        collect_rows(table_rows, deferred, worker_func(entry[0], stats=stats), worker_defer)
+
+    counts = None
+    conn = worker_pool.getconn()
+    try:
+        cur = conn.cursor()
+        with timer(stats, 'load_sec'):
+            for attempt in range(WORKER_LOAD_ATTEMPTS):
+                counts = bulk_load(cur, conn, table_rows, None if worker_defer else files)
+                if counts is not None:
+                    break
+        cur.close()
+    finally:
+        worker_pool.putconn(conn)
+
+    count_loaded(stats, table_rows, counts)
+    stats['files'] = len(files)
+    return len(files), files if counts is not None else [], deferred, stats
+
+
+def process_data_parallel(cur, filepath, func, dsn=DSN, workers=None,
+                          batch_files=BULK_BATCH_FILES, incremental=True, defer=()):
+    """
+    This procedure processes all data (JSON) files under a directory with a pool of worker processes.
+    The discovered files are split into chunks of `batch_files` files, and each worker
+    reads, batches and commits its chunks on its own pooled connection.
+    It returns once every file is loaded, so that song files are all loaded before log files start.
+    Files already recorded in the manifest with the same content are skipped.
+    The rows of the `defer` tables are collected over the whole run and returned,
+    together with the files to record in the manifest once they are loaded.
+
+    INPUTS:
+    * cur the cursor variable, used to read the manifest
+    * filepath the file path to the data directory
+    * func the function returning the rows of one file (song_file_rows or log_file_rows)
+    * dsn the connection string used by each worker
+    * workers the number of worker processes, defaults to the number of cores
+    * batch_files the number of files per chunk
+    * incremental False to process every file, even if already loaded
+    * defer the names of the tables whose rows are returned instead of loaded
+
+    OUTPUT:
+    * dict of deferred table name to the set of its rows over the run
+    * the manifest entries of the files of the committed chunks, still to be
+      recorded if any table is deferred
+    """
+    phase = os.path.basename(os.path.normpath(filepath))
+    entries = list_files(cur, filepath, incremental)
+    num_files = len(entries)
+
+    chunks = [entries[i:i + batch_files] for i in range(0, num_files, batch_files)]
+    workers = workers or multiprocessing.cpu_count()
+
+    start = time.perf_counter()
+    done = 0
+    deferred = {}
+    loaded = []
+    total = new_stats()
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(dsn, func, defer)) as pool:
+        for num_chunk, chunk_loaded, chunk_deferred, stats in pool.imap_unordered(load_files_worker, chunks):
+            done += num_chunk
+            loaded.extend(chunk_loaded)
+            emit('batch', phase=phase, **summary(stats))
+            add_stats(total, stats)
+            for table, rows in chunk_deferred.items():
+                deferred.setdefault(table, set()).update(rows)
+            print('{}/{} files processed.'.format(done, num_files))
+
+    elapsed = time.perf_counter() - start
+    emit('phase', phase=phase, seconds=round(elapsed, 6), workers=workers, **summary(total))
+    # read/transform/load times are summed over the workers
+    print_stats(total)
+    if num_files and elapsed > 0:
+        print('{:.1f} files/sec with {} workers'.format(num_files / elapsed, workers))
+
+    return deferred, loaded
+
+
+def parse_args(argv=None):
+    """
+    Parses the command line options of the ETL.
+
+    INPUTS:
+    * argv the list of arguments, defaults to sys.argv
+    """
+    parser = argparse.ArgumentParser(description='Load the Sparkify JSON data into PostgreSQL')
+    parser.add_argument('--mode', choices=['bulk', 'row'], default='bulk',
+                        help='bulk: COPY into staging tables and merge, row: one INSERT per row')
+    parser.add_argument('--batch-files', type=int, default=BULK_BATCH_FILES,
+                        help='number of files loaded per COPY batch in bulk mode')
+    parser.add_argument('--no-song-lookup', dest='song_lookup', action='store_false',
+                        help='row mode only: query song_select per event instead of the in-memory song lookup')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='bulk mode only: number of worker processes, 0 to load on a single connection')
+    parser.add_argument('--song-catalog', action='store_true',
+                        help='bulk mode only: load all song files with a single batch and commit')
+    parser.add_argument('--full-reload', dest='incremental', action='store_false',
+                        help='process every file, even the ones already recorded in the manifest')
+    parser.add_argument('--data', default='data',
+                        help='directory holding the song_data and log_data directories')
+    parser.add_argument('--dsn', default=DSN,
+                        help='connection string of the sparkify database')
+    parser.add_argument('--metrics', default=None,
+                        help='file to append the per-stage metrics to as JSON lines, - for stdout')
+
+    return parser.parse_args(argv)
+
+
+def load_songs(cur, conn, args):
+    """
+    This procedure loads the song_data files into the songs and artists tables,
+    with the mode selected by the command line options.
+
+    INPUTS:
+    * cur the cursor variable
+    * conn the connection variable
+    * args the options returned by parse_args
+    """
+    filepath = os.path.join(args.data, 'song_data')
+
+    if args.mode == 'bulk' and args.workers:
+        process_data_parallel(cur, filepath=filepath, func=song_file_rows, dsn=args.dsn,
+                              workers=args.workers, batch_files=args.batch_files,
+                              incremental=args.incremental)
+    elif args.mode == 'bulk' and args.song_catalog:
+        load_song_catalog(cur, conn, filepath=filepath, incremental=args.incremental)
+    elif args.mode == 'bulk':
+        process_data_bulk(cur, conn, filepath=filepath, func=song_file_rows,
+                          batch_files=args.batch_files, incremental=args.incremental)
+    else:
+        process_data(cur, conn, filepath=filepath, func=process_song_file,
+                     incremental=args.incremental)
+
+
+def timed_song_lookup(cur):
+    """
+    Builds the song lookup index from the database and emits its size and build time.
+    """
+    start = time.perf_counter()
+    lookup = build_song_lookup(cur)
+    emit('lookup', rows=len(lookup), seconds=round(time.perf_counter() - start, 6))
+
+    return lookup
+
+
+def load_logs(cur, conn, args):
+    """
+    This procedure loads the log_data files into the time, users and songplays tables,
+    with the mode selected by the command line options.
+    The songs must be loaded first, since the song lookup index is built from them.
+
+    INPUTS:
+    * cur the cursor variable
+    * conn the connection variable
+    * args the options returned by parse_args
+    """
+    filepath = os.path.join(args.data, 'log_data')
+
+    if args.mode == 'bulk':
+        lookup = timed_song_lookup(cur)
+        func = functools.partial(log_file_rows, lookup=lookup)
+        if args.workers:
+            # the workers commit in any order: users are upserted once by the parent,
+            # with the latest row of each user over the run
+            deferred, files = process_data_parallel(cur, filepath=filepath, func=func, dsn=args.dsn,
+                                                    workers=args.workers, batch_files=args.batch_files,
+                                                    incremental=args.incremental, defer=('time', 'users'))
+        else:
+            deferred, files = process_data_bulk(cur, conn, filepath=filepath, func=func,
+                                                batch_files=args.batch_files, incremental=args.incremental,
+                                                defer=('time',))
+        # the log files are recorded in the manifest together with their time rows
+        load_deferred_tables(cur, conn, deferred, files)
+    else:
+        lookup = timed_song_lookup(cur) if args.song_lookup else None
+        process_data(cur, conn, filepath=filepath,
+                     func=functools.partial(process_log_file, lookup=lookup),
+                     incremental=args.incremental)
+
+
 def main():
     """
     This is the main script execution.
     
     First, it creates a database connection.
-    Then, it processes both Song and Log information.
+    Then, it processes both Song and Log information,
+    either in bulk (default) or row by row with `--mode row`.
+    With `--workers`, the bulk load runs on a pool of worker processes.
     Finally, it closes the cursor and database connection.
     """
+    args = parse_args()
+    if args.metrics:
+        set_metrics_hook(json_lines_hook(args.metrics))
     
     # Adding error logging
     try:
-        conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+        conn = psycopg2.connect(args.dsn)
     except psycopg2.Error as e:
         print("Error: Could not make connection to the Postgres database")
         print(e)
@@ -168,8 +732,8 @@ def main():
         print("Error: Could not get curser to the Database")
         print(e)
 
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    load_songs(cur, conn, args)
+    load_logs(cur, conn, args)
 
     conn.close()
 
@@ -0,0 +1,171 @@
+import os
+import json
+import random
+import string
+import argparse
+from datetime import datetime, timedelta, timezone
+
+FIRST_NAMES = ['Walter', 'Kaylee', 'Lily', 'Jacob', 'Tegan', 'Chloe', 'Aleena', 'Mohammad', 'Ryan', 'Jayden']
+LAST_NAMES = ['Frye', 'Summers', 'Koch', 'Klein', 'Levine', 'Cuevas', 'Kirby', 'Rodriguez', 'Smith', 'Lee']
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA', 'Phoenix-Mesa-Scottsdale, AZ',
+             'Chicago-Naperville-Elgin, IL-IN-WI', 'Portland-South Portland, ME',
+             'Atlanta-Sandy Springs-Roswell, GA', 'Lansing-East Lansing, MI']
+USER_AGENTS = ['"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+               '"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.153 Safari/537.36"',
+               'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:31.0) Gecko/20100101 Firefox/31.0']
+ARTIST_LOCATIONS = ['California - LA', 'New York, NY', 'London, England', 'Hamilton, Ohio', '']
+OTHER_PAGES = ['Home', 'Logout', 'Settings', 'Help', 'Downgrade', 'Upgrade']
+
+
+def random_id(rng, prefix, length=16):
+    """
+    Returns a Million Song Dataset style ID, e.g. SOMZWCG12A8C13C480.
+    """
+    return prefix + ''.join(rng.choice(string.ascii_uppercase + string.digits) for _ in range(length))
+
+
+def generate_songs(rng, output, num_songs, num_artists):
+    """
+    This function writes `num_songs` song files under output/song_data, one record per file,
+    laid out like the sample data: song_data/A/B/C/TRABC....json.
+
+    INPUTS:
+    * rng the random generator
+    * output the output data directory
+    * num_songs the number of songs
+    * num_artists the number of distinct artists
+
+    OUTPUT:
+    * list of (title, artist_name, duration) of the generated songs, used by the log events
+    """
+    artists = []
+    for i in range(num_artists):
+        located = rng.random() < 0.4
+        artists.append({
+            'artist_id': random_id(rng, 'AR'),
+            'artist_latitude': round(rng.uniform(-60, 60), 5) if located else None,
+            'artist_longitude': round(rng.uniform(-150, 150), 5) if located else None,
+            'artist_location': rng.choice(ARTIST_LOCATIONS),
+            'artist_name': 'Artist {}'.format(i),
+        })
+
+    catalog = []
+    for i in range(num_songs):
+        track_id = 'TR' + ''.join(rng.choice('ABC') for _ in range(3)) + random_id(rng, '', 13)
+        directory = os.path.join(output, 'song_data', track_id[2], track_id[3], track_id[4])
+        os.makedirs(directory, exist_ok=True)
+
+        artist = rng.choice(artists)
+        record = {'num_songs': 1}
+        record.update(artist)
+        record.update({
+            'song_id': random_id(rng, 'SO'),
+            'title': 'Song {}'.format(i),
+            'duration': round(rng.uniform(60, 600), 5),
+            'year': rng.choice([0, rng.randint(1960, 2018)]),
+        })
+
+        with open(os.path.join(directory, track_id + '.json'), 'w', encoding='utf8') as f:
+            json.dump(record, f)
+        catalog.append((record['title'], record['artist_name'], record['duration']))
+
+    return catalog
+
+
+def generate_logs(rng, output, catalog, num_users, num_days, events_per_day, start_date, hit_rate):
+    """
+    This procedure writes one log file per day under output/log_data,
+    laid out like the sample data: log_data/2018/11/2018-11-01-events.json.
+    About 80% of the events are NextSong plays; `hit_rate` of them are songs of the catalog,
+    the others are unknown songs, as in the sample data.
+
+    INPUTS:
+    * rng the random generator
+    * output the output data directory
+    * catalog the list of (title, artist_name, duration) returned by generate_songs
+    * num_users the number of distinct users
+    * num_days the number of days, i.e. of log files
+    * events_per_day the number of events per log file
+    * start_date the date of the first log file
+    * hit_rate the share of NextSong events that match a song of the catalog
+    """
+    users = [{
+        'userId': str(user_id),
+        'firstName': rng.choice(FIRST_NAMES),
+        'lastName': rng.choice(LAST_NAMES),
+        'gender': rng.choice('MF'),
+        'level': rng.choice(['free', 'paid']),
+        'location': rng.choice(LOCATIONS),
+        'userAgent': rng.choice(USER_AGENTS),
+        'registration': float(rng.randint(1538000000000, 1541000000000)),
+    } for user_id in range(1, num_users + 1)]
+
+    session_id = 0
+    for day in range(num_days):
+        date = start_date + timedelta(days=day)
+        directory = os.path.join(output, 'log_data', '{:%Y}'.format(date), '{:%m}'.format(date))
+        os.makedirs(directory, exist_ok=True)
+
+        day_start = int(date.replace(tzinfo=timezone.utc).timestamp() * 1000)
+        timestamps = sorted(day_start + rng.randrange(86400000) for _ in range(events_per_day))
+
+        sessions = {}
+        with open(os.path.join(directory, '{:%Y-%m-%d}-events.json'.format(date)), 'w', encoding='utf8') as f:
+            for ts in timestamps:
+                user = rng.choice(users)
+                if user['userId'] not in sessions or rng.random() < 0.05:
+                    session_id += 1
+                    sessions[user['userId']] = [session_id, 0]
+                    if rng.random() < 0.1:
+                        user['level'] = 'paid' if user['level'] == 'free' else 'free'
+                session = sessions[user['userId']]
+
+                artist, song, length, page = None, None, None, rng.choice(OTHER_PAGES)
+                if rng.random() < 0.8:
+                    page = 'NextSong'
+                    if rng.random() < hit_rate:
+                        song, artist, length = rng.choice(catalog)
+                    else:
+                        song, artist, length = 'Unknown Song', 'Unknown Artist', round(rng.uniform(60, 600), 5)
+
+                event = {
+                    'artist': artist, 'auth': 'Logged In', 'firstName': user['firstName'],
+                    'gender': user['gender'], 'itemInSession': session[1], 'lastName': user['lastName'],
+                    'length': length, 'level': user['level'], 'location': user['location'],
+                    'method': 'PUT' if page == 'NextSong' else 'GET', 'page': page,
+                    'registration': user['registration'], 'sessionId': session[0], 'song': song,
+                    'status': 200, 'ts': ts, 'userAgent': user['userAgent'], 'userId': user['userId'],
+                }
+                session[1] += 1
+                f.write(json.dumps(event, separators=(',', ':')) + '\n')
+
+
+def main(argv=None):
+    """
+    Generates a synthetic Sparkify dataset with the layout and schema of the sample data,
+    scaled to the given number of songs, users and days.
+    """
+    parser = argparse.ArgumentParser(description='Generate synthetic Sparkify song_data and log_data')
+    parser.add_argument('--output', default='synthetic_data', help='output data directory')
+    parser.add_argument('--songs', type=int, default=10000, help='number of songs (one file each)')
+    parser.add_argument('--artists', type=int, default=None, help='number of artists, defaults to songs / 2')
+    parser.add_argument('--users', type=int, default=100, help='number of users')
+    parser.add_argument('--days', type=int, default=30, help='number of days (one log file each)')
+    parser.add_argument('--events-per-day', type=int, default=1000, help='number of events per log file')
+    parser.add_argument('--start-date', default='2018-11-01', help='date of the first log file')
+    parser.add_argument('--hit-rate', type=float, default=0.5,
+                        help='share of NextSong events that match a song of the catalog')
+    parser.add_argument('--seed', type=int, default=42, help='random seed')
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    catalog = generate_songs(rng, args.output, args.songs, args.artists or max(1, args.songs // 2))
+    generate_logs(rng, args.output, catalog, args.users, args.days, args.events_per_day,
+                  datetime.strptime(args.start_date, '%Y-%m-%d'), args.hit_rate)
+
+    print('{} songs, {} users and {} days of logs generated in {}'.format(
+        args.songs, args.users, args.days, args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+import os
+import time
+import shutil
+import argparse
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pandas as pd
+
+from transforms import get_files, log_file_rows, time_table_rows
+from readers import read_song_catalog, SONG_FIELDS
+from song_lookup import make_song_lookup, LOOKUP_COLUMNS
+from metrics import (set_metrics_hook, json_lines_hook, emit, new_stats, count_rows,
+                     add_stats, timer, summary, print_stats)
+
+# number of song files read per task
+SONG_CHUNK_FILES = 500
+# maximum number of rows per Parquet file and per row group
+MAX_ROWS_PER_FILE = 500000
+MAX_ROWS_PER_GROUP = 100000
+
+# Arrow schema of each table: the columns of sql_queries.py, plus the
+# year and month partition columns of songplays
+TABLE_SCHEMAS = {
+    'songs': pa.schema([('song_id', pa.string()), ('title', pa.string()),
+                        ('artist_id', pa.string()), ('year', pa.int32()),
+                        ('duration', pa.float64())]),
+    'artists': pa.schema([('artist_id', pa.string()), ('name', pa.string()),
+                          ('location', pa.string()), ('latitude', pa.float64()),
+                          ('longitude', pa.float64())]),
+    'users': pa.schema([('user_id', pa.int32()), ('first_name', pa.string()),
+                        ('last_name', pa.string()), ('gender', pa.string()),
+                        ('level', pa.string())]),
+    'time': pa.schema([('start_time', pa.int64()), ('hour', pa.int32()), ('day', pa.int32()),
+                       ('week', pa.int32()), ('month', pa.int32()), ('year', pa.int32()),
+                       ('weekday', pa.int32())]),
+    'songplays': pa.schema([('songplay_id', pa.int64()), ('start_time', pa.int64()),
+                            ('user_id', pa.int32()), ('level', pa.string()),
+                            ('song_id', pa.string()), ('artist_id', pa.string()),
+                            ('session_id', pa.int32()), ('location', pa.string()),
+                            ('user_agent', pa.string()), ('year', pa.int32()),
+                            ('month', pa.int32())]),
+}
+
+# users rows of the log events, with the ts of their event
+USER_EVENTS_SCHEMA = pa.schema([('ts', pa.int64())] + list(zip(TABLE_SCHEMAS['users'].names,
+                                                               TABLE_SCHEMAS['users'].types)))
+
+# partition columns of each table, as in TABLE_LAYOUTS of Spark and Data Lakes/layout.py
+TABLE_PARTITIONS = {'songs': ['year'], 'artists': [], 'users': [],
+                    'time': ['year', 'month'], 'songplays': ['year', 'month']}
+
+
+def ordered_map(executor, func, items, window):
+    """
+    This generator yields func(item) for every item, in the order of items, while
+    at most `window` calls are pending, so that only a few results are held in memory.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def song_chunk_batches(filepaths):
+    """
+    This function reads a chunk of song files with read_song_catalog and returns
+    its songs and artists rows as Arrow record batches.
+
+    INPUTS:
+    * filepaths the list of song file paths
+
+    OUTPUT:
+    * (songs batch, artists batch, lookup DataFrame) of the chunk
+    """
+    columns = list(zip(*read_song_catalog(filepaths))) or [()] * len(SONG_FIELDS)
+    fields = dict(zip(SONG_FIELDS, columns))
+
+    songs = pa.RecordBatch.from_arrays(
+        [pa.array(fields[f], type=t) for f, t in zip(['song_id', 'title', 'artist_id', 'year', 'duration'],
+                                                     TABLE_SCHEMAS['songs'].types)],
+        schema=TABLE_SCHEMAS['songs'])
+    artists = pa.RecordBatch.from_arrays(
+        [pa.array(fields[f], type=t) for f, t in zip(['artist_id', 'artist_name', 'artist_location',
+                                                      'artist_latitude', 'artist_longitude'],
+                                                     TABLE_SCHEMAS['artists'].types)],
+        schema=TABLE_SCHEMAS['artists'])
+    lookup = pd.DataFrame({'title': fields['title'], 'artist_name': fields['artist_name'],
+                           'duration': fields['duration'], 'song_id': fields['song_id'],
+                           'artist_id': fields['artist_id']})
+
+    return songs, artists, lookup
+
+
+def log_file_batches(filepath, lookup):
+    """
+    This function parses a log file with log_file_rows of transforms.py and returns
+    the rows it contributes as Arrow record batches.
+
+    INPUTS:
+    * filepath the file path to the log file
+    * lookup the song lookup index (see song_lookup.py)
+
+    OUTPUT:
+    * (dict of table name to record batch, stats of the file)
+    """
+    stats = new_stats()
+    table_rows = log_file_rows(filepath, lookup, stats)
+
+    with timer(stats, 'transform_sec'):
+        # users rows are (ts, userId, first_name, last_name, gender, level),
+        # ts is kept to pick the level of the latest event
+        users = list(zip(*table_rows['users'])) or [()] * 6
+        users = pa.RecordBatch.from_arrays(
+            [pa.array(users[0], type=pa.int64()), pc.cast(pa.array(users[1]), pa.int32())] +
+            [pa.array(column, type=pa.string()) for column in users[2:]],
+            schema=USER_EVENTS_SCHEMA)
+
+        # songplays rows are (ts, userId, level, song_id, artist_id, sessionId, location, userAgent)
+        songplays = list(zip(*table_rows['songplays'])) or [()] * 8
+        start_time = pa.array(songplays[0], type=pa.int64())
+        timestamps = pc.cast(start_time, pa.timestamp('ms'))
+        songplays = pa.RecordBatch.from_arrays(
+            [start_time, pc.cast(pa.array(songplays[1]), pa.int32())] +
+            [pa.array(column, type=pa.string()) for column in songplays[2:5]] +
+            [pa.array(songplays[5], type=pa.int32())] +
+            [pa.array(column, type=pa.string()) for column in songplays[6:]] +
+            [pc.cast(pc.year(timestamps), pa.int32()), pc.cast(pc.month(timestamps), pa.int32())],
+            schema=TABLE_SCHEMAS['songplays'].remove(0))
+
+    return {'time': table_rows['time'], 'users': users, 'songplays': songplays}, stats
+
+
+def keep_last(table, keys, sort_by=None):
+    """
+    This function drops the duplicates of keys from an Arrow table, keeping the last row
+    of each key in the order of sort_by (a stable sort), or in table order.
+    """
+    if sort_by:
+        table = table.sort_by([(sort_by, 'ascending')])
+    table = table.append_column('_row', pa.array(np.arange(len(table), dtype='int64')))
+    rows = table.group_by(keys, use_threads=False).aggregate([('_row', 'max')])['_row_max']
+
+    return table.take(pc.take(rows, pc.sort_indices(rows))).drop_columns(['_row'])
+
+
+def build_song_tables(filepaths, workers):
+    """
+    This function reads the song files on a pool of threads and builds the songs and
+    artists tables, one row per song_id and per artist_id, and the song lookup index.
+
+    OUTPUT:
+    * (dict of table name to Arrow table, song lookup index, stats)
+    """
+    stats = new_stats()
+    chunks = [filepaths[i:i + SONG_CHUNK_FILES] for i in range(0, len(filepaths), SONG_CHUNK_FILES)]
+
+    songs, artists, lookups = [], [], []
+    with timer(stats, 'read_sec'), ThreadPoolExecutor(workers) as executor:
+        for song_batch, artist_batch, lookup in ordered_map(executor, song_chunk_batches,
+                                                            chunks, 2 * workers):
+            songs.append(song_batch)
+            artists.append(artist_batch)
+            lookups.append(lookup)
+    stats['files'] = len(filepaths)
+
+    with timer(stats, 'transform_sec'):
+        tables = {'songs': keep_last(pa.Table.from_batches(songs, TABLE_SCHEMAS['songs']), ['song_id']),
+                  'artists': keep_last(pa.Table.from_batches(artists, TABLE_SCHEMAS['artists']),
+                                       ['artist_id'])}
+        lookup = make_song_lookup(pd.concat(lookups, ignore_index=True) if lookups
+                                  else pd.DataFrame(columns=LOOKUP_COLUMNS))
+
+    return tables, lookup, stats
+
+
+def songplay_batches(filepaths, lookup, workers, stats, users, timestamps):
+    """
+    This generator parses the log files on a pool of threads and yields the songplays
+    record batch of each file as it completes, so that songplays is written while the
+    files are parsed. The users batches and the timestamps of the time table are
+    appended to users and timestamps, for build_log_tables once every file is parsed.
+    """
+    songplay_id = 0
+    with ThreadPoolExecutor(workers) as executor:
+        func = functools.partial(log_file_batches, lookup=lookup)
+        for batches, file_stats in ordered_map(executor, func, filepaths, 2 * workers):
+            timestamps.extend(batches['time'])
+            users.append(batches['users'])
+            add_stats(stats, file_stats)
+            stats['files'] += 1
+
+            # songplay_id numbers the song plays in file order, like the serial of sql_queries.py
+            songplays = batches['songplays']
+            yield songplays.add_column(0, 'songplay_id', pa.array(range(songplay_id, songplay_id + len(songplays)),
+                                                                  type=pa.int64()))
+            songplay_id += len(songplays)
+
+
+def build_log_tables(users, timestamps, stats):
+    """
+    This function builds the users (latest level of each user) and time (one row per
+    start_time) tables from the rows collected by songplay_batches.
+
+    OUTPUT:
+    * dict of table name to Arrow table
+    """
+    with timer(stats, 'transform_sec'):
+        users = keep_last(pa.Table.from_batches(users, USER_EVENTS_SCHEMA), ['user_id'], sort_by='ts') \
+                  .drop_columns(['ts'])
+        time_table = pa.Table.from_pandas(time_table_rows(timestamps), preserve_index=False) \
+                       .cast(TABLE_SCHEMAS['time'])
+
+    return {'users': users, 'time': time_table}
+
+
+def write_table(batches, schema, path, partitions, max_rows_per_file=MAX_ROWS_PER_FILE):
+    """
+    This function streams record batches to Parquet files under path, replacing the files
+    already there, with one hive-style directory per value of the partition columns
+    (e.g. year=2018/month=11), like the DataFrameWriter.partitionBy of the Spark ETL.
+    The files are encoded and written on the threads of Arrow, which must not call back
+    into Python: the files written are listed once the write is over.
+
+    INPUTS:
+    * batches iterable of the record batches of the table, e.g. a generator or Table.to_batches()
+    * schema the Arrow schema of the batches
+    * path the directory of the table
+    * partitions the partition columns of the table
+
+    OUTPUT:
+    * (rows, number of files, total bytes) written
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
+    rows = 0
+
+    def counted(batches):
+        nonlocal rows
+        for batch in batches:
+            rows += batch.num_rows
+            yield batch
+
+    reader = pa.RecordBatchReader.from_batches(schema, counted(batches))
+    ds.write_dataset(reader, path, format='parquet',
+                     partitioning=partitions or None, partitioning_flavor='hive' if partitions else None,
+                     basename_template='part-{i}.parquet', use_threads=True,
+                     max_rows_per_file=max_rows_per_file,
+                     max_rows_per_group=min(MAX_ROWS_PER_GROUP, max_rows_per_file))
+    # the reader holds the last batches the writer pulled: they are released here, on this thread
+    reader.close()
+
+    written = [entry.stat().st_size for entry in scan_files(path)]
+    return rows, len(written), sum(written)
+
+
+def scan_files(path):
+    """
+    This generator yields the os.DirEntry of every file under a directory.
+    """
+    directories = [path]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                else:
+                    yield entry
+
+
+def load_table(total, name, batches, output):
+    """
+    This function writes the batches of a table with write_table and counts its rows.
+    """
+    with timer(total, 'load_sec'):
+        rows, files, size = write_table(batches, TABLE_SCHEMAS[name], os.path.join(output, name, name + '.parquet'),
+                                        TABLE_PARTITIONS[name])
+    count_rows(total, name, attempted=rows, inserted=rows)
+    print('{}: {} rows, {} files, {:.1f} MB'.format(name, rows, files, size / 1024 ** 2))
+
+
+def build_lake(data, output, workers):
+    """
+    This function builds the five tables of the star schema from the song_data and
+    log_data files under data and writes them to Parquet under output, e.g.
+    output/songplays/songplays.parquet/year=2018/month=11/part-0.parquet.
+    songplays is streamed to its files while the log files are parsed; the other tables
+    are deduplicated in memory, and each is released once written, before the next one.
+
+    INPUTS:
+    * data the directory holding the song_data and log_data directories
+    * output the directory the tables are written to
+    * workers the number of threads reading the files
+
+    OUTPUT:
+    * stats of the run, see metrics.py
+    """
+    start = time.perf_counter()
+    total = new_stats()
+
+    tables, lookup, stats = build_song_tables(get_files(os.path.join(data, 'song_data')), workers)
+    add_stats(total, stats)
+    emit('phase', phase='song_data', **summary(stats))
+    for name in list(tables):
+        load_table(total, name, tables.pop(name).to_batches(), output)
+
+    # the load time of songplays includes the parsing of the log files it waits for
+    stats = new_stats()
+    users, timestamps = [], []
+    load_table(total, 'songplays', songplay_batches(get_files(os.path.join(data, 'log_data')), lookup, workers,
+                                                    stats, users, timestamps), output)
+    del lookup
+    tables = build_log_tables(users, timestamps, stats)
+    del users, timestamps
+    add_stats(total, stats)
+    emit('phase', phase='log_data', **summary(stats))
+    for name in list(tables):
+        load_table(total, name, tables.pop(name).to_batches(), output)
+
+    elapsed = time.perf_counter() - start
+    emit('phase', phase='lake', seconds=round(elapsed, 6), workers=workers, **summary(total))
+    print_stats(total)
+    print('{} files in {:.2f} s, {:.1f} files/sec with {} threads'.format(
+        total['files'], elapsed, total['files'] / elapsed if elapsed > 0 else 0, workers))
+
+    return total
+
+
+def main():
+    """
+    Builds the star schema from the JSON files with Arrow on a single node, without
+    a database or a Spark cluster, and writes it to a local Parquet data lake with
+    the partition layout of the Spark ETL.
+    """
+    parser = argparse.ArgumentParser(description='Write the Sparkify star schema to Parquet with pyarrow')
+    parser.add_argument('--data', default='data',
+                        help='directory holding the song_data and log_data directories')
+    parser.add_argument('--output', default='lake', help='directory the Parquet tables are written to')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4,
+                        help='number of threads reading the files')
+    parser.add_argument('--metrics', default=None,
+                        help='file to append the per-phase metrics to as JSON lines, - for stdout')
+    args = parser.parse_args()
+    if args.metrics:
+        set_metrics_hook(json_lines_hook(args.metrics))
+
+    build_lake(args.data, args.output, args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import os
+import hashlib
+from psycopg2.extras import execute_values
+from sql_queries import manifest_select, manifest_table_insert
+
+
+def file_hash(filepath):
+    """
+    Returns the SHA-256 hex digest of a file, read in 1 MB blocks.
+    """
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def load_manifest(cur):
+    """
+    This function returns the processed-file manifest as a dict of
+    filepath to (size, mtime, sha256).
+
+    INPUTS:
+    * cur the cursor variable
+    """
+    cur.execute(manifest_select)
+
+    return {filepath: (size, mtime, sha256) for filepath, size, mtime, sha256 in cur.fetchall()}
+
+
+def pending_files(cur, filepaths, incremental=True):
+    """
+    This function returns the manifest entries of the files that still have to be processed.
+    A file listed in the manifest with the same size and mtime is skipped without being read.
+    A file whose size or mtime changed is hashed, and skipped if its content is unchanged.
+    Every other file is new or changed and is returned.
+
+    INPUTS:
+    * cur the cursor variable
+    * filepaths the list of file paths found
+    * incremental False to return every file, e.g. for a full reload
+
+    OUTPUT:
+    * list of (filepath, size, mtime, sha256) tuples, to be passed to record_files
+      once the rows of the file are loaded
+    """
+    manifest = load_manifest(cur) if incremental else {}
+
+    entries = []
+    for filepath in filepaths:
+        stat = os.stat(filepath)
+        known = manifest.get(filepath)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime:
+            continue
+
+        sha256 = file_hash(filepath)
+        if known and known[2] == sha256:
+            continue
+
+        entries.append((filepath, stat.st_size, stat.st_mtime, sha256))
+
+    return entries
+
+
+def record_files(cur, entries):
+    """
+    This procedure records loaded files in the manifest.
+    It does not commit, so that the manifest is committed together with the rows of the files.
+
+    INPUTS:
+    * cur the cursor variable
+    * entries list of (filepath, size, mtime, sha256) tuples returned by pending_files
+    """
+    if entries:
+        execute_values(cur, manifest_table_insert, entries)
@@ -0,0 +1,136 @@
+import sys
+import json
+import time
+from contextlib import contextmanager
+
+# function called with every metrics record (a dict), None to disable the metrics
+metrics_hook = None
+
+
+def set_metrics_hook(hook):
+    """
+    Sets the function called with every metrics record, None to disable the metrics.
+    With a forked worker pool, the hook set in the parent is inherited by the workers.
+    """
+    global metrics_hook
+    metrics_hook = hook
+
+
+def json_lines_hook(path):
+    """
+    Returns a metrics hook appending each record as a JSON line to a file, or to stdout for '-'.
+    The file is opened in append mode for every record, so that worker processes can share it.
+    """
+    def hook(record):
+        line = json.dumps(record, default=str) + '\n'
+        if path == '-':
+            sys.stdout.write(line)
+            sys.stdout.flush()
+        else:
+            with open(path, 'a', encoding='utf8') as f:
+                f.write(line)
+
+    return hook
+
+
+def emit(event, **fields):
+    """
+    Sends a metrics record to the metrics hook, if any.
+
+    INPUTS:
+    * event the kind of record, e.g. file, batch, phase or error
+    * fields the values of the record
+    """
+    if metrics_hook is not None:
+        record = {'event': event, 'time': time.time()}
+        record.update(fields)
+        metrics_hook(record)
+
+
+def new_stats():
+    """
+    Returns empty stats: wall time of the read/transform/load stages, number of files,
+    song lookup hits and misses, and rows attempted/inserted/failed per table.
+    """
+    return {'files': 0, 'read_sec': 0.0, 'transform_sec': 0.0, 'load_sec': 0.0,
+            'lookup_hits': 0, 'lookup_misses': 0, 'tables': {}}
+
+
+def count_rows(stats, table, attempted=0, inserted=0, failed=0):
+    """
+    Adds row counts of a table to stats.
+    Rows attempted but neither inserted nor failed were dropped by an ON CONFLICT clause
+    (or collapsed before the load), and are reported as conflicted.
+    """
+    counts = stats['tables'].setdefault(table, {'attempted': 0, 'inserted': 0, 'failed': 0})
+    counts['attempted'] += attempted
+    counts['inserted'] += inserted
+    counts['failed'] += failed
+
+
+def add_stats(total, stats):
+    """
+    Adds stats, e.g. of a batch, to total stats, e.g. of a run.
+    """
+    for key, value in stats.items():
+        if key == 'tables':
+            for table, counts in value.items():
+                count_rows(total, table, **counts)
+        else:
+            total[key] += value
+
+
+@contextmanager
+def timer(stats, key):
+    """
+    Adds the wall time of the block to stats[key].
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats[key] += time.perf_counter() - start
+
+
+def timed_iter(iterable, stats, key):
+    """
+    Yields the items of iterable, adding the time spent producing them to stats[key],
+    e.g. the read time of a streaming reader, excluding the time spent by the consumer.
+    """
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            stats[key] += time.perf_counter() - start
+            return
+        stats[key] += time.perf_counter() - start
+        yield item
+
+
+def summary(stats):
+    """
+    Returns stats as a metrics record, with the conflicted rows of each table.
+    """
+    record = {key: round(value, 6) if isinstance(value, float) else value
+              for key, value in stats.items() if key != 'tables'}
+    record['tables'] = {
+        table: dict(counts, conflicted=counts['attempted'] - counts['inserted'] - counts['failed'])
+        for table, counts in stats['tables'].items()
+    }
+
+    return record
+
+
+def print_stats(stats):
+    """
+    Prints the per-stage wall time and the per-table row counts of stats.
+    """
+    record = summary(stats)
+    print('read {read_sec:.2f}s, transform {transform_sec:.2f}s, load {load_sec:.2f}s'.format(**record))
+    if record['lookup_hits'] or record['lookup_misses']:
+        print('song lookup: {lookup_hits} hits, {lookup_misses} misses'.format(**record))
+    for table, counts in record['tables'].items():
+        print('{}: {attempted} rows attempted, {inserted} inserted, {conflicted} conflicted, {failed} failed'
+              .format(table, **counts))
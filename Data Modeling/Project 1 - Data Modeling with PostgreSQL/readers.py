@@ -0,0 +1,78 @@
+import json
+import pandas as pd
+
+# number of records per batch yielded by the readers
+READ_BATCH_RECORDS = 1000
+
+# fields of a song file needed by the songs and artists tables
+SONG_FIELDS = ['song_id', 'title', 'artist_id', 'year', 'duration',
+               'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']
+
+# fields of a log file needed by the time, users and songplays tables
+LOG_FIELDS = ['ts', 'userId', 'firstName', 'lastName', 'gender', 'level',
+              'song', 'artist', 'length', 'sessionId', 'location', 'userAgent']
+
+
+def read_batches(filepath, fields, page=None, batch_size=READ_BATCH_RECORDS):
+    """
+    This generator parses a JSON lines file incrementally and yields its records
+    in batches of at most `batch_size` tuples, projected on `fields`.
+    Only one batch is held in memory, whatever the size of the file.
+
+    INPUTS:
+    * filepath the file path to the JSON lines file
+    * fields the list of fields to keep, in tuple order (missing fields are None)
+    * page if given, only the records whose page is equal to it are kept;
+      lines not containing it at all are skipped without being parsed
+    * batch_size the maximum number of records per batch
+    """
+    batch = []
+    with open(filepath, encoding='utf8') as f:
+        for line in f:
+            if page is not None and page not in line:
+                continue
+            line = line.strip()
+            if not line:
+                continue
+
+            record = json.loads(line)
+            if page is not None and record.get('page') != page:
+                continue
+
+            batch.append(tuple(record.get(field) for field in fields))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+
+    if batch:
+        yield batch
+
+
+def read_frames(filepath, fields, page=None, batch_size=READ_BATCH_RECORDS):
+    """
+    This generator yields the batches of read_batches as DataFrames whose columns are `fields`.
+    """
+    for batch in read_batches(filepath, fields, page, batch_size):
+        yield pd.DataFrame.from_records(batch, columns=fields)
+
+
+def read_song_catalog(filepaths):
+    """
+    This function reads many small song files with plain buffered I/O and returns
+    all their records as tuples projected on SONG_FIELDS.
+    Each file is read in one call and split into lines, which is the cheapest way
+    to read the thousands of single-record files of song_data.
+
+    INPUTS:
+    * filepaths the list of song file paths
+    """
+    records = []
+    for filepath in filepaths:
+        with open(filepath, 'rb') as f:
+            data = f.read()
+        for line in data.splitlines():
+            if line.strip():
+                record = json.loads(line)
+                records.append(tuple(record.get(field) for field in SONG_FIELDS))
+
+    return records
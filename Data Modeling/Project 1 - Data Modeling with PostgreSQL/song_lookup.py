@@ -0,0 +1,101 @@
+import pandas as pd
+from sql_queries import song_lookup_select
+from readers import read_batches
+
+# maximum difference in seconds between a log length and a song duration
+# (duration is stored as decimal, length is read back as a float)
+DURATION_TOLERANCE = 0.001
+
+# durations and lengths are compared in whole microseconds, so that a difference
+# of exactly DURATION_TOLERANCE is within it despite float rounding
+DURATION_UNITS = 1000000
+
+LOOKUP_COLUMNS = ['title', 'artist_name', 'duration', 'song_id', 'artist_id']
+
+
+def make_song_lookup(df):
+    """
+    This function turns a DataFrame of songs into a lookup index.
+    The index is keyed on (title, artist_name, duration) and sorted on duration,
+    as required by resolve_songs, with the duration in microseconds in duration_us.
+
+    INPUTS:
+    * df DataFrame holding at least the LOOKUP_COLUMNS
+    """
+    lookup = df[LOOKUP_COLUMNS].dropna(subset=['title', 'artist_name', 'duration'])
+    lookup = lookup.astype({'duration': 'float64'})
+
+    lookup = lookup.assign(duration_us=to_units(lookup.duration))
+
+    return lookup.drop_duplicates(['title', 'artist_name', 'duration']) \
+                 .sort_values('duration_us') \
+                 .reset_index(drop=True)
+
+
+def to_units(seconds):
+    """
+    Returns a Series of seconds as whole DURATION_UNITS (microseconds), as int64.
+    """
+    return (seconds.astype('float64') * DURATION_UNITS).round().astype('int64')
+
+
+def build_song_lookup(cur):
+    """
+    This function builds the song lookup index from the loaded songs and artists tables
+    with a single query.
+
+    INPUTS:
+    * cur the cursor variable
+    """
+    cur.execute(song_lookup_select)
+    df = pd.DataFrame(cur.fetchall(), columns=LOOKUP_COLUMNS)
+
+    return make_song_lookup(df)
+
+
+def build_song_lookup_from_files(filepaths):
+    """
+    This function builds the song lookup index directly from song JSON files,
+    without going through the database.
+
+    INPUTS:
+    * filepaths the list of song file paths
+    """
+    records = [record for f in filepaths for batch in read_batches(f, LOOKUP_COLUMNS) for record in batch]
+
+    return make_song_lookup(pd.DataFrame.from_records(records, columns=LOOKUP_COLUMNS))
+
+
+def resolve_songs(df, lookup, tolerance=DURATION_TOLERANCE):
+    """
+    This function resolves the song_id and artist_id of every event of a log DataFrame
+    in one vectorized merge against the lookup index.
+    Events match a song on equal title and artist name and on the nearest duration
+    within `tolerance`; unmatched events get None.
+
+    INPUTS:
+    * df log DataFrame with song, artist and length columns
+    * lookup the index returned by build_song_lookup/build_song_lookup_from_files
+    * tolerance maximum difference between length and duration
+
+    OUTPUT:
+    * DataFrame with song_id and artist_id columns, aligned on the index of df
+    """
+    resolved = pd.DataFrame({'song_id': None, 'artist_id': None}, index=df.index)
+
+    events = df[['song', 'artist', 'length']].dropna()
+    if events.empty or lookup.empty:
+        return resolved
+
+    events = events.assign(length_us=to_units(events.length)) \
+                   .rename_axis('_event') \
+                   .reset_index() \
+                   .sort_values('length_us')
+    matched = pd.merge_asof(events, lookup,
+                            left_on='length_us', right_on='duration_us',
+                            left_by=['song', 'artist'], right_by=['title', 'artist_name'],
+                            tolerance=int(round(tolerance * DURATION_UNITS)), direction='nearest')
+    matched = matched.set_index('_event')[['song_id', 'artist_id']]
+
+    resolved.loc[matched.index, ['song_id', 'artist_id']] = matched.values
+    return resolved.where(resolved.notna(), None)
@@ -5,6 +5,7 @@ user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+manifest_table_drop = "DROP TABLE IF EXISTS etl_manifest"
 
 # CREATE TABLES
 
@@ -19,7 +20,8 @@ songplay_table_create = ("\
         artist_id varchar, \
         session_id int NOT NULL, \
         location varchar NOT NULL, \
-        user_agent varchar NOT NULL \
+        user_agent varchar NOT NULL, \
+        UNIQUE (start_time, user_id, session_id) \
     )\
 ")
 
@@ -51,8 +53,8 @@ artist_table_create = ("\
         artist_id varchar PRIMARY KEY, \
         name varchar NOT NULL, \
         location varchar NOT NULL, \
-        latitude decimal NOT NULL, \
-        longitude decimal NOT NULL \
+        latitude decimal, \
+        longitude decimal \
     )\
 ")
 
@@ -69,6 +71,18 @@ time_table_create = ("\
     )\
 ")
 
+# one row per loaded data file, used to only process new or changed files
+manifest_table_create = ("\
+    CREATE TABLE etl_manifest \
+    ( \
+        filepath varchar PRIMARY KEY, \
+        size bigint NOT NULL, \
+        mtime double precision NOT NULL, \
+        sha256 char(64) NOT NULL, \
+        loaded_at timestamp NOT NULL DEFAULT now() \
+    )\
+")
+
 # INSERT RECORDS
 
 songplay_table_insert = ("\
@@ -116,6 +130,16 @@ time_table_insert = ("\
     ON CONFLICT DO NOTHING\
 ")
 
+manifest_table_insert = ("\
+    INSERT INTO etl_manifest\
+    (\
+        filepath, size, mtime, sha256\
+    )\
+    VALUES %s\
+    ON CONFLICT (filepath) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, \
+        sha256 = excluded.sha256, loaded_at = now()\
+")
+
 # FIND SONGS
 
 song_select = ("\
@@ -124,10 +148,171 @@ song_select = ("\
     WHERE songs.title = %s AND artists.name = %s AND songs.duration = %s \
     ")  
 
+# whole songs/artists join, loaded once into the in-memory song lookup index
+song_lookup_select = ("\
+    SELECT songs.title, artists.name, songs.duration, songs.song_id, artists.artist_id FROM songs \
+    JOIN artists ON songs.artist_id = artists.artist_id \
+    ")
+
+manifest_select = ("SELECT filepath, size, mtime, sha256 FROM etl_manifest")
+
+time_select_range = ("SELECT start_time FROM time WHERE start_time BETWEEN %s AND %s")
+
+# STAGING TABLES (bulk load)
+
+song_staging_create = ("\
+    CREATE TEMP TABLE songs_staging \
+    ( \
+        song_id varchar, \
+        title varchar, \
+        artist_id varchar, \
+        year int, \
+        duration decimal \
+    ) ON COMMIT DROP\
+")
+
+artist_staging_create = ("\
+    CREATE TEMP TABLE artists_staging \
+    ( \
+        artist_id varchar, \
+        name varchar, \
+        location varchar, \
+        latitude decimal, \
+        longitude decimal \
+    ) ON COMMIT DROP\
+")
+
+# ts is only kept to pick the latest level of each user
+user_staging_create = ("\
+    CREATE TEMP TABLE users_staging \
+    ( \
+        ts bigint, \
+        user_id int, \
+        first_name varchar, \
+        last_name varchar, \
+        gender char(1), \
+        level varchar \
+    ) ON COMMIT DROP\
+")
+
+time_staging_create = ("\
+    CREATE TEMP TABLE time_staging \
+    ( \
+        start_time bigint, \
+        hour int, \
+        day int, \
+        week int, \
+        month int, \
+        year int, \
+        weekday int \
+    ) ON COMMIT DROP\
+")
+
+# song_id and artist_id are resolved in memory with the song lookup index
+songplay_staging_create = ("\
+    CREATE TEMP TABLE songplays_staging \
+    ( \
+        start_time bigint, \
+        user_id int, \
+        level varchar, \
+        song_id varchar, \
+        artist_id varchar, \
+        session_id int, \
+        location varchar, \
+        user_agent varchar \
+    ) ON COMMIT DROP\
+")
+
+copy_from_stdin = "COPY {} ({}) FROM STDIN"
+
+# MERGE RECORDS (bulk load)
+# Rows the per-row inserts would reject on a NOT NULL column are skipped
+# here, so that one bad record does not abort the whole batch.
+
+song_table_merge = ("\
+    INSERT INTO songs\
+    (\
+        song_id, title, artist_id, year, duration\
+    )\
+    SELECT song_id, title, artist_id, year, duration \
+    FROM songs_staging \
+    WHERE song_id IS NOT NULL AND title IS NOT NULL AND artist_id IS NOT NULL \
+        AND year IS NOT NULL AND duration IS NOT NULL \
+    ON CONFLICT DO NOTHING\
+")
+
+artist_table_merge = ("\
+    INSERT INTO artists\
+    (\
+        artist_id, name, location, latitude, longitude\
+    )\
+    SELECT artist_id, name, location, latitude, longitude \
+    FROM artists_staging \
+    WHERE artist_id IS NOT NULL AND name IS NOT NULL AND location IS NOT NULL \
+    ON CONFLICT DO NOTHING\
+")
+
+# DO UPDATE cannot touch the same row twice, so keep the latest row per user
+user_table_merge = ("\
+    INSERT INTO users\
+    (\
+        user_id, first_name, last_name, gender, level\
+    )\
+    SELECT DISTINCT ON (user_id) user_id, first_name, last_name, gender, level \
+    FROM users_staging \
+    WHERE user_id IS NOT NULL AND first_name IS NOT NULL AND last_name IS NOT NULL \
+        AND gender IS NOT NULL AND level IS NOT NULL \
+    ORDER BY user_id, ts DESC \
+    ON CONFLICT (user_id) DO UPDATE SET level = excluded.level\
+")
+
+time_table_merge = ("\
+    INSERT INTO time\
+    (\
+        start_time, hour, day, week, month, year, weekday\
+    )\
+    SELECT DISTINCT start_time, hour, day, week, month, year, weekday \
+    FROM time_staging \
+    WHERE start_time IS NOT NULL \
+    ON CONFLICT DO NOTHING\
+")
+
+songplay_table_merge = ("\
+    INSERT INTO songplays\
+    (\
+        start_time, user_id, level, song_id, artist_id, session_id, location, user_agent\
+    )\
+    SELECT start_time, user_id, level, song_id, artist_id, session_id, location, user_agent \
+    FROM songplays_staging \
+    WHERE start_time IS NOT NULL AND user_id IS NOT NULL AND level IS NOT NULL \
+        AND session_id IS NOT NULL AND location IS NOT NULL AND user_agent IS NOT NULL \
+    ON CONFLICT DO NOTHING\
+")
+
 # QUERY LISTS
 
-create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
+create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, manifest_table_create]
+drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, manifest_table_drop]
+
+# table -> (staging table, staging columns, staging create, merge), in load order
+bulk_load_tables = {
+    'songs': ('songs_staging',
+              ['song_id', 'title', 'artist_id', 'year', 'duration'],
+              song_staging_create, song_table_merge),
+    'artists': ('artists_staging',
+                ['artist_id', 'name', 'location', 'latitude', 'longitude'],
+                artist_staging_create, artist_table_merge),
+    'time': ('time_staging',
+             ['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday'],
+             time_staging_create, time_table_merge),
+    'users': ('users_staging',
+              ['ts', 'user_id', 'first_name', 'last_name', 'gender', 'level'],
+              user_staging_create, user_table_merge),
+    'songplays': ('songplays_staging',
+                  ['start_time', 'user_id', 'level', 'song_id', 'artist_id',
+                   'session_id', 'location', 'user_agent'],
+                  songplay_staging_create, songplay_table_merge),
+}
 
 # Test results
 
@@ -0,0 +1,102 @@
+import os
+import json
+import tempfile
+import pandas as pd
+from song_lookup import make_song_lookup, resolve_songs, DURATION_TOLERANCE, LOOKUP_COLUMNS
+from transforms import latest_user_rows
+from readers import read_batches
+
+# checks of the row transforms of the ETL, which need no database: python test_transforms.py
+
+
+def test_resolve_songs():
+    print("Checking: song lookup duration tolerance")
+    lookup = make_song_lookup(pd.DataFrame([
+        ('Song A', 'Artist A', 100.0, 'SOA', 'ARA'),
+        ('Song B', 'Artist B', 200.0, 'SOB', 'ARB'),
+        # same title and artist, another duration: the nearest one is matched
+        ('Song B', 'Artist B', 200.5, 'SOB2', 'ARB'),
+    ], columns=LOOKUP_COLUMNS))
+
+    events = pd.DataFrame([
+        ('Song A', 'Artist A', 100.0),                            # exact duration
+        ('Song A', 'Artist A', 100.0 + DURATION_TOLERANCE),       # at the tolerance
+        ('Song A', 'Artist A', 100.0 - DURATION_TOLERANCE),       # at the tolerance, below
+        ('Song A', 'Artist A', 100.0 + DURATION_TOLERANCE * 1.01),  # just past the tolerance
+        ('Song A', 'Artist B', 100.0),                            # other artist
+        ('Song B', 'Artist B', 200.4),                            # nearest of two durations, too far
+        ('Song B', 'Artist B', 200.5),
+        (None, None, None),                                       # not a song play of the catalog
+    ], columns=['song', 'artist', 'length'], index=[10, 11, 12, 13, 14, 15, 16, 17])
+
+    resolved = resolve_songs(events, lookup)
+    print(resolved, "\n")
+    assert list(resolved.index) == list(events.index), "resolved rows must be aligned on the events"
+    assert resolved.song_id.tolist() == ['SOA', 'SOA', 'SOA', None, None, None, 'SOB2', None], \
+        "song_id differs: {}".format(resolved.song_id.tolist())
+    assert resolved.artist_id.tolist() == ['ARA', 'ARA', 'ARA', None, None, None, 'ARB', None], \
+        "artist_id differs: {}".format(resolved.artist_id.tolist())
+
+
+def test_latest_user_rows():
+    print("Checking: latest user rows out of order")
+    user_df = pd.DataFrame([
+        (300, 1, 'Ann', 'Lee', 'F', 'paid'),
+        (100, 2, 'Bob', 'Ray', 'M', 'paid'),
+        (100, 1, 'Ann', 'Lee', 'F', 'free'),
+        (400, 1, 'Ann', 'Lee', 'F', 'free'),    # latest row of user 1
+        (200, 1, 'Ann', 'Lee', 'F', 'paid'),
+        (None, None, None, None, None, None),   # no user
+        (200, 2, 'Bob', 'Ray', 'M', 'free'),    # same ts as the next row: the later row wins
+        (200, 2, 'Bob', 'Ray', 'M', 'paid'),
+    ], columns=['ts', 'userId', 'firstName', 'lastName', 'gender', 'level'])
+
+    latest = latest_user_rows(user_df)
+    print(latest, "\n")
+    levels = dict(zip(latest.userId.astype(int), latest.level))
+    assert len(latest) == 2, "one row per user expected, got {}".format(len(latest))
+    assert levels == {1: 'free', 2: 'paid'}, "levels differ: {}".format(levels)
+
+
+def test_read_batches():
+    print("Checking: read_batches page filter and batch boundaries")
+    records = [
+        {'page': 'NextSong', 'ts': 1},
+        {'page': 'Home', 'ts': 2},
+        {'page': 'Home', 'song': 'NextSong', 'ts': 3},  # contains the page, but is not a song play
+        {'page': 'NextSong', 'ts': 4},
+        {'page': 'NextSong', 'ts': 5},
+        {'page': 'Logout', 'ts': 6},
+        {'page': 'NextSong', 'ts': 7},
+        {'page': 'NextSong', 'ts': 8},
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        filepath = os.path.join(tmp, 'events.json')
+        with open(filepath, 'w', encoding='utf8') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n\n')
+
+        # 5 song plays: batches of 5 (exact), 2 (remainder) and 1, and all records unfiltered
+        for page, batch_size, expected in [
+            ('NextSong', 5, [[1, 4, 5, 7, 8]]),
+            ('NextSong', 2, [[1, 4], [5, 7], [8]]),
+            ('NextSong', 1, [[1], [4], [5], [7], [8]]),
+            (None, 4, [[1, 2, 3, 4], [5, 6, 7, 8]]),
+            ('Error', 2, []),
+        ]:
+            batches = [[ts for ts, in batch] for batch in read_batches(filepath, ['ts'], page, batch_size)]
+            print(page, batch_size, batches)
+            assert batches == expected, "page {} batch_size {}: expected {}, got {}".format(
+                page, batch_size, expected, batches)
+    print()
+
+
+def main():
+    test_resolve_songs()
+    test_latest_user_rows()
+    test_read_batches()
+    print("All checks passed")
+
+
+if __name__ == "__main__":
+    main()
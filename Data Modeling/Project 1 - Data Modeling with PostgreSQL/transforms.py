@@ -0,0 +1,137 @@
+import os
+import pandas as pd
+from song_lookup import resolve_songs
+from readers import read_batches, read_frames, SONG_FIELDS, LOG_FIELDS
+from metrics import new_stats, timer, timed_iter
+
+# row transforms of the ETL, shared with lake.py: they read the JSON files
+# and return plain rows, without a database connection
+
+
+def get_files(filepath):
+    """
+    This function returns the absolute paths of all JSON files under a directory, sorted.
+    The tree is walked with a single recursive os.scandir scan, without one glob per directory.
+
+    INPUTS:
+    * filepath the directory to walk
+    """
+    all_files = []
+    directories = [os.path.abspath(filepath)]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.name.endswith('.json') and not entry.name.startswith('.'):
+                    all_files.append(entry.path)
+
+    return sorted(all_files)
+
+
+def time_table_rows(timestamps):
+    """
+    This function builds the time table rows of a set of timestamps in bulk.
+    Duplicate timestamps are dropped, and hour/day/week/month/year/weekday are
+    computed with vectorized datetime accessors, week being the ISO calendar week.
+
+    INPUTS:
+    * timestamps iterable of start_time values, in milliseconds since the epoch
+
+    OUTPUT:
+    * DataFrame with the columns of the time table, one row per distinct timestamp
+    """
+    start_time = pd.Series(pd.unique(pd.Series(list(timestamps), dtype='int64')), dtype='int64')
+    t = pd.to_datetime(start_time, unit='ms')
+
+    return pd.DataFrame({
+        'start_time': start_time,
+        'hour': t.dt.hour,
+        'day': t.dt.day,
+        'week': t.dt.isocalendar().week.astype('int64'),
+        'month': t.dt.month,
+        'year': t.dt.year,
+        'weekday': t.dt.weekday,
+    })
+
+
+def latest_user_rows(user_df):
+    """
+    This function reduces user rows to the latest row of each user, ordered by ts,
+    so that a single upsert per user leaves the level of its last event.
+
+    INPUTS:
+    * user_df DataFrame of user rows whose first two columns are ts and the user ID
+
+    OUTPUT:
+    * DataFrame with one row per distinct user ID
+    """
+    ts, user_id = user_df.columns[:2]
+
+    return user_df.dropna(subset=[user_id]) \
+                  .sort_values(ts, kind='stable') \
+                  .drop_duplicates(user_id, keep='last')
+
+
+def song_file_rows(filepath, stats=None):
+    """
+    This function reads a song file whose filepath has been provided as an argument
+    and returns the rows it contributes to the songs and artists tables.
+    The file is parsed with plain JSON, without building a DataFrame.
+
+    INPUTS:
+    * filepath the file path to the song file
+    * stats the stats to update, see metrics.py
+
+    OUTPUT:
+    * dict of table name to list of rows, in the column order of `bulk_load_tables` of sql_queries.py
+    """
+    stats = stats if stats is not None else new_stats()
+
+    songs, artists = [], []
+    for batch in timed_iter(read_batches(filepath, SONG_FIELDS), stats, 'read_sec'):
+        for row in batch:
+            songs.append(row[:5])
+            artists.append((row[2],) + row[5:])
+
+    return {'songs': songs, 'artists': artists}
+
+
+def log_file_rows(filepath, lookup, stats=None):
+    """
+    This function reads a log file whose filepath has been provided as an argument
+    and returns the rows it contributes to the time, users and songplays tables.
+    Only the NextSong events are parsed, in batches (see readers.py).
+    Song and artist IDs are resolved against the song lookup index.
+
+    INPUTS:
+    * filepath the file path to the log file
+    * lookup the song lookup index (see song_lookup.py)
+    * stats the stats to update, see metrics.py
+
+    OUTPUT:
+    * dict of table name to list of rows, in the column order of `bulk_load_tables` of sql_queries.py,
+      except for time which only holds the distinct start_time values of the file,
+      to be deferred to load_deferred_tables of etl.py; users rows are tuples
+    """
+    stats = stats if stats is not None else new_stats()
+
+    table_rows = {'time': [], 'users': [], 'songplays': []}
+    for df in timed_iter(read_frames(filepath, LOG_FIELDS, page='NextSong'), stats, 'read_sec'):
+        with timer(stats, 'transform_sec'):
+            song_ids = resolve_songs(df, lookup)
+            hits = int(song_ids.song_id.notna().sum())
+            stats['lookup_hits'] += hits
+            stats['lookup_misses'] += len(df) - hits
+
+            songplays_df = pd.concat([df[['ts', 'userId', 'level']],
+                                      song_ids,
+                                      df[['sessionId', 'location', 'userAgent']]], axis=1)
+
+            table_rows['time'].extend(df.ts.unique().tolist())
+            # as tuples, so that they can be collected in a set when the users are deferred
+            table_rows['users'].extend(map(tuple, df[['ts', 'userId', 'firstName', 'lastName', 'gender',
+                                                      'level']].values.tolist()))
+            table_rows['songplays'].extend(songplays_df.values.tolist())
+
+    return table_rows
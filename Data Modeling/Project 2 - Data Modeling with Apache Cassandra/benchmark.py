@@ -0,0 +1,202 @@
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import loader
+import standin
+from cql_queries import (drop_table_queries, songs_by_session_item_select,
+                         songs_by_user_item_select, users_by_title_select)
+
+# table -> (select query, function returning the query parameters of an event)
+BENCHMARK_QUERIES = {
+    'songs_by_session_item': (songs_by_session_item_select, lambda event: (int(event[8]), int(event[3]))),
+    'songs_by_user_item': (songs_by_user_item_select, lambda event: (int(event[10]), int(event[8]))),
+    'users_by_title': (users_by_title_select, lambda event: (event[9],)),
+}
+
+
+def git_version():
+    """
+    Returns the short hash of the current commit, or None outside of a git checkout.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def scale_events(events, scale):
+    """
+    This function returns `scale` copies of the events, the session and user ids of each
+    copy being shifted past those of the previous one, so that the copies fill new
+    session and user partitions while the song title partitions grow.
+
+    INPUTS:
+    * events the list of events of event_datafile_new.csv
+    * scale the number of copies
+    """
+    max_session = max(int(event[8]) for event in events) + 1
+    max_user = max(int(event[10]) for event in events) + 1
+
+    scaled = list(events)
+    for copy in range(1, scale):
+        for event in events:
+            event = list(event)
+            event[8] = str(int(event[8]) + copy * max_session)
+            event[10] = str(int(event[10]) + copy * max_user)
+            scaled.append(event)
+
+    return scaled
+
+
+def percentile(latencies, p):
+    """
+    Returns the nearest-rank p-th percentile of a sorted list of latencies.
+    """
+    if not latencies:
+        return None
+    return latencies[min(len(latencies) - 1, max(0, int(round(p / 100 * len(latencies))) - 1))]
+
+
+def replay_queries(session, query, parameters, concurrency):
+    """
+    This function runs a prepared query once per parameter tuple, from `concurrency`
+    client threads, and measures the latency of each synchronous execution.
+
+    OUTPUT:
+    * dict with the number of queries, queries/sec, and p50/p99 latency in milliseconds
+    """
+    statement = session.prepare(query)
+
+    def timed_query(params):
+        start = time.perf_counter()
+        session.execute(statement, params)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        latencies = sorted(executor.map(timed_query, parameters))
+    elapsed = time.perf_counter() - start
+
+    return {
+        'queries': len(latencies),
+        'queries_per_sec': len(latencies) / elapsed if elapsed > 0 else None,
+        'p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+        'p99_ms': percentile(latencies, 99) * 1000 if latencies else None,
+    }
+
+
+def connect(args):
+    """
+    Returns (session, shutdown function, execute_group function) of the chosen backend.
+    """
+    if args.backend == 'standin':
+        session = standin.StandInSession(args.latency_ms / 1000, args.concurrency)
+        return session, session.shutdown, standin.execute_group_async
+
+    from cassandra.cluster import Cluster
+
+    cluster = Cluster(args.hosts)
+    session = cluster.connect()
+
+    def shutdown():
+        session.shutdown()
+        cluster.shutdown()
+
+    return session, shutdown, loader.execute_group_async
+
+
+def run_benchmark(session, execute_group, events, args):
+    """
+    This function recreates the three query tables, loads the events into them and replays
+    the three access patterns on parameters sampled from the events.
+
+    OUTPUT:
+    * dict with the write throughput and the read latency of each table
+    """
+    # the tables are dropped in the keyspace, which a new session has not set yet
+    loader.set_keyspace(session, args.keyspace)
+    for query in drop_table_queries:
+        session.execute(query)
+    loader.create_tables(session, args.keyspace)
+
+    start = time.perf_counter()
+    load_stats = loader.load_events(session, events, args.concurrency, args.batch_rows,
+                                    execute_group=execute_group)
+    load_sec = time.perf_counter() - start
+
+    rng = random.Random(args.seed)
+    sample = [rng.choice(events) for _ in range(args.queries)]
+
+    tables = {}
+    for table, (query, params_func) in BENCHMARK_QUERIES.items():
+        tables[table] = dict(load_stats[table], **replay_queries(
+            session, query, [params_func(event) for event in sample], args.concurrency))
+
+    return {
+        'load_sec': load_sec,
+        'rows_per_sec': sum(counts['rows'] for counts in load_stats.values()) / load_sec if load_sec > 0 else None,
+        'tables': tables,
+    }
+
+
+def main():
+    """
+    Benchmarks the Cassandra data model: loads event_datafile_new.csv (optionally scaled)
+    into the three query tables of a local Cassandra or of the in-process stand-in,
+    replays the three queries at the given concurrency, prints the write throughput and
+    the p50/p99 read latency per table, and appends them as a JSON line to the results file.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the Sparkify Cassandra tables')
+    parser.add_argument('--backend', choices=['standin', 'cassandra'], default='standin',
+                        help='in-process stand-in or Cassandra cluster at --hosts')
+    parser.add_argument('--hosts', nargs='+', default=['127.0.0.1'], help='Cassandra contact points')
+    parser.add_argument('--keyspace', default=loader.KEYSPACE, help='keyspace of the tables')
+    parser.add_argument('--file', default=loader.EVENT_FILE, help='denormalized event CSV file')
+    parser.add_argument('--scale', type=int, default=1, help='number of copies of the events to load')
+    parser.add_argument('--concurrency', type=int, default=loader.CONCURRENCY,
+                        help='maximum number of requests in flight, and number of query threads')
+    parser.add_argument('--batch-rows', type=int, default=loader.BATCH_ROWS,
+                        help='maximum number of rows per unlogged batch, 1 to disable the batches')
+    parser.add_argument('--queries', type=int, default=1000, help='number of queries per table')
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help='simulated round-trip latency of the stand-in, in milliseconds')
+    parser.add_argument('--seed', type=int, default=42, help='random seed of the query sample')
+    parser.add_argument('--output', default='benchmark_results.jsonl', help='JSON lines results file')
+    args = parser.parse_args()
+
+    events = scale_events(list(loader.read_event_file(args.file)), args.scale)
+
+    session, shutdown, execute_group = connect(args)
+    try:
+        result = run_benchmark(session, execute_group, events, args)
+    finally:
+        shutdown()
+
+    result.update({
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'version': git_version(),
+        'python': platform.python_version(),
+        'params': {'backend': args.backend, 'events': len(events), 'scale': args.scale,
+                   'concurrency': args.concurrency, 'batch_rows': args.batch_rows,
+                   'queries': args.queries, 'latency_ms': args.latency_ms},
+    })
+    with open(args.output, 'a', encoding='utf8') as f:
+        f.write(json.dumps(result) + '\n')
+
+    print('{} events loaded in {:.2f} s, {:.0f} rows/sec'.format(len(events), result['load_sec'],
+                                                                 result['rows_per_sec'] or 0))
+    for table, stats in result['tables'].items():
+        print('  {}: {} requests, {} failed, {:.0f} queries/sec, p50 {:.2f} ms, p99 {:.2f} ms'.format(
+            table, stats['requests'], stats['failed'], stats['queries_per_sec'] or 0,
+            stats['p50_ms'] or 0, stats['p99_ms'] or 0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# CREATE KEYSPACE
+
+keyspace_create = ("""
+CREATE KEYSPACE IF NOT EXISTS {}
+WITH REPLICATION =
+{{ 'class' : 'SimpleStrategy', 'replication_factor' : 1 }}
+""")
+
+# DROP TABLES
+
+songs_by_session_item_drop = "DROP TABLE IF EXISTS songs_by_session_item"
+songs_by_user_item_drop = "DROP TABLE IF EXISTS songs_by_user_item"
+users_by_title_drop = "DROP TABLE IF EXISTS users_by_title"
+
+# CREATE TABLES
+
+songs_by_session_item_create = ("""
+CREATE TABLE IF NOT EXISTS songs_by_session_item (
+    session_id int,
+    item int,
+    artist_name text,
+    song_length double,
+    song_title text,
+    PRIMARY KEY (session_id, item))
+""")
+
+songs_by_user_item_create = ("""
+CREATE TABLE IF NOT EXISTS songs_by_user_item (
+    user_id int,
+    session_id int,
+    item int,
+    artist_name text,
+    first_name text,
+    last_name text,
+    song_title text,
+    PRIMARY KEY ((user_id, session_id), item))
+""")
+
+users_by_title_create = ("""
+CREATE TABLE IF NOT EXISTS users_by_title (
+    song_title text,
+    user_id int,
+    first_name text,
+    last_name text,
+    PRIMARY KEY (song_title, user_id))
+""")
+
+# INSERT RECORDS
+
+songs_by_session_item_insert = ("""
+INSERT INTO songs_by_session_item (session_id, item, artist_name, song_length, song_title)
+VALUES (?, ?, ?, ?, ?)
+""")
+
+songs_by_user_item_insert = ("""
+INSERT INTO songs_by_user_item (user_id, session_id, item, artist_name, first_name, last_name, song_title)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+""")
+
+users_by_title_insert = ("""
+INSERT INTO users_by_title (song_title, user_id, first_name, last_name)
+VALUES (?, ?, ?, ?)
+""")
+
+# QUERIES
+
+# Query 1: artist, song title and song's length heard during a session at an item
+songs_by_session_item_select = ("""
+SELECT artist_name, song_title, song_length FROM songs_by_session_item WHERE session_id = ? AND item = ?
+""")
+
+# Query 2: artist, song (sorted by item) and user name of a session of a user
+songs_by_user_item_select = ("""
+SELECT artist_name, song_title, first_name, last_name FROM songs_by_user_item WHERE user_id = ? AND session_id = ?
+""")
+
+# Query 3: every user name who listened to a song
+users_by_title_select = ("""
+SELECT first_name, last_name FROM users_by_title WHERE song_title = ?
+""")
+
+# QUERY LISTS
+
+create_table_queries = [songs_by_session_item_create, songs_by_user_item_create, users_by_title_create]
+drop_table_queries = [songs_by_session_item_drop, songs_by_user_item_drop, users_by_title_drop]
@@ -0,0 +1,227 @@
+import csv
+import time
+import argparse
+from collections import deque
+from itertools import islice
+
+from preprocess import get_files, stream_events
+from cql_queries import (keyspace_create, create_table_queries, songs_by_session_item_insert,
+                         songs_by_user_item_insert, users_by_title_insert)
+
+EVENT_FILE = 'event_datafile_new.csv'
+KEYSPACE = 'udacity'
+
+# maximum number of requests (statements or batches) waiting for Cassandra
+CONCURRENCY = 64
+# maximum number of rows of an unlogged batch, all of the same partition
+# (keeps batches under the 5 KB batch_size_warn_threshold of Cassandra)
+BATCH_ROWS = 20
+# number of events grouped by partition key at a time
+CHUNK_ROWS = 1000
+
+
+def session_item_row(event):
+    """
+    Returns the songs_by_session_item row of an event of event_datafile_new.csv.
+    """
+    return (int(event[8]), int(event[3]), event[0], float(event[5]), event[9])
+
+
+def user_item_row(event):
+    """
+    Returns the songs_by_user_item row of an event of event_datafile_new.csv.
+    """
+    return (int(event[10]), int(event[8]), int(event[3]), event[0], event[1], event[4], event[9])
+
+
+def title_user_row(event):
+    """
+    Returns the users_by_title row of an event of event_datafile_new.csv.
+    """
+    return (event[9], int(event[10]), event[1], event[4])
+
+
+# table -> (insert query, row function, number of leading row values making the partition key)
+LOAD_TABLES = {
+    'songs_by_session_item': (songs_by_session_item_insert, session_item_row, 1),
+    'songs_by_user_item': (songs_by_user_item_insert, user_item_row, 2),
+    'users_by_title': (users_by_title_insert, title_user_row, 1),
+}
+
+
+def read_event_file(filepath=EVENT_FILE):
+    """
+    This generator yields the events of event_datafile_new.csv one by one, without its header.
+    """
+    with open(filepath, encoding='utf8', newline='') as f:
+        csvreader = csv.reader(f)
+        next(csvreader, None)
+        for line in csvreader:
+            yield line
+
+
+def partition_groups(events, key_size, batch_rows):
+    """
+    This function groups the rows of a chunk of events by partition key, in order of
+    first appearance, and splits each group into lists of at most `batch_rows` rows.
+
+    INPUTS:
+    * events the list of rows of one table
+    * key_size the number of leading row values making the partition key
+    * batch_rows the maximum number of rows per group
+    """
+    partitions = {}
+    for row in events:
+        partitions.setdefault(row[:key_size], []).append(row)
+
+    for rows in partitions.values():
+        for i in range(0, len(rows), batch_rows):
+            yield rows[i:i + batch_rows]
+
+
+def execute_group_async(session, statement, rows):
+    """
+    Sends the rows of one partition to Cassandra without waiting for the response:
+    a single row is a plain execution of the prepared statement, several rows are
+    one unlogged batch (they all belong to one partition, so the batch is applied
+    by a single replica set without the batch log).
+
+    OUTPUT:
+    * the response future
+    """
+    if len(rows) == 1:
+        return session.execute_async(statement, rows[0])
+
+    from cassandra.query import BatchStatement, BatchType
+
+    batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+    for row in rows:
+        batch.add(statement, row)
+    return session.execute_async(batch)
+
+
+def load_events(session, events, concurrency=CONCURRENCY, batch_rows=BATCH_ROWS,
+                chunk_rows=CHUNK_ROWS, execute_group=execute_group_async):
+    """
+    This function loads a stream of events into the three query tables in one pass.
+    Each INSERT is prepared once; each event is fanned out to every table, and the rows
+    of each chunk of `chunk_rows` events are grouped by partition key into unlogged batches.
+    At most `concurrency` requests are in flight at a time, so memory is bounded by the
+    chunk size, not by the number of events.
+
+    INPUTS:
+    * session the Cassandra session, connected to the keyspace
+    * events iterable of events with the columns of event_datafile_new.csv
+    * concurrency the maximum number of requests in flight
+    * batch_rows the maximum number of rows per batch, 1 disables the batches
+    * chunk_rows the number of events grouped at a time
+    * execute_group function (session, statement, rows) -> future sending one group of rows
+
+    OUTPUT:
+    * dict of table name to {'rows', 'requests', 'failed'} counts
+    """
+    statements = {table: session.prepare(query) for table, (query, _, _) in LOAD_TABLES.items()}
+    stats = {table: {'rows': 0, 'requests': 0, 'failed': 0} for table in LOAD_TABLES}
+
+    in_flight = deque()
+
+    def wait_oldest():
+        table, num_rows, future = in_flight.popleft()
+        try:
+            future.result()
+        except Exception as e:
+            if not stats[table]['failed']:
+                print("Error: Insert rows for table {}".format(table))
+                print(e)
+            stats[table]['failed'] += num_rows
+
+    events = iter(events)
+    while True:
+        chunk = list(islice(events, chunk_rows))
+        if not chunk:
+            break
+
+        for table, (_, row_func, key_size) in LOAD_TABLES.items():
+            rows = [row_func(event) for event in chunk]
+            for group in partition_groups(rows, key_size, batch_rows):
+                if len(in_flight) >= concurrency:
+                    wait_oldest()
+                in_flight.append((table, len(group), execute_group(session, statements[table], group)))
+                stats[table]['rows'] += len(group)
+                stats[table]['requests'] += 1
+
+    while in_flight:
+        wait_oldest()
+
+    return stats
+
+
+def print_load_stats(stats, elapsed):
+    """
+    Prints the rows, requests and rows/sec written per table by load_events.
+    """
+    for table, counts in stats.items():
+        print('{}: {} rows in {} requests, {} failed, {:.0f} rows/sec'.format(
+            table, counts['rows'], counts['requests'], counts['failed'],
+            counts['rows'] / elapsed if elapsed > 0 else 0))
+
+
+def set_keyspace(session, keyspace=KEYSPACE):
+    """
+    Creates the keyspace if needed and sets it on the session.
+    """
+    session.execute(keyspace_create.format(keyspace))
+    session.set_keyspace(keyspace)
+
+
+def create_tables(session, keyspace=KEYSPACE):
+    """
+    Creates the keyspace if needed, sets it on the session and creates the three query tables.
+    """
+    set_keyspace(session, keyspace)
+    for query in create_table_queries:
+        session.execute(query)
+
+
+def main():
+    """
+    Loads event_datafile_new.csv into the songs_by_session_item, songs_by_user_item
+    and users_by_title tables, reading the file once.
+    With --event-data, the daily event files are merged and loaded on the fly instead,
+    without writing event_datafile_new.csv.
+    """
+    parser = argparse.ArgumentParser(description='Load the Sparkify events into Cassandra')
+    parser.add_argument('--file', default=EVENT_FILE, help='denormalized event CSV file')
+    parser.add_argument('--event-data', default=None,
+                        help='directory of daily event CSV files to stream instead of --file')
+    parser.add_argument('--hosts', nargs='+', default=['127.0.0.1'], help='Cassandra contact points')
+    parser.add_argument('--keyspace', default=KEYSPACE, help='keyspace of the tables')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY,
+                        help='maximum number of requests in flight')
+    parser.add_argument('--batch-rows', type=int, default=BATCH_ROWS,
+                        help='maximum number of rows per unlogged batch, 1 to disable the batches')
+    args = parser.parse_args()
+
+    # the driver is only needed against a cluster, see standin.py
+    from cassandra.cluster import Cluster
+
+    cluster = Cluster(args.hosts)
+    session = cluster.connect()
+    try:
+        create_tables(session, args.keyspace)
+
+        if args.event_data:
+            events = stream_events(get_files(args.event_data))
+        else:
+            events = read_event_file(args.file)
+
+        start = time.perf_counter()
+        stats = load_events(session, events, args.concurrency, args.batch_rows)
+        print_load_stats(stats, time.perf_counter() - start)
+    finally:
+        session.shutdown()
+        cluster.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+import os
+import csv
+import glob
+import queue
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+EVENT_DATA = 'event_data'
+EVENT_FILE = 'event_datafile_new.csv'
+
+# columns of event_datafile_new.csv
+EVENT_COLUMNS = ['artist', 'firstName', 'gender', 'itemInSession', 'lastName', 'length',
+                 'level', 'location', 'sessionId', 'song', 'userId']
+# indices of EVENT_COLUMNS in the daily event files
+EVENT_INDICES = (0, 2, 3, 4, 5, 6, 7, 8, 12, 13, 16)
+
+# number of events per batch passed from the reading threads to the consumer
+BATCH_ROWS = 1000
+# number of daily files read ahead of the consumer
+READ_WORKERS = 4
+# number of batches a reading thread may buffer ahead of the consumer
+READ_AHEAD_BATCHES = 2
+
+# LF line endings, like the committed event_datafile_new.csv
+csv.register_dialect('myDialect', quoting=csv.QUOTE_ALL, skipinitialspace=True, lineterminator='\n')
+
+
+def get_files(filepath=EVENT_DATA):
+    """
+    Returns the sorted paths of the daily event CSV files of a directory.
+    """
+    return sorted(glob.glob(os.path.join(filepath, '*.csv')))
+
+
+def read_event_batches(filepath, batch_rows=BATCH_ROWS):
+    """
+    This generator reads a daily event CSV file and yields its events in batches
+    of at most `batch_rows` tuples projected on EVENT_COLUMNS.
+    Events without artist, i.e. other pages than NextSong, are dropped on the fly.
+
+    INPUTS:
+    * filepath the file path to the daily event file
+    * batch_rows the maximum number of events per batch
+    """
+    batch = []
+    with open(filepath, 'r', encoding='utf8', newline='') as csvfile:
+        csvreader = csv.reader(csvfile)
+        next(csvreader, None)
+        for row in csvreader:
+            if row[0] == '':
+                continue
+            batch.append(tuple(row[i] for i in EVENT_INDICES))
+            if len(batch) == batch_rows:
+                yield batch
+                batch = []
+
+    if batch:
+        yield batch
+
+
+def stream_events(filepaths, workers=READ_WORKERS, batch_rows=BATCH_ROWS):
+    """
+    This generator yields the projected events of many daily files, in file order.
+    Up to `workers` files are read in parallel by threads, each one buffering at most
+    READ_AHEAD_BATCHES batches, so memory is bounded by the batch size and the number
+    of workers, not by the number of events.
+
+    INPUTS:
+    * filepaths the list of daily event file paths
+    * workers the number of files read in parallel
+    * batch_rows the maximum number of events per batch
+    """
+    done = object()
+    stop = threading.Event()
+    queues = [queue.Queue(READ_AHEAD_BATCHES) for _ in filepaths]
+
+    def put(q, item):
+        # gives up once the consumer has stopped, instead of blocking forever
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read(filepath, q):
+        try:
+            for batch in read_event_batches(filepath, batch_rows):
+                if not put(q, batch):
+                    return
+        except Exception as e:
+            put(q, e)
+        else:
+            put(q, done)
+
+    with ThreadPoolExecutor(max(1, workers)) as executor:
+        try:
+            # the executor starts the files in order, so the file consumed is always being read
+            for filepath, q in zip(filepaths, queues):
+                executor.submit(read, filepath, q)
+
+            for q in queues:
+                while True:
+                    item = q.get()
+                    if item is done:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    yield from item
+        finally:
+            stop.set()
+
+
+def write_event_file(events, filepath=EVENT_FILE):
+    """
+    This function writes events to the denormalized event CSV file as they come.
+    The file only depends on the events: quoted fields and LF line endings on every platform.
+
+    INPUTS:
+    * events iterable of events projected on EVENT_COLUMNS
+    * filepath the output file path
+
+    OUTPUT:
+    * the number of events written
+    """
+    num_rows = 0
+    with open(filepath, 'w', encoding='utf8', newline='') as f:
+        writer = csv.writer(f, dialect='myDialect')
+        writer.writerow(EVENT_COLUMNS)
+        for row in events:
+            writer.writerow(row)
+            num_rows += 1
+
+    return num_rows
+
+
+def main():
+    """
+    Merges the daily event files of event_data into event_datafile_new.csv.
+    """
+    parser = argparse.ArgumentParser(description='Merge the Sparkify daily event files')
+    parser.add_argument('--input', default=EVENT_DATA, help='directory of the daily event CSV files')
+    parser.add_argument('--output', default=EVENT_FILE, help='denormalized event CSV file')
+    parser.add_argument('--workers', type=int, default=READ_WORKERS, help='number of files read in parallel')
+    args = parser.parse_args()
+
+    filepaths = get_files(args.input)
+    num_rows = write_event_file(stream_events(filepaths, args.workers), args.output)
+    print('{} events of {} files written to {}'.format(num_rows, len(filepaths), args.output))
+
+
+if __name__ == "__main__":
+    main()
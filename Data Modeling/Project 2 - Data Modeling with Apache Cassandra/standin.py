@@ -0,0 +1,167 @@
+import re
+import time
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# number of threads serving the asynchronous requests of a stand-in session
+STANDIN_WORKERS = 8
+
+PreparedInsert = namedtuple('PreparedInsert', ['table', 'columns'])
+PreparedSelect = namedtuple('PreparedSelect', ['table', 'columns', 'where'])
+TableSchema = namedtuple('TableSchema', ['partition_key', 'clustering'])
+
+
+def parse_primary_key(text):
+    """
+    Returns the partition key and clustering columns of a PRIMARY KEY clause,
+    e.g. '(user_id, session_id), item' -> (['user_id', 'session_id'], ['item']).
+    """
+    text = text.strip()
+    if text.startswith('('):
+        end = text.index(')')
+        partition_key = [c.strip() for c in text[1:end].split(',')]
+        rest = text[end + 1:]
+    else:
+        partition_key, _, rest = text.partition(',')
+        partition_key = [partition_key.strip()]
+
+    return partition_key, [c.strip() for c in rest.split(',') if c.strip()]
+
+
+class StandInSession:
+    """
+    In-process stand-in for a Cassandra session, understanding the statements of
+    cql_queries.py: each table is a dict of partitions keyed by the partition key,
+    each partition a dict of rows keyed by the clustering columns and read back
+    in clustering order. Requests are served by a thread pool, after an optional
+    simulated round-trip latency, so that the loader and the benchmark can run
+    without a Cassandra node.
+    """
+
+    def __init__(self, latency=0.0, workers=STANDIN_WORKERS):
+        """
+        INPUTS:
+        * latency the simulated round-trip latency of every request, in seconds
+        * workers the number of threads serving the asynchronous requests
+        """
+        self.latency = latency
+        self.schemas = {}
+        self.tables = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(workers)
+
+    def set_keyspace(self, keyspace):
+        """
+        The stand-in has a single keyspace.
+        """
+
+    def shutdown(self):
+        """
+        Stops the threads serving the asynchronous requests.
+        """
+        self.executor.shutdown()
+
+    def prepare(self, query):
+        """
+        Parses an INSERT or a SELECT with equality conditions on `?` markers.
+        """
+        query = ' '.join(query.split())
+        match = re.match(r'INSERT INTO (\w+) \(([^)]*)\)', query, re.I)
+        if match:
+            return PreparedInsert(match.group(1), [c.strip() for c in match.group(2).split(',')])
+
+        match = re.match(r'SELECT (.*) FROM (\w+) WHERE (.*)$', query, re.I)
+        if match:
+            where = [condition.split('=')[0].strip() for condition in re.split(r' AND ', match.group(3), flags=re.I)]
+            return PreparedSelect(match.group(2), [c.strip() for c in match.group(1).split(',')], where)
+
+        raise ValueError('Unsupported statement: {}'.format(query))
+
+    def execute(self, query, parameters=None):
+        """
+        Runs a DDL statement of cql_queries.py or a prepared statement,
+        returning the selected rows as tuples.
+        """
+        if self.latency:
+            time.sleep(self.latency)
+
+        if isinstance(query, str):
+            return self.execute_ddl(' '.join(query.split()))
+        if isinstance(query, PreparedInsert):
+            self.insert(query, [parameters])
+            return []
+        return self.select(query, parameters)
+
+    def execute_async(self, query, parameters=None):
+        """
+        Runs execute in the thread pool, returning a future.
+        """
+        return self.executor.submit(self.execute, query, parameters)
+
+    def execute_ddl(self, query):
+        """
+        Creates or drops a table; keyspaces are ignored.
+        """
+        match = re.match(r'CREATE TABLE (?:IF NOT EXISTS )?(\w+) \((.*)\)$', query, re.I)
+        if match:
+            primary_key = re.search(r'PRIMARY KEY \((.*)\)', match.group(2), re.I).group(1)
+            with self.lock:
+                if match.group(1) not in self.schemas:
+                    self.schemas[match.group(1)] = TableSchema(*parse_primary_key(primary_key))
+                    self.tables[match.group(1)] = {}
+            return []
+
+        match = re.match(r'DROP TABLE (?:IF EXISTS )?(\w+)$', query, re.I)
+        if match:
+            with self.lock:
+                self.schemas.pop(match.group(1), None)
+                self.tables.pop(match.group(1), None)
+            return []
+
+        if re.match(r'CREATE KEYSPACE', query, re.I):
+            return []
+
+        raise ValueError('Unsupported statement: {}'.format(query))
+
+    def insert(self, statement, rows):
+        """
+        Upserts rows of values ordered like the columns of the prepared INSERT.
+        """
+        schema = self.schemas[statement.table]
+        with self.lock:
+            table = self.tables[statement.table]
+            for values in rows:
+                row = dict(zip(statement.columns, values))
+                partition = table.setdefault(tuple(row[c] for c in schema.partition_key), {})
+                partition[tuple(row[c] for c in schema.clustering)] = row
+
+    def select(self, statement, parameters):
+        """
+        Reads one partition, filtered on a prefix of the clustering columns like Cassandra.
+        """
+        schema = self.schemas[statement.table]
+        values = dict(zip(statement.where, parameters))
+        if any(c not in values for c in schema.partition_key):
+            raise ValueError('The partition key of {} must be restricted'.format(statement.table))
+
+        with self.lock:
+            partition = self.tables[statement.table].get(tuple(values[c] for c in schema.partition_key), {})
+            rows = [partition[key] for key in sorted(partition)]
+
+        prefix = [c for c in schema.clustering if c in values]
+        return [tuple(row[c] for c in statement.columns) for row in rows
+                if all(row[c] == values[c] for c in prefix)]
+
+
+def execute_group_async(session, statement, rows):
+    """
+    Stand-in counterpart of loader.execute_group_async: the rows of one partition
+    are applied as a single request.
+    """
+    def execute():
+        if session.latency:
+            time.sleep(session.latency)
+        session.insert(statement, rows)
+
+    return session.executor.submit(execute)
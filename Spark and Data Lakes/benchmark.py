@@ -0,0 +1,417 @@
+import os
+import re
+import json
+import time
+import argparse
+import platform
+import subprocess
+import urllib.request
+from datetime import datetime
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import udf
+from pyspark.sql.types import TimestampType, DateType
+import pyspark.sql.functions as F
+import pandas as pd
+
+import etl
+from transforms import with_start_time
+
+# first timestamp of the synthetic events, in epoch milliseconds (2018-11-01)
+FIRST_TS = 1541030400000
+
+# song_data and log_data bundled with the PostgreSQL project
+SAMPLE_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                           'Data Modeling',
+                           'Project 1 - Data Modeling with PostgreSQL',
+                           'data')
+
+# metrics of the stages of the status API summed for each ETL stage
+STAGE_METRICS = {'executor_run_ms': 'executorRunTime',
+                 'input_bytes': 'inputBytes',
+                 'input_rows': 'inputRecords',
+                 'output_bytes': 'outputBytes',
+                 'output_rows': 'outputRecords',
+                 'shuffle_read_bytes': 'shuffleReadBytes',
+                 'shuffle_write_bytes': 'shuffleWriteBytes',
+                 'memory_spill_bytes': 'memoryBytesSpilled',
+                 'disk_spill_bytes': 'diskBytesSpilled'}
+
+OUTPUT_TABLES = ['songs', 'artists', 'users', 'time', 'songplays']
+
+# plan nodes reading files, e.g. "Scan json " (FileSourceScanExec)
+FILE_SCAN_RE = re.compile(r'^Scan (json|parquet|csv|text|orc)\b')
+
+
+def create_local_spark_session(cores):
+    """
+        Creates a local-mode spark session with `cores` worker threads,
+        its UI enabled for the status API read by stage_metrics
+    """
+
+    return SparkSession \
+        .builder \
+        .master('local[{}]'.format(cores)) \
+        .appName('sparkify-benchmark') \
+        .config("spark.sql.session.timeZone", "UTC") \
+        .config("spark.ui.showConsoleProgress", "false") \
+        .getOrCreate()
+
+
+def with_start_time_udf(df):
+    """
+        Former conversion of etl.py: two Python UDFs called for every row
+    """
+
+    df = df.withColumn("ts", df.ts.cast('double'))
+    get_timestamp = udf(lambda x: pd.Timestamp(x*1000000), TimestampType())
+    df = df.withColumn("start_time", get_timestamp("ts"))
+    get_datetime = udf(lambda x: pd.Timestamp(x*1000000), DateType())
+    return df.withColumn("start_date", get_datetime("ts"))
+
+
+def synthetic_events(spark, rows):
+    """
+        Returns a frame of `rows` events with a string ts column,
+        one event every 10 seconds from 2018-11-01, like the log data
+    """
+
+    return spark.range(rows) \
+                .select((F.lit(FIRST_TS) + F.col('id') * 10000)
+                        .cast('string').alias('ts'))
+
+
+def benchmark_timestamps(spark, rows, repeat):
+    """
+        Times the UDF and native conversions of ts over synthetic events
+
+        Parameters:
+        spark: spark session
+        rows: number of events
+        repeat: number of timed runs of each conversion, the best one is kept
+
+        Returns:
+        dict of conversion name to (best seconds, rows per second)
+    """
+
+    df = synthetic_events(spark, rows).cache()
+    df.count()
+
+    results = {}
+    for name, convert in [('udf', with_start_time_udf), ('native', with_start_time)]:
+        converted = convert(df).agg(F.min('start_time'), F.max('start_time'),
+                                    F.countDistinct('start_date'))
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            converted.collect()
+            timings.append(time.perf_counter() - start)
+        results[name] = (min(timings), rows / min(timings))
+
+    df.unpersist()
+    return results
+
+
+def git_version():
+    """
+        Returns the short hash of the current commit, or None outside
+        of a git checkout
+    """
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL)\
+                         .decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def scale_sample(spark, sample_data, scaled_data, scale):
+    """
+        Writes `scale` copies of the sample song and log data as JSON
+        files readable by etl.py. Copy i > 0 of a song gets the title
+        "<title> #i" and the song_id "<song_id>i", and copy i of an event
+        plays that copy in session sessionId + i * 1000000: each copy adds
+        as many songs and song plays as the sample, with the same artists,
+        users and timestamps
+
+        Parameters:
+        spark: spark session
+        sample_data: path holding song_data and log_data
+        scaled_data: path the scaled song_data and log_data are written to
+        scale: number of copies
+    """
+
+    copies = spark.range(scale).select(F.col('id').cast('int').alias('copy'))
+    suffix = F.when(F.col('copy') > 0,
+                    F.concat(F.lit(' #'), F.col('copy').cast('string')))\
+              .otherwise(F.lit(''))
+
+    songs = spark.read.json(os.path.join(sample_data, 'song_data/*/*/*/*.json'),
+                            schema=etl.SongDataSchema)
+    songs.crossJoin(copies)\
+         .withColumn('title', F.concat('title', suffix))\
+         .withColumn('song_id', F.concat('song_id',
+                                         F.col('copy').cast('string')))\
+         .drop('copy')\
+         .write.json(os.path.join(scaled_data, 'song_data/S/C/A'), 'overwrite')
+
+    events = spark.read.json(os.path.join(sample_data, 'log_data/*/*/*.json'),
+                             schema=etl.LogDataSchema)
+    events.crossJoin(copies)\
+          .withColumn('song', F.concat('song', suffix))\
+          .withColumn('sessionId', F.col('sessionId') + F.col('copy') * 1000000)\
+          .drop('copy')\
+          .write.json(os.path.join(scaled_data, 'log_data/scaled/x{}'.format(scale)),
+                      'overwrite')
+
+
+def status_api(spark, path):
+    """
+        Returns the JSON of a path of the status API of the application,
+        e.g. 'jobs', fed by the listener of the Spark UI
+    """
+
+    url = '{}/api/v1/applications/{}/{}'.format(spark.sparkContext.uiWebUrl,
+                                                spark.sparkContext.applicationId,
+                                                path)
+    with urllib.request.urlopen(url) as response:
+        return json.load(response)
+
+
+def stage_metrics(spark, group, timeout=30):
+    """
+        Returns the metrics of the stages run by the jobs of a job group:
+        number of stages, sum of their durations and of the STAGE_METRICS,
+        and the duration of each stage
+
+        The listener updates the status store asynchronously: the jobs of
+        the group are polled until they have all ended
+
+        Parameters:
+        spark: spark session
+        group: job group set by SparkContext.setJobGroup
+        timeout: seconds to wait for the status store
+    """
+
+    deadline = time.time() + timeout
+    while True:
+        jobs = [job for job in status_api(spark, 'jobs')
+                if job.get('jobGroup') == group]
+        if all(job['status'] != 'RUNNING' for job in jobs) \
+                or time.time() > deadline:
+            break
+        time.sleep(0.5)
+
+    stage_ids = {stage_id for job in jobs for stage_id in job['stageIds']}
+    stages = [stage for stage in status_api(spark, 'stages?status=complete')
+              if stage['stageId'] in stage_ids]
+
+    metrics = {name: sum(stage.get(field, 0) for stage in stages)
+               for name, field in STAGE_METRICS.items()}
+    metrics['jobs'] = len(jobs)
+    metrics['stages'] = len(stages)
+    metrics['stage_durations_ms'] = {}
+    for stage in stages:
+        duration = (parse_status_time(stage['completionTime']) -
+                    parse_status_time(stage['submissionTime']))
+        metrics['stage_durations_ms']['{} {}'.format(stage['stageId'],
+                                                     stage['name'])] = \
+            int(duration.total_seconds() * 1000)
+    metrics['stage_ms'] = sum(metrics['stage_durations_ms'].values())
+    metrics['input_scans'] = file_scans(spark, {job['jobId'] for job in jobs})
+    return metrics
+
+
+def file_scans(spark, job_ids):
+    """
+        Returns the number of file scans run by the SQL executions of the
+        jobs: the scan nodes of their plans which output rows in them.
+        A scan under a persisted frame is listed again by each execution
+        reading the frame, but outputs rows only in the one materializing it
+
+        Parameters:
+        spark: spark session
+        job_ids: ids of the jobs
+    """
+
+    scans = 0
+    for execution in status_api(spark, 'sql?details=true'):
+        execution_jobs = set(execution.get('successJobIds', []) +
+                             execution.get('failedJobIds', []))
+        if not execution_jobs & job_ids:
+            continue
+        for node in execution.get('nodes', []):
+            if not FILE_SCAN_RE.match(node['nodeName']):
+                continue
+            rows = [metric['value'] for metric in node.get('metrics', [])
+                    if metric['name'] == 'number of output rows']
+            if rows and rows[0].replace(',', '').strip() not in ('', '0'):
+                scans += 1
+    return scans
+
+
+def parse_status_time(value):
+    """
+        Returns the datetime of a time of the status API,
+        e.g. 2018-11-01T10:00:00.000GMT
+    """
+
+    return datetime.strptime(value.replace('GMT', ''), '%Y-%m-%dT%H:%M:%S.%f')
+
+
+def benchmark_etl(spark, input_data, output_data):
+    """
+        Runs process_song_data and process_log_data of etl.py, each in a
+        job group of its own, and returns their metrics
+
+        Parameters:
+        spark: spark session
+        input_data: path holding song_data and log_data
+        output_data: path the tables are written to
+
+        Returns:
+        dict of ETL stage to its seconds and stage_metrics,
+        and dict of table to its rows
+    """
+
+    input_data = input_data.rstrip('/') + '/'
+    stages = {}
+
+    spark.sparkContext.setJobGroup('song_data', 'process_song_data')
+    start = time.perf_counter()
+    dfSongData = etl.load_song_catalog(spark, input_data, output_data)
+    etl.process_song_data(spark, dfSongData, output_data)
+    stages['song_data'] = {'sec': time.perf_counter() - start}
+
+    spark.sparkContext.setJobGroup('log_data', 'process_log_data')
+    start = time.perf_counter()
+    etl.process_log_data(spark, input_data, output_data, dfSongData)
+    stages['log_data'] = {'sec': time.perf_counter() - start}
+
+    spark.sparkContext.setJobGroup('check', 'output rows')
+    dfSongData.unpersist()
+    for name in stages:
+        stages[name].update(stage_metrics(spark, name))
+
+    rows = {table: spark.read.parquet(os.path.join(output_data, table,
+                                                   table + '.parquet')).count()
+            for table in OUTPUT_TABLES}
+    return stages, rows
+
+
+def check_rows(rows, base_rows, scale):
+    """
+        Returns the differences between the output rows of a scaled run
+        and those expected from the run of the sample (scale 1): songs and
+        song plays grow with the scale, artists, users and time do not
+    """
+
+    expected = {table: base_rows[table] * (scale if table in ('songs', 'songplays') else 1)
+                for table in OUTPUT_TABLES}
+    return ['{}: {} rows, {} expected'.format(table, rows[table], expected[table])
+            for table in OUTPUT_TABLES if rows[table] != expected[table]]
+
+
+def run_etl_suite(spark, args):
+    """
+        Runs benchmark_etl over the sample data and each scale of it,
+        prints the metrics of each run and appends them as JSON lines
+        to the results file
+
+        Returns:
+        True if the output rows of every run are those expected,
+        and each ETL stage scanned its input once
+    """
+
+    ok = True
+    base_rows = None
+    for scale in args.scales:
+        if scale == 1:
+            input_data = args.sample_data
+        else:
+            input_data = os.path.join(args.work_dir, 'input_x{}'.format(scale))
+            scale_sample(spark, args.sample_data, input_data, scale)
+        output_data = os.path.join(args.work_dir, 'output_x{}'.format(scale))
+
+        stages, rows = benchmark_etl(spark, input_data, output_data)
+        errors = check_rows(rows, base_rows, scale) if base_rows else []
+        # each stage reads its input files once, the song catalog included
+        errors += ['{}: {} input scans, 1 expected'.format(name, metrics['input_scans'])
+                   for name, metrics in stages.items() if metrics['input_scans'] > 1]
+        if scale == 1:
+            base_rows = rows
+        ok = ok and not errors
+
+        result = {'timestamp': datetime.now().isoformat(timespec='seconds'),
+                  'version': git_version(),
+                  'python': platform.python_version(),
+                  'spark': spark.version,
+                  'params': {'suite': 'etl', 'scale': scale,
+                             'cores': args.cores},
+                  'stages': stages,
+                  'rows': rows,
+                  'errors': errors}
+        with open(args.output, 'a', encoding='utf8') as f:
+            f.write(json.dumps(result) + '\n')
+
+        print('scale {}: {}'.format(scale, ', '.join(
+            '{} {}'.format(table, count) for table, count in rows.items())))
+        for name, metrics in stages.items():
+            print('  {}: {:.2f} s, {} jobs, {} stages ({} ms), {} input scans, '
+                  'shuffle read {:.1f} MB, write {:.1f} MB, '
+                  'spill {:.1f} MB memory, {:.1f} MB disk, {} rows written'
+                  .format(name, metrics['sec'], metrics['jobs'],
+                          metrics['stages'], metrics['stage_ms'],
+                          metrics['input_scans'],
+                          metrics['shuffle_read_bytes'] / 1024 ** 2,
+                          metrics['shuffle_write_bytes'] / 1024 ** 2,
+                          metrics['memory_spill_bytes'] / 1024 ** 2,
+                          metrics['disk_spill_bytes'] / 1024 ** 2,
+                          metrics['output_rows']))
+        for error in errors:
+            print('  check failed: ' + error)
+
+    return ok
+
+
+def main():
+    """
+        Benchmarks on a local-mode spark session either the conversion
+        of ts to start_time and start_date (--suite timestamps), or
+        process_song_data and process_log_data of etl.py over the sample
+        data and scaled copies of it (--suite etl)
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark the Sparkify Spark transforms')
+    parser.add_argument('--suite', choices=['timestamps', 'etl'], default='timestamps',
+                        help='ts conversions, or the ETL stages of etl.py')
+    parser.add_argument('--rows', type=int, default=1000000, help='number of synthetic events')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs')
+    parser.add_argument('--cores', type=int, default=4, help='number of local worker threads')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10],
+                        help='numbers of copies of the sample data to run the ETL on')
+    parser.add_argument('--sample-data', default=SAMPLE_DATA,
+                        help='path holding the sample song_data and log_data')
+    parser.add_argument('--work-dir', default='benchmark_data',
+                        help='directory of the scaled data and of the tables written')
+    parser.add_argument('--output', default='benchmark_results.jsonl', help='JSON lines results file')
+    args = parser.parse_args()
+
+    spark = create_local_spark_session(args.cores)
+    if args.suite == 'etl':
+        # the checks of the scaled runs are relative to the sample run
+        args.scales = [1] + [scale for scale in args.scales if scale != 1]
+        ok = run_etl_suite(spark, args)
+        spark.stop()
+        raise SystemExit(0 if ok else 1)
+
+    results = benchmark_timestamps(spark, args.rows, args.repeat)
+    for name, (seconds, rows_per_sec) in results.items():
+        print('{}: {:.2f} s, {:.0f} rows/sec'.format(name, seconds, rows_per_sec))
+    print('native speedup: {:.1f}x'.format(results['udf'][0] / results['native'][0]))
+
+    spark.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,48 @@
+import argparse
 import configparser
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf, col
+from pyspark.sql.functions import col
 from pyspark.sql.functions import year, month, dayofmonth, \
                                   hour, weekofyear, date_format
 from pyspark.sql.types import StructType as R, StructField as Fld, \
     DoubleType as Dbl, StringType as Str, IntegerType as Int, \
     DateType as Date, FloatType as Flt, TimestampType
 import pyspark.sql.functions as F
-import pandas as pd
+from transforms import with_start_time, song_lookup, resolve_songplays, \
+    join_strategies, latest_users
+from layout import read_layouts, write_table, print_file_stats
 
 from pyspark.sql import SQLContext
 from pyspark import SparkContext
 
+# default data paths, overridden by INPUT_DATA and OUTPUT_DATA
+# in the [ETL] section of dl.cfg or by --input-data and --output-data
+INPUT_DATA = "s3a://udacity-dend/"
+OUTPUT_DATA = "s3a://project4-data-lake-s3/parquet/"
+
+# ETL options of dl.cfg, the job runs with their defaults if it is missing
 config = configparser.ConfigParser()
 config.read('dl.cfg')
 
-os.environ['AWS_ACCESS_KEY_ID'] = config['AWS']['AWS_ACCESS_KEY_ID']
-os.environ['AWS_SECRET_ACCESS_KEY'] = config['AWS']['AWS_SECRET_ACCESS_KEY']
+
+def export_credentials(config):
+    """
+        Exports the AWS credentials of the [AWS] section of a configuration
+        to the environment read by s3a, if it has one: otherwise the
+        credentials already in the environment (or none, for local paths)
+        are used
+
+        Parameters:
+        config: configparser.ConfigParser
+    """
+
+    if config.has_section('AWS'):
+        os.environ['AWS_ACCESS_KEY_ID'] = config['AWS']['AWS_ACCESS_KEY_ID']
+        os.environ['AWS_SECRET_ACCESS_KEY'] = \
+            config['AWS']['AWS_SECRET_ACCESS_KEY']
 
 
 def create_spark_session():
@@ -26,43 +50,115 @@ def create_spark_session():
         Creates the spark session
     """
 
+    # hadoop-aws must match the Hadoop version of Spark: 3.3.4 for Spark 3.4 and 3.5
     spark = SparkSession \
         .builder \
-        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
+        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:3.3.4") \
+        .config("spark.sql.session.timeZone", "UTC") \
+        .config("spark.sql.autoBroadcastJoinThreshold",
+                config.get('ETL', 'BROADCAST_THRESHOLD', fallback='10m')) \
         .getOrCreate()
     return spark
 
 
-def process_song_data(spark, input_data, output_data):
+# schema of the song data files
+SongDataSchema = R([
+    Fld("num_songs", Int()),
+    Fld("artist_id", Str()),
+    Fld("artist_latitude", Flt()),
+    Fld("artist_longitude", Flt()),
+    Fld("artist_location", Str()),
+    Fld("artist_name", Str()),
+    Fld("song_id", Str()),
+    Fld("title", Str()),
+    Fld("duration", Flt()),
+    Fld("year", Int())
+])
+
+
+# schema of the log data files
+LogDataSchema = R([
+    Fld("artist", Str()),
+    Fld("auth", Str()),
+    Fld("firstName", Str()),
+    Fld("gender", Str()),
+    Fld("itemInSession", Int()),
+    Fld("lastName", Str()),
+    Fld("length", Flt()),
+    Fld("level", Str()),
+    Fld("location", Str()),
+    Fld("method", Str()),
+    Fld("page", Str()),
+    Fld("registration", Flt()),
+    Fld("sessionId", Int()),
+    Fld("song", Str()),
+    Fld("status", Int()),
+    Fld("ts", Str()),
+    Fld("userAgent", Str()),
+    Fld("userId", Str())
+])
+
+# columns of the log data used by the users, time and songplays tables
+LOG_COLUMNS = ["artist", "firstName", "gender", "itemInSession", "lastName",
+               "length", "level", "location", "sessionId", "song", "ts",
+               "userAgent", "userId"]
+
+
+def load_song_catalog(spark, input_data, output_data, source='json'):
     """
-        Gets the song data from the s3 bucket and creates the
-        artists and songs tables
+        Reads the song catalog once per run and persists it, so that the
+        songs and artists tables and the songplays join all reuse the
+        same scan
 
         Parameters:
         spark: spark session
         input_data: input data path
         output_data: output data path
+        source: 'json' to read the raw song data,
+                'parquet' to read the songs and artists tables
+                already written to output_data
+
+        Returns:
+        data frame with the columns of the song data files
     """
 
-    # get filepath to song data file
-    song_data = input_data + 'song_data/*/*/*/*.json'
+    if source == 'parquet':
+        songs = spark.read.parquet(os.path.join(output_data,
+                                                'songs/songs.parquet'))
+        artists = spark.read.parquet(os.path.join(output_data,
+                                                  'artists/artists.parquet'))
+        dfSongData = songs.join(artists, on='artist_id', how='left')\
+                          .select("artist_id",
+                                  col("latitude").alias("artist_latitude"),
+                                  col("longitude").alias("artist_longitude"),
+                                  col("location").alias("artist_location"),
+                                  col("name").alias("artist_name"),
+                                  "song_id",
+                                  "title",
+                                  "duration",
+                                  "year")
+    else:
+        # get filepath to song data file
+        song_data = input_data + 'song_data/*/*/*/*.json'
+        dfSongData = spark.read.json(song_data, schema=SongDataSchema)
+
+    # read by two table writes and the songplays join: kept in memory,
+    # spilled to disk rather than re-read from the source if it does not fit
+    return dfSongData.persist(StorageLevel.MEMORY_AND_DISK)
+
+
+def process_song_data(spark, dfSongData, output_data, layouts=None):
+    """
+        Creates the artists and songs tables from the song catalog
 
-    # define required schema
-    SongDataSchema = R([
-        Fld("num_songs", Int()),
-        Fld("artist_id", Str()),
-        Fld("artist_latitude", Flt()),
-        Fld("artist_longitude", Flt()),
-        Fld("artist_location", Str()),
-        Fld("artist_name", Str()),
-        Fld("song_id", Str()),
-        Fld("title", Str()),
-        Fld("duration", Flt()),
-        Fld("year", Int())
-    ])
+        Parameters:
+        spark: spark session
+        dfSongData: song catalog returned by load_song_catalog
+        output_data: output data path
+        layouts: table layouts, see layout.read_layouts
+    """
 
-    # read song data file
-    dfSongData = spark.read.json(song_data, schema=SongDataSchema)
+    layouts = layouts or read_layouts(config)
 
     # extract columns to create songs table
     songs_table = dfSongData.select("song_id",
@@ -71,13 +167,14 @@ def process_song_data(spark, input_data, output_data):
                                     "year",
                                     "duration")\
                             .dropDuplicates()
-    songs_table.createOrReplaceTempView('songs')
 
-    # write songs table to parquet files partitioned by year and artist
-    songs_table.write.partitionBy('year', 'artist_id')\
-               .parquet(os.path.join(output_data,
-                                     'songs/songs.parquet'),
-                        'overwrite')
+    # write songs table to parquet files with its layout
+    # (partitioned by year by default)
+    print_file_stats('songs',
+                     write_table(songs_table,
+                                 os.path.join(output_data,
+                                              'songs/songs.parquet'),
+                                 layouts['songs']))
 
     # extract columns to create artists table
     artists_table = dfSongData.select("artist_id",
@@ -87,149 +184,225 @@ def process_song_data(spark, input_data, output_data):
                                       col("artist_longitude")
                                       .alias("longitude"))\
                               .dropDuplicates()
-    artists_table.createOrReplaceTempView('artists')
 
     # write artists table to parquet files
-    artists_table.write.parquet(os.path.join(output_data,
-                                             'artists/artists.parquet'),
-                                'overwrite')
+    print_file_stats('artists',
+                     write_table(artists_table,
+                                 os.path.join(output_data,
+                                              'artists/artists.parquet'),
+                                 layouts['artists']))
 
 
-def process_log_data(spark, input_data, output_data):
+def path_exists(spark, path):
+    """
+        Returns whether a path (local, hdfs or s3a) exists
+
+        Parameters:
+        spark: spark session
+        path: path of a file or directory
+    """
+
+    jvm_path = spark.sparkContext._jvm.org.apache.hadoop.fs.Path(path)
+    fs = jvm_path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration())
+    return fs.exists(jvm_path)
+
+
+def log_data_paths(spark, input_data, start=None, end=None):
+    """
+        Returns the log data files to read: all of them, or only the
+        daily files (log_data/YYYY/MM/YYYY-MM-DD-events.json) of the
+        dates from start to end, skipping the days without a file
+
+        Parameters:
+        spark: spark session
+        input_data: input data path
+        start: first date (datetime.date) of an incremental run, or None
+        end: last date of an incremental run
+    """
+
+    if start is None:
+        return [input_data + 'log_data/*/*/*.json']
+
+    paths = []
+    day = start
+    while day <= end:
+        path = input_data + 'log_data/{:%Y/%m/%Y-%m-%d}-events.json'.format(day)
+        if path_exists(spark, path):
+            paths.append(path)
+        day += timedelta(days=1)
+    return paths
+
+
+def affected_months(start, end):
+    """
+        Returns the year * 100 + month values of the dates from start to end
+    """
+
+    months = set()
+    day = start
+    while day <= end:
+        months.add(day.year * 100 + day.month)
+        day += timedelta(days=1)
+    return sorted(months)
+
+
+def read_existing(spark, path, months=None):
+    """
+        Returns the rows already written to a table, only those of the
+        given year/month partitions if months is set (partition pruning),
+        or None if the table was never written
+
+        Parameters:
+        spark: spark session
+        path: path of the table
+        months: year * 100 + month values, see affected_months
+    """
+
+    if not path_exists(spark, path):
+        return None
+    existing = spark.read.parquet(path)
+    if months is not None:
+        existing = existing.where((col('year') * 100 + col('month'))
+                                  .isin(months))
+    return existing
+
+
+def process_log_data(spark, input_data, output_data, dfSongData,
+                     start=None, end=None, layouts=None):
     """
         Gets the log data from the s3 bucket and creates the
         users, time and songplays tables
 
+        With start and end, only the log files of those dates are read:
+        the year/month partitions of time and songplays they fall in are
+        merged with the rows already written and overwritten, the other
+        partitions are left as they are, and users are merged by user_id
+
         Parameters:
         spark: spark session
         input_data: input data path
         output_data: output data path
+        dfSongData: song catalog returned by load_song_catalog
+        start: first date (datetime.date) of an incremental run, or None
+        end: last date of an incremental run
+        layouts: table layouts, see layout.read_layouts
     """
 
-    # get filepath to log data file
-    log_data = input_data + 'log_data/*.json'
-
-    # define required schema
-    LogDataSchema = R([
-        Fld("artist", Str()),
-        Fld("auth", Str()),
-        Fld("firstName", Str()),
-        Fld("gender", Str()),
-        Fld("itemInSession", Int()),
-        Fld("lastName", Str()),
-        Fld("length", Flt()),
-        Fld("level", Str()),
-        Fld("location", Str()),
-        Fld("method", Str()),
-        Fld("page", Str()),
-        Fld("registration", Flt()),
-        Fld("sessionId", Int()),
-        Fld("song", Str()),
-        Fld("status", Int()),
-        Fld("ts", Str()),
-        Fld("userAgent", Str()),
-        Fld("userId", Str())
-    ])
-
-    # read log data file
-    dfLogData = spark.read.json(log_data, schema=LogDataSchema)
+    layouts = layouts or read_layouts(config)
+    incremental = start is not None
 
-    # filter by actions for song plays
-    dfLogData = dfLogData.select('*').where(dfLogData.page == 'NextSong')
+    # get filepaths to log data files
+    log_data = log_data_paths(spark, input_data, start, end)
+    if not log_data:
+        print('no log data from {} to {}'.format(start, end))
+        return
 
-    # extract columns for users table
-    users_table = dfLogData.select(col("userId").alias("user_id"),
-                                   col("firstName").alias("first_name"),
-                                   col("lastName").alias("last_name"),
-                                   "gender",
-                                   "level")\
-                           .dropDuplicates()
-    users_table.createOrReplaceTempView('users')
+    # read log data file, keeping the song plays and
+    # the columns of the tables only
+    dfLogData = spark.read.json(log_data, schema=LogDataSchema)
+    dfLogData = dfLogData.where(dfLogData.page == 'NextSong')\
+                         .select(*LOG_COLUMNS)
+
+    # create timestamp and date columns from original timestamp column
+    # (epoch milliseconds) with native expressions, in a single projection
+    dfLogData = with_start_time(dfLogData)
+
+    # the log data is scanned once: the three tables are derived from the
+    # song plays persisted by the first write
+    dfLogData = dfLogData.persist(StorageLevel.MEMORY_AND_DISK)
+
+    # extract columns for users table: one row per user_id,
+    # with the level of their latest event
+    users_table = latest_users(dfLogData)
+    users_path = os.path.join(output_data, 'users/users.parquet')
+
+    # merge the users already written: the users of these events replace
+    # theirs, the others are kept (runs are expected in date order)
+    existing_users = read_existing(spark, users_path) if incremental else None
+    if existing_users is not None:
+        users_table = existing_users.join(users_table.select('user_id'),
+                                          on='user_id',
+                                          how='left_anti')\
+                                    .unionByName(users_table)\
+                                    .localCheckpoint()
 
     # write users table to parquet files
-    users_table.write.parquet(os.path.join(output_data,
-                                           'users/users.parquet'),
-                              'overwrite')
+    print_file_stats('users',
+                     write_table(users_table, users_path, layouts['users']))
 
-    # convert ts to double
-    dfLogData = dfLogData.withColumn("ts", dfLogData.ts.cast(Dbl()))
-
-    # create timestamp column from original timestamp column
-    get_timestamp = udf(lambda x: pd.Timestamp(x*1000000), TimestampType())
-    dfLogData = dfLogData.withColumn("start_time", get_timestamp("ts"))
-
-    # create datetime column from original timestamp column
-    get_datetime = udf(lambda x: pd.Timestamp(x*1000000), Date())
-    dfLogData = dfLogData.withColumn("start_date", get_datetime("ts"))
-
-    # extract columns to create time table
+    # extract columns to create time table, one row per start_time
     time_table = dfLogData.select("start_time")\
+                          .dropDuplicates(["start_time"])\
                           .withColumn("hour", F.hour(col("start_time")))\
                           .withColumn("day", F.dayofmonth(col("start_time")))\
                           .withColumn("week", F.weekofyear(col("start_time")))\
                           .withColumn("month", F.month(col("start_time")))\
                           .withColumn("year", F.year(col("start_time")))\
                           .withColumn("weekday",
-                                      F.dayofweek(col("start_time")))\
-                          .dropDuplicates()
+                                      F.dayofweek(col("start_time")))
     time_table.createOrReplaceTempView('time')
+    time_path = os.path.join(output_data, 'time/time.parquet')
+
+    if incremental:
+        # merge the rows already written to the affected months
+        # and overwrite these partitions only
+        months = affected_months(start, end)
+        existing_time = read_existing(spark, time_path, months)
+        if existing_time is not None:
+            time_table = existing_time.unionByName(time_table)\
+                                      .dropDuplicates(['start_time'])\
+                                      .localCheckpoint()
 
     # write time table to parquet files partitioned by year and month
-    time_table.write.partitionBy('year', 'month') \
-                    .parquet(os.path.join(output_data,
-                                          'time/time.parquet'),
-                             'overwrite')
-
-    # reset df song_data
-    song_data = input_data + 'song_data/*/*/*/*.json'
-
-    # define required schema
-    SongDataSchema = R([
-        Fld("num_songs", Int()),
-        Fld("artist_id", Str()),
-        Fld("artist_latitude", Flt()),
-        Fld("artist_longitude", Flt()),
-        Fld("artist_location", Str()),
-        Fld("artist_name", Str()),
-        Fld("song_id", Str()),
-        Fld("title", Str()),
-        Fld("duration", Flt()),
-        Fld("year", Int())
-    ])
-
-    # read in song data to use for songplays table
-    dfSongData = spark.read.json(song_data, schema=SongDataSchema)
-
-    # format and join
-    dfSongData = dfSongData.selectExpr('title as song_title',
-                                       '*')
-    dfLogData = dfLogData.selectExpr('artist as artist_name',
-                                     'song as song_title',
-                                     '*')
-    All = dfLogData.join(dfSongData,
-                         on=['song_title', 'artist_name'],
-                         how='outer')
+    print_file_stats('time',
+                     write_table(time_table, time_path, layouts['time'],
+                                 dynamic=incremental))
+
+    # resolve song_id and artist_id of every event from the deduplicated
+    # song lookup, broadcast to the executors: the events are not shuffled
+    # and the unplayed songs of the catalog are not brought in
+    songplays = resolve_songplays(dfLogData,
+                                  song_lookup(dfSongData),
+                                  config.getboolean('ETL', 'BROADCAST_SONGS',
+                                                    fallback=True))
 
     # extract columns from joined song and log datasets
     # to create songplays table
-    songplays_table = All.select("start_time",
-                                 col("userId").alias("user_id"),
-                                 "level",
-                                 "song_id",
-                                 "artist_id",
-                                 col("SessionId").alias("session_id"),
-                                 "artist_location",
-                                 col("userAgent").alias("user_agent"),
-                                 .withColumn("year", F.year(col("start_time")))
-                                 .withColumn("month",
-                                             month(col('start_time'))))
-    songplays_table.createOrReplaceTempView('songplays')
+    # songplay_id is a hash of the event, so that reloading a day
+    # gives its song plays the same ids
+    songplays_table = songplays.select(
+        F.xxhash64("ts", "userId", "sessionId", "itemInSession")
+         .alias("songplay_id"),
+        "start_time",
+        col("userId").alias("user_id"),
+        "level",
+        "song_id",
+        "artist_id",
+        col("sessionId").alias("session_id"),
+        "location",
+        col("userAgent").alias("user_agent"))\
+        .withColumn("year", F.year(col("start_time")))\
+        .withColumn("month", F.month(col("start_time")))
+    print('songplays joins: {}'.format(join_strategies(songplays_table)))
+
+    songplays_path = os.path.join(output_data, 'songplays/songplays.parquet')
+
+    if incremental:
+        # keep the song plays already written to the affected months,
+        # except those of the reloaded dates, and overwrite these partitions
+        existing_songplays = read_existing(spark, songplays_path, months)
+        if existing_songplays is not None:
+            reloaded = F.to_date(col('start_time')).between(start, end)
+            songplays_table = existing_songplays.where(~reloaded)\
+                                                .unionByName(songplays_table)\
+                                                .localCheckpoint()
 
     # write songplays table to parquet files partitioned by year and month
-    songplays_table.write.partitionBy('year', 'month')\
-                         .parquet(os.path.join(output_data,
-                                               'songplays/songplays.parquet'),
-                                  'overwrite')
+    print_file_stats('songplays',
+                     write_table(songplays_table, songplays_path,
+                                 layouts['songplays'], dynamic=incremental))
+
+    dfLogData.unpersist()
 
 
 def main():
@@ -238,13 +411,54 @@ def main():
         2. Define the basic data paths (write and read)
         3. Create the star schema with both functions and
            write them to the s3 bucket
+
+        With --start and --end, only the log data of these dates is
+        loaded into the tables already written
     """
 
+    parser = argparse.ArgumentParser(description='Sparkify data lake ETL')
+    parser.add_argument('--start', default=None,
+                        help='first log date (YYYY-MM-DD) of an incremental run')
+    parser.add_argument('--end', default=None,
+                        help='last log date (YYYY-MM-DD), defaults to --start')
+    parser.add_argument('--input-data', default=None,
+                        help='path holding song_data and log_data '
+                             '(s3a://, hdfs:// or local)')
+    parser.add_argument('--output-data', default=None,
+                        help='path the tables are written to')
+    parser.add_argument('--config', default=None,
+                        help='configuration read over dl.cfg')
+    args = parser.parse_args()
+
+    if args.config:
+        config.read(args.config)
+    export_credentials(config)
+
+    start = end = None
+    if args.start:
+        start = datetime.strptime(args.start, '%Y-%m-%d').date()
+        end = datetime.strptime(args.end or args.start, '%Y-%m-%d').date()
+
     spark = create_spark_session()
-    input_data = "s3a://udacity-dend/"
-    output_data = "s3a://project4-data-lake-s3/parquet/"
-    process_song_data(spark, input_data, output_data)
-    process_log_data(spark, input_data, output_data)
+    input_data = (args.input_data or
+                  config.get('ETL', 'INPUT_DATA', fallback=INPUT_DATA))
+    output_data = (args.output_data or
+                   config.get('ETL', 'OUTPUT_DATA', fallback=OUTPUT_DATA))
+    # the input paths are built by appending to input_data
+    input_data = input_data.rstrip('/') + '/'
+
+    # json: read the raw song data and write the songs and artists tables,
+    # parquet: reuse the songs and artists tables already written
+    song_source = config.get('ETL', 'SONG_CATALOG', fallback='json')
+
+    layouts = read_layouts(config)
+
+    dfSongData = load_song_catalog(spark, input_data, output_data, song_source)
+    if song_source != 'parquet' and start is None:
+        process_song_data(spark, dfSongData, output_data, layouts)
+    process_log_data(spark, input_data, output_data, dfSongData, start, end,
+                     layouts)
+    dfSongData.unpersist()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,157 @@
+import configparser
+
+# default layout of each output table:
+# partition_by: partition columns (directories) of the table
+# repartition: columns the rows are repartitioned by before the write, so
+#              that each partition directory is written by a single task
+# partitions: number of partitions of the repartition, None for
+#             spark.sql.shuffle.partitions (or no repartition without columns)
+# max_records_per_file: rows per file at most, None for no limit
+# sort_within: columns the rows of each file are sorted by, for the
+#              min/max statistics of the parquet row groups
+TABLE_LAYOUTS = {
+    # one directory per year: the artists are far too many to partition by
+    'songs': {'partition_by': ['year'],
+              'repartition': ['year'],
+              'partitions': None,
+              'max_records_per_file': 500000,
+              'sort_within': ['artist_id', 'song_id']},
+    'artists': {'partition_by': [],
+                'repartition': [],
+                'partitions': 1,
+                'max_records_per_file': 500000,
+                'sort_within': ['artist_id']},
+    'users': {'partition_by': [],
+              'repartition': [],
+              'partitions': 1,
+              'max_records_per_file': 500000,
+              'sort_within': ['user_id']},
+    'time': {'partition_by': ['year', 'month'],
+             'repartition': ['year', 'month'],
+             'partitions': None,
+             'max_records_per_file': 500000,
+             'sort_within': ['start_time']},
+    'songplays': {'partition_by': ['year', 'month'],
+                  'repartition': ['year', 'month'],
+                  'partitions': None,
+                  'max_records_per_file': 500000,
+                  'sort_within': ['start_time']},
+}
+
+LIST_KEYS = ['partition_by', 'repartition', 'sort_within']
+INT_KEYS = ['partitions', 'max_records_per_file']
+
+
+def read_layouts(config):
+    """
+        Returns TABLE_LAYOUTS overridden by the [LAYOUT <table>] sections
+        of the configuration, e.g.
+
+            [LAYOUT songs]
+            partition_by = year
+            max_records_per_file = 100000
+
+        Lists are comma separated, and an empty value means none
+
+        Parameters:
+        config: configparser.ConfigParser of dl.cfg
+    """
+
+    layouts = {table: dict(layout) for table, layout in TABLE_LAYOUTS.items()}
+    for table, layout in layouts.items():
+        section = 'LAYOUT {}'.format(table)
+        if not config.has_section(section):
+            continue
+        for key, value in config[section].items():
+            if key in LIST_KEYS:
+                layout[key] = [c.strip() for c in value.split(',') if c.strip()]
+            elif key in INT_KEYS:
+                layout[key] = int(value) if value.strip() else None
+            else:
+                raise configparser.Error('unknown key {} in [{}]'
+                                         .format(key, section))
+    return layouts
+
+
+def write_table(df, path, layout, dynamic=False):
+    """
+        Writes a table to parquet files with its layout and returns the
+        statistics of the files written
+
+        Parameters:
+        df: rows of the table
+        path: path of the table
+        layout: dict with the keys of TABLE_LAYOUTS
+        dynamic: whether to overwrite only the partitions present in df
+                 (dynamic partition overwrite) rather than the whole table
+    """
+
+    if layout['repartition'] and layout['partitions']:
+        df = df.repartition(layout['partitions'],
+                            *layout['repartition'])
+    elif layout['repartition']:
+        df = df.repartition(*layout['repartition'])
+    elif layout['partitions']:
+        df = df.repartition(layout['partitions'])
+
+    # a partitioned write sorts each task by the partition columns unless its
+    # rows already are (Spark 3.4+), which would drop a sort by sort_within only
+    if layout['sort_within']:
+        df = df.sortWithinPartitions(
+            *(layout['partition_by'] + [c for c in layout['sort_within']
+                                        if c not in layout['partition_by']]))
+
+    writer = df.write
+    if layout['partition_by']:
+        writer = writer.partitionBy(*layout['partition_by'])
+    if layout['max_records_per_file']:
+        writer = writer.option('maxRecordsPerFile',
+                               layout['max_records_per_file'])
+    if dynamic:
+        writer = writer.option('partitionOverwriteMode', 'dynamic')
+    writer.parquet(path, 'overwrite')
+
+    return file_stats(df.sparkSession, path)
+
+
+def file_stats(spark, path):
+    """
+        Returns the statistics of the parquet files of a table:
+        dict of files, partitions (directories), total, min and max bytes
+
+        Parameters:
+        spark: spark session
+        path: path of the table
+    """
+
+    jvm = spark.sparkContext._jvm
+    jvm_path = jvm.org.apache.hadoop.fs.Path(path)
+    fs = jvm_path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration())
+
+    sizes = []
+    directories = set()
+    files = fs.listFiles(jvm_path, True)
+    while files.hasNext():
+        status = files.next()
+        if status.getPath().getName().endswith('.parquet'):
+            sizes.append(status.getLen())
+            directories.add(status.getPath().getParent().toString())
+
+    return {'files': len(sizes),
+            'partitions': len(directories),
+            'bytes': sum(sizes),
+            'min_bytes': min(sizes) if sizes else 0,
+            'max_bytes': max(sizes) if sizes else 0}
+
+
+def print_file_stats(table, stats):
+    """
+        Prints the statistics returned by file_stats
+    """
+
+    average = stats['bytes'] / stats['files'] if stats['files'] else 0
+    print('{}: {} files in {} partitions, {:.1f} MB, '
+          '{:.0f} KB per file (min {:.0f} KB, max {:.0f} KB)'
+          .format(table, stats['files'], stats['partitions'],
+                  stats['bytes'] / 1024 ** 2, average / 1024,
+                  stats['min_bytes'] / 1024, stats['max_bytes'] / 1024))
@@ -0,0 +1,101 @@
+import re
+import pyspark.sql.functions as F
+from pyspark.sql import Window
+from pyspark.sql.types import TimestampType
+
+
+def start_time_column(ts='ts'):
+    """
+        Returns the native expression converting an epoch milliseconds
+        column (string or number) to a timestamp, keeping the milliseconds
+
+        Parameters:
+        ts: name of the epoch milliseconds column
+    """
+
+    return (F.col(ts).cast('double') / 1000).cast(TimestampType())
+
+
+def with_start_time(df, ts='ts'):
+    """
+        Adds the start_time (timestamp) and start_date (date) columns
+        computed from the epoch milliseconds column, in a single projection
+        evaluated by the JVM, without Python UDFs
+
+        Parameters:
+        df: log data frame
+        ts: name of the epoch milliseconds column
+    """
+
+    start_time = start_time_column(ts)
+    return df.select('*',
+                     start_time.alias('start_time'),
+                     F.to_date(start_time).alias('start_date'))
+
+
+def song_lookup(dfSongData):
+    """
+        Returns the songplays lookup of the song catalog: one row per
+        (title, artist name, duration), small enough to be broadcast
+
+        Parameters:
+        dfSongData: song catalog, with the columns of the song data files
+    """
+
+    return dfSongData.select(F.col('title').alias('song'),
+                             F.col('artist_name').alias('artist'),
+                             F.col('duration').alias('length'),
+                             'song_id',
+                             'artist_id')\
+                     .dropDuplicates(['song', 'artist', 'length'])
+
+
+def resolve_songplays(dfLogData, lookup, broadcast=True):
+    """
+        Left joins the NextSong events to the song lookup on title,
+        artist name and duration: every event is kept, with null
+        song_id and artist_id when its song is not in the catalog
+
+        Parameters:
+        dfLogData: NextSong events with a start_time column
+        lookup: frame returned by song_lookup
+        broadcast: whether to hint a broadcast of the lookup, otherwise
+                   spark.sql.autoBroadcastJoinThreshold decides
+    """
+
+    if broadcast:
+        lookup = F.broadcast(lookup)
+    return dfLogData.join(lookup, on=['song', 'artist', 'length'], how='left')
+
+
+def join_strategies(df):
+    """
+        Returns the join operators of the physical plan of a frame,
+        e.g. ['BroadcastHashJoin'], to verify how a join is executed
+
+        Parameters:
+        df: data frame
+    """
+
+    plan = df._jdf.queryExecution().executedPlan().toString()
+    return re.findall(r'\b(\w+Join)\b', plan)
+
+
+def latest_users(dfLogData):
+    """
+        Returns one row per user of the events, with the names, gender
+        and level of the latest event of the user
+
+        Parameters:
+        dfLogData: NextSong events
+    """
+
+    latest = Window.partitionBy('userId')\
+                   .orderBy(F.col('ts').cast('long').desc())
+    return dfLogData.withColumn('event_rank', F.row_number().over(latest))\
+                    .where(F.col('event_rank') == 1)\
+                    .select(F.col('userId').alias('user_id'),
+                            F.col('firstName').alias('first_name'),
+                            F.col('lastName').alias('last_name'),
+                            'gender',
+                            'level')